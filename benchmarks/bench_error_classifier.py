@@ -0,0 +1,48 @@
+"""
+micro-benchmark for `ErrorClassifier`
+
+Classifies a mix of Graph error payloads (dominated by expired tokens, as in a
+mass token expiry) with the default rules, then again after registering a
+thousand extra rules.  The per-call cost should stay flat.
+
+    python benchmarks/bench_error_classifier.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import facebook_utils as fb
+
+
+ERRORS = [{'message': 'Error validating access token: Session has expired on Tuesday, 10-Mar-15 12:00:00 PDT.', 'type': 'OAuthException', 'code': 190, 'error_subcode': 463}] * 8 + [
+    {'message': 'Error validating access token: Session has expired at unix time 1426017600.', 'type': 'OAuthException', 'code': 190},
+    {'message': 'Invalid OAuth access token.', 'type': 'OAuthException', 'code': 190},
+    {'message': 'Unsupported scope: foo', 'type': 'OAuthException', 'code': 100},
+    {'message': 'An unknown error has occurred.', 'type': 'OAuthException', 'code': 1},
+    {'message': 'Application request limit reached', 'type': 'OAuthException', 'code': 4},
+    {'message': 'Something nobody has seen before', 'type': 'SomethingException', 'code': 12345},
+]
+
+
+def bench(classifier, number=20000):
+    def run():
+        for error in ERRORS:
+            classifier.exception(error, http_status=400)
+    seconds = min(timeit.repeat(run, number=number, repeat=3))
+    return seconds / (number * len(ERRORS)) * 1e6
+
+
+def main():
+    classifier = fb.default_error_classifier.copy()
+    print 'default rules:          %.2f usec/error' % bench(classifier)
+    for i in range(1000):
+        classifier.register(fb.ApiError, code=100000 + i)
+        classifier.register(fb.ApiError, code=100000 + i, subcode=i)
+        classifier.register(fb.ApiError, message_prefix='Made up message prefix %s' % i)
+    print '+3000 registered rules: %.2f usec/error' % bench(classifier)
+
+
+if __name__ == '__main__':
+    main()
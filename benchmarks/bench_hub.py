@@ -0,0 +1,177 @@
+"""
+offline benchmark of `FacebookHub`, against a local Graph API stand-in
+
+Starts a `GraphStandIn` (see graph_standin.py) and runs each scenario through a
+real `FacebookHub` and `FacebookTransport`, reporting throughput and latency
+percentiles.  With `--latency 0` the numbers are the library's own overhead
+(url building, transport, decoding, error classification); add latency and
+`--failure-rate` to see how concurrency and retries behave.
+
+    python benchmarks/bench_hub.py
+    python benchmarks/bench_hub.py --latency 0.02 --concurrency 16 --failure-rate 0.05 --retry
+    python benchmarks/bench_hub.py --scenario batch --scenario iter_edge
+
+No Facebook credentials are needed; nothing leaves the machine.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import facebook_utils as fb
+from graph_standin import GraphStandIn
+
+
+ACCESS_TOKEN = 'standin-access-token'
+
+
+def scenario_profile(hub):
+    hub.graph__get_profile_for_access_token(access_token=ACCESS_TOKEN)
+
+
+def scenario_oauth(hub):
+    hub.oauth_code__get_access_token(submitted_code='standin-code')
+
+
+def scenario_batch(hub):
+    operations = [{'method': 'GET', 'relative_url': str(i)} for i in range(fb.FB_BATCH_MAX_OPERATIONS)]
+    hub.graph__batch(access_token=ACCESS_TOKEN, operations=operations)
+
+
+def scenario_get_objects(hub):
+    hub.graph__get_objects(access_token=ACCESS_TOKEN, ids=range(fb.FB_IDS_MAX), fields='id,name')
+
+
+def scenario_iter_edge(hub):
+    for item in hub.graph__iter_edge(access_token=ACCESS_TOKEN, edge='friends'):
+        pass
+
+
+def scenario_iter_edge_stream(hub):
+    for item in hub.graph__iter_edge(access_token=ACCESS_TOKEN, edge='friends', stream=True):
+        pass
+
+
+def scenario_errors(hub):
+    try:
+        hub.api_proxy('%s/error/190?subcode=463' % hub.fb_graph_api)
+    except fb.ApiAuthExpiredError:
+        pass
+
+
+SCENARIOS = [('profile', scenario_profile),
+             ('oauth', scenario_oauth),
+             ('batch', scenario_batch),
+             ('get_objects', scenario_get_objects),
+             ('iter_edge', scenario_iter_edge),
+             ('iter_edge_stream', scenario_iter_edge_stream),
+             ('errors', scenario_errors),
+             ]
+
+
+def percentile(timings, pct):
+    if not timings:
+        return 0
+    index = min(len(timings) - 1, int(round(pct / 100.0 * (len(timings) - 1))))
+    return timings[index]
+
+
+def run(hub, fn, iterations, concurrency):
+    """runs `fn(hub)` `iterations` times over `concurrency` threads; returns `(seconds, timings, failures)`"""
+    timings = []
+    failures = []
+    remaining = [iterations]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            started = time.time()
+            try:
+                fn(hub)
+            except Exception as e:
+                with lock:
+                    failures.append(e)
+                continue
+            elapsed = time.time() - started
+            with lock:
+                timings.append(elapsed)
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (time.time() - started, sorted(timings), failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=[name for (name, fn) in SCENARIOS],
+                        help='run only this scenario (repeatable)')
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0, help='seconds the stand-in waits before every response')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of responses replaced by a transient error')
+    parser.add_argument('--retry', action='store_true', help='give the transport a RetryPolicy')
+    parser.add_argument('--instrument', action='store_true', help='record calls with a HistogramSink, and report per endpoint')
+    options = parser.parse_args()
+
+    server = GraphStandIn(latency=options.latency, failure_rate=options.failure_rate).start()
+    retry_policy = None
+    if options.retry:
+        retry_policy = fb.RetryPolicy(backoff_base=0.001, backoff_max=0.01)
+    transport = fb.FacebookTransport(pool_maxsize=max(10, options.concurrency), retry_policy=retry_policy)
+    sink = None
+    instrumentation = None
+    if options.instrument:
+        sink = fb.HistogramSink()
+        instrumentation = fb.Instrumentation(sink)
+    hub = fb.FacebookHub(app_id='123',
+                         app_secret='secret',
+                         app_scope='email',
+                         oauth_code_redirect_uri='http://127.0.0.1/oauth',
+                         transport=transport,
+                         instrumentation=instrumentation,
+                         )
+    hub.fb_graph_api = server.url
+
+    print 'stand-in at %s, latency %sms, failure rate %s%%, concurrency %s, %s iterations' % (
+        server.url, options.latency * 1000, options.failure_rate * 100, options.concurrency, options.iterations)
+    print '%-18s %10s %9s %9s %9s %9s %9s %8s' % ('scenario', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'requests', 'failed')
+    try:
+        for (name, fn) in SCENARIOS:
+            if options.scenario and name not in options.scenario:
+                continue
+            fn(hub)  # warm up the connection pool
+            requests_before = server.requests
+            (seconds, timings, failures) = run(hub, fn, options.iterations, options.concurrency)
+            print '%-18s %10.1f %9.2f %9.2f %9.2f %9.2f %9d %8d' % (name,
+                                                                 len(timings) / seconds,
+                                                                 percentile(timings, 50) * 1000,
+                                                                 percentile(timings, 90) * 1000,
+                                                                 percentile(timings, 99) * 1000,
+                                                                 (timings[-1] if timings else 0) * 1000,
+                                                                 server.requests - requests_before,
+                                                                 len(failures),
+                                                                 )
+    finally:
+        transport.close()
+        server.stop()
+    if retry_policy is not None:
+        print 'retries: %s' % retry_policy.stats()
+    if sink is not None:
+        print 'p90 by endpoint (instrumented):'
+        for (seconds, endpoint, method) in sink.slowest(20):
+            print '  %-7s %-24s %9.2f ms' % (method, endpoint, seconds * 1000)
+
+
+if __name__ == '__main__':
+    main()
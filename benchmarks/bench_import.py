@@ -0,0 +1,80 @@
+"""
+import-time benchmark for `facebook_utils`
+
+Runs each scenario in a fresh interpreter, several times, and reports how long
+its imports took (the median and the fastest run), how many modules were
+loaded, and whether `requests` was among them.  Cold-start-sensitive workers
+(pre-fork servers, serverless functions) pay this on every start, so compare
+the numbers before and after changing what the package imports.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --repeat 20 --scenario urls --scenario signed_request
+
+No Facebook credentials are needed; nothing leaves the machine.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SCENARIOS = [('package', 'import facebook_utils'),
+             ('urls', 'import facebook_utils\n'
+                      'facebook_utils.FacebookApiUrls.oauth_code__url_dialog(app_id="123", redirect_uri="http://example.com/", scope="email")'),
+             ('signed_request', 'import facebook_utils\n'
+                                'hub = facebook_utils.FacebookHub(app_id="123", app_secret="secret")\n'
+                                'hub.signed_request_verifier'),
+             ('hub_transport', 'import facebook_utils\n'
+                               'facebook_utils.FacebookHub(app_id="123", app_secret="secret").transport'),
+             ('everything', 'from facebook_utils import *'),
+             ('requests', 'import requests'),
+             ]
+
+# runs in the child interpreter; prints `seconds modules requests_loaded`
+CHILD = '''
+import sys
+import time
+started = time.time()
+exec compile(%r, '<scenario>', 'exec')
+elapsed = time.time() - started
+print elapsed, len([m for m in sys.modules.values() if m is not None]), 'requests' in sys.modules
+'''
+
+
+def measure(python, code):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [i for i in [env.get('PYTHONPATH')] if i])
+    output = subprocess.check_output([python, '-c', CHILD % code], env=env, cwd=ROOT)
+    (seconds, modules, requests_loaded) = output.split()
+    return (float(seconds), int(modules), requests_loaded == 'True')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=[name for (name, code) in SCENARIOS],
+                        help='run only this scenario (repeatable)')
+    parser.add_argument('--repeat', type=int, default=10, help='fresh interpreters per scenario')
+    parser.add_argument('--python', default=sys.executable, help='the interpreter to measure')
+    options = parser.parse_args()
+
+    # compile the package once, so every run measures a warm .pyc cache
+    measure(options.python, 'from facebook_utils import *')
+    print '%-16s %10s %10s %9s %9s' % ('scenario', 'median ms', 'min ms', 'modules', 'requests')
+    for (name, code) in SCENARIOS:
+        if options.scenario and name not in options.scenario:
+            continue
+        runs = [measure(options.python, code) for i in range(options.repeat)]
+        timings = sorted(seconds for (seconds, modules, requests_loaded) in runs)
+        (seconds, modules, requests_loaded) = runs[-1]
+        print '%-16s %10.2f %10.2f %9d %9s' % (name,
+                                              timings[len(timings) // 2] * 1000,
+                                              timings[0] * 1000,
+                                              modules,
+                                              'yes' if requests_loaded else 'no',
+                                              )
+
+
+if __name__ == '__main__':
+    main()
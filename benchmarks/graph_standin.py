@@ -0,0 +1,197 @@
+"""
+a local stand-in for the Graph API, for benchmarking `facebook_utils` offline
+
+`GraphStandIn` is a threaded HTTP/1.1 (keep-alive) server which answers the
+endpoints `FacebookHub` talks to:
+
+    GET  /oauth/access_token        urlencoded `access_token=...&expires=...`
+    GET  /me, /{id}                 a json profile
+    GET  /me/{edge}, /{id}/{edge}   `edge_items` items, `limit` per page, with `paging.next` cursors
+    GET  /?ids=1,2,3                a dict of profiles keyed by id
+    POST /  (batch=...)             a batch response; every operation gets a profile or an edge page
+    GET  /error/{code}              a Graph error body for that code (`?subcode=`, `?status=`)
+
+Every response is delayed by `latency` seconds, and a `failure_rate` fraction
+of them is replaced with a transient Graph error (code 2, http 500).
+
+    server = GraphStandIn(latency=0.002).start()
+    hub.fb_graph_api = server.url
+    ...
+    server.stop()
+"""
+import BaseHTTPServer
+import SocketServer
+import threading
+import socket
+import urlparse
+import random
+import time
+import json
+
+
+ERROR_BODIES = {
+    1: {'message': 'An unknown error has occurred.', 'type': 'OAuthException'},
+    2: {'message': 'An unexpected error has occurred. Please retry your request later.', 'type': 'OAuthException'},
+    4: {'message': 'Application request limit reached', 'type': 'OAuthException'},
+    17: {'message': 'User request limit reached', 'type': 'OAuthException'},
+    100: {'message': 'Unsupported get request.', 'type': 'GraphMethodException'},
+    190: {'message': 'Error validating access token: Session has expired on Tuesday, 10-Mar-15 12:00:00 PDT.', 'type': 'OAuthException'},
+}
+
+
+def profile(object_id):
+    return {'id': object_id,
+            'name': 'Stand-in User %s' % object_id,
+            'first_name': 'Stand-in',
+            'last_name': 'User %s' % object_id,
+            'email': 'user%s@example.com' % object_id,
+            'locale': 'en_US',
+            }
+
+
+def error_body(code, subcode=None):
+    error = dict(ERROR_BODIES.get(code, {'message': 'Error %s' % code, 'type': 'OAuthException'}))
+    error['code'] = code
+    if subcode is not None:
+        error['error_subcode'] = subcode
+    return {'error': error}
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # write each response in as few segments as possible, and don't hold back the last one;
+    # otherwise Nagle's algorithm and delayed ACKs add ~40ms to every response
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, content_type='application/json'):
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, method, body=None):
+        standin = self.server.standin
+        standin._count()
+        if standin.latency:
+            time.sleep(standin.latency)
+        if standin.failure_rate and random.random() < standin.failure_rate:
+            return self._reply(500, error_body(2))
+
+        parsed = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(parsed.query))
+        if body:
+            query.update(urlparse.parse_qsl(body))
+        # accept versioned paths (`/v2.3/me`) and the double slashes of a versioned `fb_graph_api`
+        segments = [s for s in parsed.path.split('/') if s]
+        if segments and segments[0].startswith('v') and segments[0][1:2].isdigit():
+            segments = segments[1:]
+        (status, payload) = standin.respond(method, segments, query, self.headers.get('Host'))
+        if isinstance(payload, basestring):
+            return self._reply(status, payload, content_type='text/plain')
+        return self._reply(status, payload)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._dispatch('POST', self.rfile.read(length) if length else '')
+
+    def do_DELETE(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._dispatch('DELETE', self.rfile.read(length) if length else '')
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class GraphStandIn(object):
+    """a local Graph API stand-in; see the module docstring"""
+    latency = 0
+    failure_rate = 0
+    edge_items = 250
+    page_size = 25
+
+    def __init__(self, latency=None, failure_rate=None, edge_items=None, page_size=None, port=0):
+        if latency is not None:
+            self.latency = latency
+        if failure_rate is not None:
+            self.failure_rate = failure_rate
+        if edge_items is not None:
+            self.edge_items = edge_items
+        if page_size is not None:
+            self.page_size = page_size
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.standin = self
+        self._thread = None
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self._server.server_address[1]
+
+    def _count(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def edge_page(self, host, path, query):
+        limit = int(query.get('limit') or self.page_size)
+        start = int(query.get('after') or 0)
+        stop = min(start + limit, self.edge_items)
+        page = {'data': [{'id': str(i), 'name': 'Item %s' % i} for i in range(start, stop)]}
+        if stop < self.edge_items:
+            page['paging'] = {'cursors': {'after': str(stop)},
+                              'next': 'http://%s/%s?access_token=%s&limit=%s&after=%s' % (host, path, query.get('access_token', ''), limit, stop),
+                              }
+        return page
+
+    def respond(self, method, segments, query, host):
+        """returns `(http_status, payload)` for a request; a string payload is sent as text"""
+        if segments[:1] == ['error']:
+            code = int(segments[1]) if len(segments) > 1 else 1
+            subcode = int(query['subcode']) if 'subcode' in query else None
+            return (int(query.get('status') or 400), error_body(code, subcode))
+        if segments[:2] == ['oauth', 'access_token']:
+            return (200, 'access_token=standin-token-%s&expires=5183999' % random.randint(0, 1 << 30))
+        if not segments:
+            if method == 'POST' and 'batch' in query:
+                return (200, [self.batch_item(host, operation) for operation in json.loads(query['batch'])])
+            if 'ids' in query:
+                return (200, dict((i, profile(i)) for i in query['ids'].split(',')))
+            return (400, error_body(100))
+        if len(segments) == 1:
+            return (200, profile(segments[0]))
+        return (200, self.edge_page(host, '/'.join(segments), query))
+
+    def batch_item(self, host, operation):
+        parsed = urlparse.urlparse(operation.get('relative_url', ''))
+        segments = [s for s in parsed.path.split('/') if s]
+        (status, payload) = self.respond(operation.get('method', 'GET'), segments, dict(urlparse.parse_qsl(parsed.query)), host)
+        return {'code': status,
+                'headers': [{'name': 'Content-Type', 'value': 'application/json'}],
+                'body': json.dumps(payload),
+                }
@@ -1,3 +1,71 @@
-from facebook_utils import *
-from facebook_api_urls import *
-from facebook_exceptions import *
+"""
+The package's names are loaded lazily: `import facebook_utils` imports none of the
+submodules, and a submodule is only imported when one of its names is first used.
+Building `FacebookApiUrls` urls or verifying signed requests never imports `requests`,
+which is only needed once a hub goes to the network.
+
+`from facebook_utils import *` still imports everything.
+"""
+import importlib
+import types
+import sys
+
+
+# submodule -> the public names it defines
+_exports = {
+    'facebook_utils': ('FacebookHub', 'DEBUG', 'JSONDecodeError'),
+    'facebook_api_urls': ('FacebookApiUrls', 'GraphQuery', 'FB_GRAPH_API_URL', 'FB_URL', 'FB_BATCH_MAX_OPERATIONS', 'FB_IDS_MAX',
+                          'hash_access_token', 'url_access_token', 'url_endpoint_class', 'url_endpoint_template',
+                          'url_hash_access_token', 'url_normalized'),
+    'facebook_exceptions': ('ApiError', 'ApiAuthError', 'ApiAuthExpiredError', 'ApiApplicationError', 'ApiRateLimitError',
+                            'ApiCircuitOpenError', 'ApiTimeoutError', 'ApiResponseError', 'ApiRuntimeError',
+                            'ApiRuntimeVerirficationFormatError', 'ApiRuntimeGrantError', 'ApiRuntimeScopeError',
+                            'ApiRuntimeGraphMethodError', 'ApiUnhandledError', 'ErrorClassifier', 'default_error_classifier',
+                            'reformat_error', 'facebook_time'),
+    'facebook_transport': ('FacebookTransport', 'RetryPolicy'),
+    'facebook_concurrency': ('BoundedExecutor', 'Future', 'FutureTimeoutError', 'SingleFlight', 'gather', 'imap_unordered',
+                             'map_bounded', 'result_within_deadline'),
+    'facebook_deadline': ('Deadline', 'current_deadline', 'with_deadline'),
+    'facebook_async': ('AsyncFacebookHub', ),
+    'facebook_pyramid': ('FacebookPyramid', 'FacebookRequestHub', 'hub_kwargs_from_settings', 'includeme', 'registry_hub',
+                         'registry_hub_kwargs',
+                         'set_facebook_hub'),
+    'facebook_batch': ('BatchResult', 'batch_item_result'),
+    'facebook_breaker': ('CircuitBreaker', 'CLOSED', 'OPEN', 'HALF_OPEN'),
+    'facebook_cache': ('CacheBackend', 'ClientCacheBackend', 'MemoryCacheBackend', 'ResponseCache'),
+    'facebook_coalesce': ('BatchCoalescer', ),
+    'facebook_instrumentation': ('GraphCall', 'HistogramSink', 'Instrumentation', 'PrometheusSink', 'PHASES'),
+    'facebook_ratelimit': ('RateLimiter', ),
+    'facebook_signed_request': ('SignedRequestVerifier', 'base64_url_decode'),
+    'facebook_stream': ('GraphStream', 'JsonArrayScanner', 'LazyBatchItem'),
+    'facebook_tokens': ('TokenRefreshManager', 'TokenStateIndex'),
+}
+
+# public name -> the submodule which defines it
+_names = dict((name, module) for (module, names) in _exports.items() for name in names)
+
+
+class _LazyPackage(types.ModuleType):
+    """stands in for this package in `sys.modules`, importing a submodule when one of its names is first used"""
+
+    def __getattr__(self, name):
+        module = _names.get(name)
+        if module is None:
+            if name in _exports:
+                # a submodule itself; importing it sets the attribute
+                return importlib.import_module('%s.%s' % (self.__name__, name))
+            raise AttributeError("module '%s' has no attribute '%s'" % (self.__name__, name))
+        value = getattr(importlib.import_module('%s.%s' % (self.__name__, module)), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_names))
+
+
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update((k, v) for (k, v) in globals().items() if k.startswith('__'))
+_package.__all__ = sorted(_names)
+# python 2 clears a module's globals when it is garbage collected; `_LazyPackage` still needs them
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
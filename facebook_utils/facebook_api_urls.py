@@ -1,11 +1,176 @@
 # -*- coding: utf-8 -*-
 
 import urllib
+import urlparse
+import hashlib
+import re
 
 
 FB_GRAPH_API_URL = 'https://graph.facebook.com/'
 FB_URL = 'https://www.facebook.com'
 
+# Graph rejects batch requests with more operations than this
+FB_BATCH_MAX_OPERATIONS = 50
+
+# Graph rejects `?ids=` requests with more ids than this
+FB_IDS_MAX = 50
+
+_re_api_version = re.compile(r'^v\d+\.\d+$')
+_re_object_id = re.compile(r'^\d+(_\d+)?$')
+
+
+def url_access_token(url):
+    """returns the `access_token` in a url's query string, or None"""
+    query = urlparse.parse_qs(urlparse.urlsplit(url).query)
+    if 'access_token' in query:
+        return query['access_token'][-1]
+    return None
+
+
+def hash_access_token(access_token):
+    """a stable digest of an access token, safe to use in keys and logs"""
+    if isinstance(access_token, unicode):
+        access_token = access_token.encode('utf-8')
+    return hashlib.sha256(access_token).hexdigest()
+
+
+def url_hash_access_token(url):
+    """returns the url with its `access_token` replaced by a digest of the token, so the url can be used as a key without storing the token"""
+    parts = urlparse.urlsplit(url)
+    if 'access_token=' not in parts.query:
+        return url
+    query = []
+    for (k, v) in urlparse.parse_qsl(parts.query, keep_blank_values=True):
+        if k == 'access_token':
+            v = hash_access_token(v)
+        query.append((k, v))
+    return urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path, urllib.urlencode(query), parts.fragment))
+
+
+def url_normalized(url):
+    """returns the url with a lowercase scheme and host, its query parameters sorted and no fragment, so equivalent urls compare equal"""
+    parts = urlparse.urlsplit(url)
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urlparse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+
+def url_endpoint_template(url):
+    """reduces a Graph url to its endpoint template: no host, api version, query string or object ids.
+
+        https://graph.facebook.com/v2.3/12345/friends?access_token=abc  ->  /{id}/friends
+    """
+    segments = [i for i in urlparse.urlsplit(url).path.split('/') if i]
+    if segments and _re_api_version.match(segments[0]):
+        segments = segments[1:]
+    template = []
+    for segment in segments:
+        if _re_object_id.match(segment):
+            segment = '{id}'
+        elif ':' in segment:
+            segment = '{namespace}:{action}'
+        template.append(segment)
+    return '/' + '/'.join(template)
+
+
+def url_endpoint_class(url, method='GET'):
+    """groups Graph urls into coarse endpoint classes: 'oauth', 'batch', 'objects', 'actions', 'profile' or 'edge'"""
+    template = url_endpoint_template(url)
+    if template.startswith('/oauth') or template == '/debug_token':
+        return 'oauth'
+    if template == '/':
+        if method == 'GET':
+            return 'objects'
+        return 'batch'
+    if ':' in template or method == 'DELETE':
+        return 'actions'
+    if template.count('/') == 1:
+        return 'profile'
+    return 'edge'
+
+
+class GraphQuery(object):
+    """Composes a Graph request: field projection, nested edge expansions, modifiers and cursors.
+
+        query = GraphQuery('me').fields('id', 'name').edge('friends', 'id', 'name', limit=100)
+        query.querystring()  ->  fields=id,name,friends.limit(100){id,name}
+
+    `edge()` nests another `GraphQuery`; modifiers on a nested edge are rendered inline
+    (`friends.limit(100)`), while modifiers on the top-level query (`limit()`, `after()`,
+    `before()`, `modifier()`) become query string parameters.  Every method returns the
+    query, so calls can be chained.
+    """
+
+    def __init__(self, path='me', *fields, **modifiers):
+        self.path = path
+        self._fields = []
+        self._modifiers = []
+        self.fields(*fields)
+        for (name, value) in sorted(modifiers.items()):
+            self.modifier(name, value)
+
+    def fields(self, *fields):
+        """adds fields; each is a field name, a comma-separated string of names, or a nested `GraphQuery`"""
+        for field in fields:
+            if isinstance(field, GraphQuery):
+                self._fields.append(field)
+            else:
+                self._fields.extend(i.strip() for i in field.split(',') if i.strip())
+        return self
+
+    def edge(self, name, *fields, **modifiers):
+        """adds a nested edge expansion, e.g. `edge('friends', 'id', 'name', limit=100)`"""
+        return self.fields(GraphQuery(name, *fields, **modifiers))
+
+    def modifier(self, name, value):
+        self._modifiers = [(k, v) for (k, v) in self._modifiers if k != name]
+        self._modifiers.append((name, value))
+        return self
+
+    def limit(self, limit):
+        return self.modifier('limit', int(limit))
+
+    def after(self, cursor):
+        return self.modifier('after', cursor)
+
+    def before(self, cursor):
+        return self.modifier('before', cursor)
+
+    def field_list(self):
+        """the rendered `fields=` value"""
+        return u','.join(field.expression() if isinstance(field, GraphQuery) else field for field in self._fields)
+
+    def expression(self):
+        """this query rendered as a nested field expression: `name.modifier(value){fields}`"""
+        rval = self.path + u''.join(u'.{0}({1})'.format(k, self._render(v)) for (k, v) in self._modifiers)
+        if self._fields:
+            rval += u'{%s}' % self.field_list()
+        return rval
+
+    def _render(self, value):
+        if value is True:
+            return u'true'
+        if value is False:
+            return u'false'
+        return unicode(value)
+
+    def params(self):
+        """the query string parameters for this query, as a list of (key, value)"""
+        rval = []
+        if self._fields:
+            rval.append(('fields', self.field_list()))
+        rval.extend((k, self._render(v)) for (k, v) in self._modifiers)
+        return rval
+
+    def querystring(self):
+        return urllib.urlencode([(k, v.encode('utf-8')) for (k, v) in self.params()])
+
+    def url(self, fb_graph_api, access_token):
+        params = self.params() + [('access_token', access_token)]
+        return u'{fb_graph_api}/{path}?{query}'.format(fb_graph_api=fb_graph_api.rstrip('/'),
+                                                       path=self.path.lstrip('/'),
+                                                       query=urllib.urlencode([(k, unicode(v).encode('utf-8')) for (k, v) in params]),
+                                                       )
+
 
 class FacebookApiUrls(object):
 
@@ -62,9 +227,25 @@ class FacebookApiUrls(object):
                                                                        access_token=urllib.urlencode(dict(access_token=access_token)),
                                                                        )
 
+    @classmethod
+    def graph__url_debug_token(cls, fb_graph_api, input_token, access_token):
+        return u'{fb_graph_api}/debug_token?{query}'.format(fb_graph_api=fb_graph_api,
+                                                            query=urllib.urlencode([('input_token', input_token), ('access_token', access_token)]),
+                                                            )
+
+    @classmethod
+    def graph__url_objects_for_access_token(cls, fb_graph_api, access_token, ids, fields=None):
+        query = [('ids', u','.join(ids))]
+        if fields:
+            query.append(('fields', fields))
+        query.append(('access_token', access_token))
+        return u'{fb_graph_api}?{query}'.format(fb_graph_api=fb_graph_api,
+                                                query=urllib.urlencode([(k, unicode(v).encode('utf-8')) for (k, v) in query]),
+                                                )
+
     @classmethod
     def graph__action_create_url(cls, fb_graph_api, fb_app_namespace, fb_action_type_name):
-        return u'{fb_graph_api}/me/{fb_fb_app_namespace}:{fb_action_type_name}'.format(fb_graph_api=fb_graph_api,
+        return u'{fb_graph_api}/me/{fb_app_namespace}:{fb_action_type_name}'.format(fb_graph_api=fb_graph_api,
                                                                                        fb_app_namespace=fb_app_namespace,
                                                                                        fb_action_type_name=fb_action_type_name,
                                                                                        )
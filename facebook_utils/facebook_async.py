@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import inspect
+
+from facebook_utils import FacebookHub
+from facebook_transport import FacebookTransport
+from facebook_concurrency import BoundedExecutor
+from facebook_deadline import with_deadline
+
+
+class AsyncFacebookHub(object):
+    """A non-blocking counterpart to `FacebookHub`.
+
+    The network methods mirror `FacebookHub`, but return a `Future` instead of
+    blocking; call `.result()` on it to get the payload or to re-raise the same
+    `ApiError` subclass the blocking hub would have raised.
+
+    Calls run on a `BoundedExecutor`, so at most `max_concurrency` requests are
+    on the wire at once, while any number of them may be queued.  Pass
+    `max_pending` to make submitting block once that many calls are waiting.
+    A `deadline=` (or a `Deadline` entered around the call) starts when the call is submitted, so it covers the time queued.
+
+    Attributes and the methods which don't touch the network (url builders, `verify_signed_request`, ...; see
+    `proxied_methods`) are proxied straight through to the underlying hub.  The other `FacebookHub` methods
+    which aren't mirrored here (the iterators, `api_proxy_stream`, `map_tokens`, ...) raise `AttributeError`
+    instead of blocking the caller; call them on `hub` if that is what you want.
+    """
+    hub = None
+    executor = None
+    proxied_methods = ('oauth_code__url_dialog',
+                       'oauth_code__url_access_token',
+                       'oauth_token__url_dialog',
+                       'oauth__url_extend_access_token',
+                       'graph__url_me',
+                       'graph__url_me_for_access_token',
+                       'graph__url_user_for_access_token',
+                       'graph__get_profile',
+                       'verify_signed_request',
+                       )
+
+    def __init__(self,
+                 max_concurrency=10,
+                 max_pending=None,
+                 executor=None,
+                 hub=None,
+                 **hub_kwargs
+                 ):
+        if hub is None:
+            if 'transport' not in hub_kwargs:
+                hub_kwargs['transport'] = FacebookTransport(pool_maxsize=max_concurrency)
+            hub = FacebookHub(**hub_kwargs)
+        elif hub_kwargs:
+            raise ValueError('submit either a hub or FacebookHub arguments, not both')
+        if executor is None:
+            executor = BoundedExecutor(max_workers=max_concurrency,
+                                       max_pending=max_pending,
+                                       )
+        self.hub = hub
+        self.executor = executor
+
+    def __getattr__(self, name):
+        if (name not in self.proxied_methods) and inspect.isroutine(getattr(FacebookHub, name, None)):
+            raise AttributeError("'AsyncFacebookHub' does not mirror the blocking '%s'; call it on `hub`" % name)
+        return getattr(self.hub, name)
+
+    def _submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
+
+    @with_deadline
+    def api_proxy(self, url, post_data=None, expected_format='json.load', is_delete=False, ssl_verify=None):
+        if (self.hub.single_flight is not None) and not post_data:
+            # identical calls share one future, and so one worker
+            return self.hub.single_flight.future(self.hub._single_flight_key(url, expected_format, ssl_verify),
+                                                 lambda: self._submit(self.hub._api_proxy_call, url, post_data, expected_format, is_delete, ssl_verify),
+                                                 )
+        return self._submit(self.hub.api_proxy,
+                            url,
+                            post_data=post_data,
+                            expected_format=expected_format,
+                            is_delete=is_delete,
+                            ssl_verify=ssl_verify,
+                            )
+
+    @with_deadline
+    def oauth_code__get_access_token(self, submitted_code=None, redirect_uri=None, scope=None):
+        return self._submit(self.hub.oauth_code__get_access_token,
+                            submitted_code=submitted_code,
+                            redirect_uri=redirect_uri,
+                            scope=scope,
+                            )
+
+    @with_deadline
+    def oauth_code__get_access_token_and_profile(self, submitted_code=None, redirect_uri=None, scope=None):
+        return self._submit(self.hub.oauth_code__get_access_token_and_profile,
+                            submitted_code=submitted_code,
+                            redirect_uri=redirect_uri,
+                            scope=scope,
+                            )
+
+    @with_deadline
+    def graph__extend_access_token(self, access_token=None):
+        return self._submit(self.hub.graph__extend_access_token,
+                            access_token=access_token,
+                            )
+
+    @with_deadline
+    def graph__debug_token(self, input_token=None, access_token=None):
+        return self._submit(self.hub.graph__debug_token,
+                            input_token=input_token,
+                            access_token=access_token,
+                            )
+
+    @with_deadline
+    def graph__get_profile_for_access_token(self, access_token=None, user=None, action=None, query=None):
+        return self._submit(self.hub.graph__get_profile_for_access_token,
+                            access_token=access_token,
+                            user=user,
+                            action=action,
+                            query=query,
+                            )
+
+    @with_deadline
+    def graph__query(self, access_token=None, query=None):
+        return self._submit(self.hub.graph__query,
+                            access_token=access_token,
+                            query=query,
+                            )
+
+    @with_deadline
+    def graph__batch(self, access_token=None, operations=None, chunk_size=None, concurrency=4):
+        return self._submit(self.hub.graph__batch,
+                            access_token=access_token,
+                            operations=operations,
+                            chunk_size=chunk_size,
+                            concurrency=concurrency,
+                            )
+
+    @with_deadline
+    def graph__action_create_many(self, access_token=None, actions=None, chunk_size=None, concurrency=4, max_attempts=3):
+        return self._submit(self.hub.graph__action_create_many,
+                            access_token=access_token,
+                            actions=actions,
+                            chunk_size=chunk_size,
+                            concurrency=concurrency,
+                            max_attempts=max_attempts,
+                            )
+
+    @with_deadline
+    def graph__action_delete_many(self, access_token=None, action_ids=None, chunk_size=None, concurrency=4, max_attempts=3):
+        return self._submit(self.hub.graph__action_delete_many,
+                            access_token=access_token,
+                            action_ids=action_ids,
+                            chunk_size=chunk_size,
+                            concurrency=concurrency,
+                            max_attempts=max_attempts,
+                            )
+
+    @with_deadline
+    def graph__get_objects(self, access_token=None, ids=None, fields=None, chunk_size=None, concurrency=4):
+        return self._submit(self.hub.graph__get_objects,
+                            access_token=access_token,
+                            ids=ids,
+                            fields=fields,
+                            chunk_size=chunk_size,
+                            concurrency=concurrency,
+                            )
+
+    @with_deadline
+    def graph__action_create(self,
+                             access_token=None,
+                             fb_app_namespace=None,
+                             fb_action_type_name=None,
+                             object_type_name=None,
+                             object_instance_url=None,
+                             ):
+        return self._submit(self.hub.graph__action_create,
+                            access_token=access_token,
+                            fb_app_namespace=fb_app_namespace,
+                            fb_action_type_name=fb_action_type_name,
+                            object_type_name=object_type_name,
+                            object_instance_url=object_instance_url,
+                            )
+
+    @with_deadline
+    def graph__action_list(self, access_token=None, fb_app_namespace=None, fb_action_type_name=None):
+        return self._submit(self.hub.graph__action_list,
+                            access_token=access_token,
+                            fb_app_namespace=fb_app_namespace,
+                            fb_action_type_name=fb_action_type_name,
+                            )
+
+    @with_deadline
+    def graph__action_delete(self, access_token=None, action_id=None):
+        return self._submit(self.hub.graph__action_delete,
+                            access_token=access_token,
+                            action_id=action_id,
+                            )
+
+    def close(self, wait=True):
+        """stops the worker threads once the queued calls have run"""
+        self.executor.shutdown(wait=wait)
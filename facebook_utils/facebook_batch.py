@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import types
+import time
+
+from facebook_exceptions import *
+from facebook_deadline import current_deadline
+
+
+def batch_item_result(item, error_classifier=None):
+    """the decoded body of a batch response item, or the `ApiError` (subclass) a failed item maps to"""
+    if item is None:
+        # Graph returns null for an operation which didn't complete
+        return ApiError(message='The batch operation did not complete', http_status=504)
+    code = item.get('code')
+    body = item.get('body')
+    if code == 200:
+        return body
+    if isinstance(body, types.DictType) and ('error' in body):
+        if error_classifier is None:
+            error_classifier = default_error_classifier
+        return error_classifier.exception(body['error'], http_status=code)
+    return ApiError(message='Could not communicate with the API', code=code, http_status=code, response=body)
+
+
+class BatchResult(list):
+    """The response to a batch, as returned by `FacebookHub.graph__batch`.
+
+    It is the list of response items (with decoded bodies) in the order of the operations, as before;
+    `results` has the outcome of each operation instead: its body, or the `ApiError` subclass its
+    error maps to, classified like a top-level response.
+
+    `succeeded` and `failed` list `(index, body)` and `(index, error)` pairs, and `retry()`
+    resubmits only the operations whose error is retryable, merging their new outcome in place.
+    """
+
+    def __init__(self, items, operations, hub=None, access_token=None, chunk_size=None, concurrency=4):
+        list.__init__(self, items)
+        self.operations = list(operations)
+        self.hub = hub
+        self.access_token = access_token
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        error_classifier = hub.error_classifier if hub is not None else None
+        self.results = [batch_item_result(item, error_classifier) for item in self]
+        self.attempts = [1] * len(self)
+
+    @property
+    def succeeded(self):
+        return [(i, result) for (i, result) in enumerate(self.results) if not isinstance(result, ApiError)]
+
+    @property
+    def failed(self):
+        return [(i, result) for (i, result) in enumerate(self.results) if isinstance(result, ApiError)]
+
+    def retryable(self, retry_policy=None):
+        """the indexes of the failed operations which are worth resubmitting, according to `retry_policy` (see `RetryPolicy`)"""
+        if retry_policy is None:
+            retry_policy = self._retry_policy()
+        return [i for (i, error) in self.failed if retry_policy.is_retryable(error, self.operations[i].get('method', 'GET'))]
+
+    def _retry_policy(self):
+        retry_policy = getattr(getattr(self.hub, 'transport', None), 'retry_policy', None)
+        if retry_policy is None:
+            # imported here, as it imports `requests`
+            from facebook_transport import RetryPolicy
+            retry_policy = RetryPolicy()
+        return retry_policy
+
+    def retry(self, max_attempts=3, retry_policy=None):
+        """resubmits the retryable failures, with backoff, until they succeed or an operation was tried `max_attempts` times; returns self.
+
+        `retry_policy` defaults to the hub transport's (or a default `RetryPolicy`).  Under a `Deadline`, the backoff
+        is capped to the time left, and `ApiTimeoutError` is raised once it is spent.
+        """
+        if self.hub is None:
+            raise ValueError('this BatchResult has no hub to resubmit with')
+        if retry_policy is None:
+            retry_policy = self._retry_policy()
+        while True:
+            pending = [i for i in self.retryable(retry_policy) if self.attempts[i] < max_attempts]
+            if not pending:
+                return self
+            delay = max(retry_policy.backoff(self.attempts[i], self.results[i]) for i in pending)
+            deadline = current_deadline()
+            if deadline is not None:
+                deadline.check()
+                delay = min(delay, deadline.remaining())
+            time.sleep(delay)
+            if deadline is not None:
+                deadline.check()
+            resubmitted = self.hub.graph__batch(self.access_token,
+                                                [self.operations[i] for i in pending],
+                                                chunk_size=self.chunk_size,
+                                                concurrency=self.concurrency,
+                                                )
+            for (i, item, result) in zip(pending, resubmitted, resubmitted.results):
+                self[i] = item
+                self.results[i] = result
+                self.attempts[i] += 1
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import time
+
+from facebook_exceptions import *
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class _Circuit(object):
+
+    def __init__(self, window_size):
+        self.state = CLOSED
+        # the most recent outcomes, as `(failed, slow)`
+        self.outcomes = collections.deque(maxlen=window_size)
+        self.opened_at = None
+        self.probes = 0
+        self.probe_successes = 0
+        self.rejected = 0
+        self.trips = 0
+
+
+class CircuitBreaker(object):
+    """Fails calls fast while Graph is failing, instead of letting each one wait for its timeout.
+
+    There is a circuit per endpoint class ('oauth', 'profile', 'edge', 'actions', 'batch', 'objects'; see
+    `url_endpoint_class`), over the outcomes of its last `window_size` requests:
+
+    * closed: requests go through.  Once there are at least `min_calls` outcomes, and the share of failures
+      reaches `error_rate` or the share of requests slower than `slow_seconds` reaches `slow_rate`, it opens
+    * open: requests raise `ApiCircuitOpenError` at once, for `open_seconds`; then it is half open
+    * half open: up to `probes` requests at a time go through.  A failed (or slow) probe opens it again;
+      `probes` successful ones close it, with a clean slate
+
+    A failure is a connection error or timeout, or an HTTP 5xx response; other errors (auth errors,
+    throttling, ...) mean Graph is answering, so they count as successes.
+
+    `on_transition(endpoint_class, old_state, new_state)`, if given, is called on every state change (outside
+    the lock); the most recent `max_transitions` changes are also kept in `transitions`, as
+    `(time, endpoint_class, old_state, new_state)`.
+    """
+    window_size = 50
+    min_calls = 20
+    error_rate = 0.5
+    slow_seconds = 10.0
+    slow_rate = 0.8
+    open_seconds = 30.0
+    probes = 1
+    max_transitions = 100
+
+    def __init__(self,
+                 window_size=None,
+                 min_calls=None,
+                 error_rate=None,
+                 slow_seconds=None,
+                 slow_rate=None,
+                 open_seconds=None,
+                 probes=None,
+                 on_transition=None,
+                 ):
+        if window_size is not None:
+            self.window_size = window_size
+        if min_calls is not None:
+            self.min_calls = min_calls
+        if error_rate is not None:
+            self.error_rate = error_rate
+        if slow_seconds is not None:
+            self.slow_seconds = slow_seconds
+        if slow_rate is not None:
+            self.slow_rate = slow_rate
+        if open_seconds is not None:
+            self.open_seconds = open_seconds
+        if probes is not None:
+            self.probes = probes
+        self.on_transition = on_transition
+        self.transitions = collections.deque(maxlen=self.max_transitions)
+        self._lock = threading.Lock()
+        self._circuits = {}
+
+    def _circuit(self, endpoint_class):
+        circuit = self._circuits.get(endpoint_class)
+        if circuit is None:
+            circuit = self._circuits[endpoint_class] = _Circuit(self.window_size)
+        return circuit
+
+    def _transition(self, endpoint_class, circuit, state, changes):
+        """moves `circuit` to `state`; must hold the lock.  the change is appended to `changes`, to notify after releasing it"""
+        old_state = circuit.state
+        circuit.state = state
+        circuit.probes = 0
+        circuit.probe_successes = 0
+        if state == OPEN:
+            circuit.opened_at = time.time()
+            circuit.trips += 1
+        elif state == CLOSED:
+            circuit.opened_at = None
+            circuit.outcomes.clear()
+        self.transitions.append((time.time(), endpoint_class, old_state, state))
+        changes.append((endpoint_class, old_state, state))
+
+    def _notify(self, changes):
+        if self.on_transition is not None:
+            for change in changes:
+                self.on_transition(*change)
+
+    def before(self, endpoint_class):
+        """called before a request; raises `ApiCircuitOpenError` if the circuit doesn't let it through.
+
+        returns whether the request is a half-open probe, to pass on to `record()`
+        """
+        changes = []
+        error = None
+        is_probe = False
+        with self._lock:
+            circuit = self._circuit(endpoint_class)
+            if circuit.state == OPEN:
+                remaining = circuit.opened_at + self.open_seconds - time.time()
+                if remaining > 0:
+                    circuit.rejected += 1
+                    error = ApiCircuitOpenError(message="The circuit for '%s' endpoints is open" % endpoint_class,
+                                                retry_after=remaining,
+                                                )
+                else:
+                    self._transition(endpoint_class, circuit, HALF_OPEN, changes)
+            if (error is None) and (circuit.state == HALF_OPEN):
+                if circuit.probes >= self.probes:
+                    circuit.rejected += 1
+                    error = ApiCircuitOpenError(message="The circuit for '%s' endpoints is half open, and probing" % endpoint_class,
+                                                retry_after=0,
+                                                )
+                else:
+                    circuit.probes += 1
+                    is_probe = True
+        self._notify(changes)
+        if error is not None:
+            raise error
+        return is_probe
+
+    def is_failure(self, error=None, status=None):
+        """whether a request outcome means Graph is failing: a connection error or timeout, or a 5xx response"""
+        if isinstance(error, ApiUnhandledError) and error.raised is not None:
+            error = error.raised
+        if error is not None:
+            # `requests` exceptions and socket errors are `IOError`s
+            return isinstance(error, IOError)
+        return (status is not None) and (status >= 500)
+
+    def record(self, endpoint_class, elapsed, error=None, status=None, is_probe=False):
+        """records the outcome of a request let through by `before()`: the exception it raised, or the response status"""
+        failed = self.is_failure(error, status)
+        slow = elapsed >= self.slow_seconds
+        changes = []
+        with self._lock:
+            circuit = self._circuit(endpoint_class)
+            if is_probe:
+                if circuit.state == HALF_OPEN:
+                    if failed or slow:
+                        self._transition(endpoint_class, circuit, OPEN, changes)
+                    else:
+                        circuit.probe_successes += 1
+                        if circuit.probe_successes >= self.probes:
+                            self._transition(endpoint_class, circuit, CLOSED, changes)
+            elif circuit.state == CLOSED:
+                circuit.outcomes.append((failed, slow))
+                count = len(circuit.outcomes)
+                if count >= self.min_calls:
+                    failures = sum(1 for (f, s) in circuit.outcomes if f)
+                    slows = sum(1 for (f, s) in circuit.outcomes if s)
+                    if (failures >= self.error_rate * count) or (slows >= self.slow_rate * count):
+                        self._transition(endpoint_class, circuit, OPEN, changes)
+        self._notify(changes)
+
+    def release(self, endpoint_class, is_probe=False):
+        """for a request let through by `before()` whose outcome says nothing about Graph (e.g. the caller's `Deadline`
+        ran out): records nothing, but frees its probe slot"""
+        if not is_probe:
+            return
+        with self._lock:
+            circuit = self._circuit(endpoint_class)
+            if (circuit.state == HALF_OPEN) and (circuit.probes > 0):
+                circuit.probes -= 1
+
+    def state(self, endpoint_class):
+        with self._lock:
+            circuit = self._circuits.get(endpoint_class)
+            return circuit.state if circuit is not None else CLOSED
+
+    def reset(self, endpoint_class=None):
+        """closes one circuit, or all of them"""
+        changes = []
+        with self._lock:
+            for (name, circuit) in self._circuits.items():
+                if (endpoint_class in (None, name)) and (circuit.state != CLOSED):
+                    self._transition(name, circuit, CLOSED, changes)
+        self._notify(changes)
+
+    def stats(self):
+        """a dict of endpoint class to its `state`, the `calls` and `failures` / `slow` calls in its window, `trips` and `rejected` calls"""
+        with self._lock:
+            return dict((name, {'state': circuit.state,
+                                'calls': len(circuit.outcomes),
+                                'failures': sum(1 for (f, s) in circuit.outcomes if f),
+                                'slow': sum(1 for (f, s) in circuit.outcomes if s),
+                                'trips': circuit.trips,
+                                'rejected': circuit.rejected,
+                                'opened_at': circuit.opened_at,
+                                })
+                        for (name, circuit) in self._circuits.items())
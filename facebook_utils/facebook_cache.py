@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import copy
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from facebook_api_urls import url_hash_access_token, url_endpoint_class
+
+
+class CacheBackend(object):
+    """The storage interface used by `ResponseCache`.
+
+    Entries are plain dicts (json serializable), so a backend shared between processes only has to store strings.
+    `ttl` is the number of seconds the backend should keep an entry around; `ResponseCache` decides on freshness itself.
+    """
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def set(self, key, entry, ttl):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def stats(self):
+        return {}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """An in-process, thread-safe LRU, bounded by number of entries and by (approximate) bytes of response body."""
+    max_entries = 10000
+    max_bytes = 32 * 1024 * 1024
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry['stale_at'] <= time.time():
+                self._bytes -= entry['size']
+                return None
+            self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry, ttl):
+        entry = dict(entry, stale_at=time.time() + ttl)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous['size']
+            self._entries[key] = entry
+            self._bytes += entry['size']
+            while self._entries and ((len(self._entries) > self.max_entries) or (self._bytes > self.max_bytes)):
+                (_key, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted['size']
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry['size']
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'evictions': self.evictions,
+                    }
+
+
+class ClientCacheBackend(CacheBackend):
+    """Stores entries as json in a shared cache such as memcached or redis.
+
+    `client` needs `get(key)`, `delete(key)` and a `set(key, value, **{ttl_kwarg: seconds})`;
+    use `ttl_kwarg='time'` for python-memcached and `ttl_kwarg='ex'` for redis-py.
+    """
+    prefix = 'facebook_utils:'
+    ttl_kwarg = 'time'
+
+    def __init__(self, client, prefix=None, ttl_kwarg=None):
+        self.client = client
+        if prefix is not None:
+            self.prefix = prefix
+        if ttl_kwarg is not None:
+            self.ttl_kwarg = ttl_kwarg
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, entry, ttl):
+        self.client.set(self.prefix + key, json.dumps(entry), **{self.ttl_kwarg: int(ttl) + 1})
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class ResponseCache(object):
+    """Caches decoded Graph GET responses for `FacebookHub.api_proxy`.
+
+    Keys are the request url with the access token replaced by a digest, so raw tokens are never stored.
+    `ttls` maps an endpoint class (see `url_endpoint_class`: 'profile', 'edge', 'objects', ...) to the seconds a response stays fresh; endpoints without a ttl are not cached.
+    Once an entry goes stale it is kept for another `stale_ttl` seconds, and if Facebook sent an ETag the next request revalidates it with `If-None-Match`, so a 304 reuses the stored body.
+    """
+    ttls = {'profile': 300,
+            'objects': 300,
+            'edge': 60,
+            }
+    stale_ttl = 3600
+
+    def __init__(self, backend=None, ttls=None, stale_ttl=None):
+        if backend is None:
+            backend = MemoryCacheBackend()
+        self.backend = backend
+        if ttls is not None:
+            self.ttls = ttls
+        if stale_ttl is not None:
+            self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0,
+                          'misses': 0,
+                          'stale': 0,
+                          'revalidated': 0,
+                          'stores': 0,
+                          }
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def key(self, url):
+        return url_hash_access_token(url)
+
+    def ttl_for(self, url):
+        """seconds a response for `url` stays fresh; None if it should not be cached"""
+        return self.ttls.get(url_endpoint_class(url))
+
+    def lookup(self, url):
+        """returns `(entry, is_fresh)`; `entry` is None on a miss or for uncacheable urls"""
+        if self.ttl_for(url) is None:
+            return (None, False)
+        entry = self.backend.get(self.key(url))
+        if entry is None:
+            self._count('misses')
+            return (None, False)
+        if entry['expires_at'] > time.time():
+            self._count('hits')
+            return (entry, True)
+        self._count('stale')
+        return (entry, False)
+
+    def content(self, entry):
+        """a private copy of the cached payload, so callers can't alter the cache"""
+        return copy.deepcopy(entry['content'])
+
+    def store(self, url, content, etag=None, size=0):
+        ttl = self.ttl_for(url)
+        if ttl is None:
+            return
+        entry = {'content': copy.deepcopy(content),
+                 'etag': etag,
+                 'size': size,
+                 'expires_at': time.time() + ttl,
+                 }
+        self.backend.set(self.key(url), entry, ttl + self.stale_ttl)
+        self._count('stores')
+
+    def revalidated(self, url, entry):
+        """marks a stale entry as fresh again, after Facebook answered its `If-None-Match` with a 304"""
+        ttl = self.ttl_for(url)
+        entry = dict(entry, expires_at=time.time() + ttl)
+        self.backend.set(self.key(url), entry, ttl + self.stale_ttl)
+        self._count('revalidated')
+
+    def invalidate(self, url):
+        self.backend.delete(self.key(url))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update(self.backend.stats())
+        return stats
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import sys
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from facebook_api_urls import FB_BATCH_MAX_OPERATIONS
+from facebook_batch import batch_item_result
+from facebook_concurrency import Future, result_within_deadline
+from facebook_exceptions import *
+
+
+def _item_etag(item):
+    """the ETag header of a batch response item, if any"""
+    for header in item.get('headers') or ():
+        if isinstance(header, dict) and ((header.get('name') or '').lower() == 'etag'):
+            return header.get('value')
+    return None
+
+
+class _Group(object):
+    """the calls waiting to go out in one batch"""
+
+    def __init__(self):
+        self.calls = []
+        self.full = threading.Event()
+
+
+class BatchCoalescer(object):
+    """Coalesces single Graph GET requests made around the same time (from any number of threads) into batch requests.
+
+        hub = FacebookHub(..., coalescer=BatchCoalescer(window=0.005))
+
+    A json GET request for the hub's Graph url (e.g. `graph__get_profile_for_access_token`) waits up to
+    `window` seconds for others to join it, or until `max_batch` are waiting; they are then sent as one
+    batch POST, and each caller gets its own decoded body, or raises the `ApiError` subclass its item maps
+    to.  Each operation keeps the access token of its url; the batch itself is sent with the app token.
+    The first caller of a batch sends it, on its own thread; a call nobody joined is sent as usual.
+
+    Fresh responses are still served from the hub's `cache`, and successful ones stored in it.  The
+    instrumentation records the batch request, not the calls it carried.
+    """
+    window = 0.005
+    max_batch = FB_BATCH_MAX_OPERATIONS
+
+    def __init__(self, window=None, max_batch=None):
+        if window is not None:
+            self.window = window
+        if max_batch is not None:
+            self.max_batch = max_batch
+        if not 0 < self.max_batch <= FB_BATCH_MAX_OPERATIONS:
+            raise ValueError('max_batch must be between 1 and %s' % FB_BATCH_MAX_OPERATIONS)
+        self._lock = threading.Lock()
+        # (hub, ssl_verify) -> the `_Group` accepting calls
+        self._groups = {}
+        self._counters = {'calls': 0,
+                          'batches': 0,
+                          'coalesced': 0,
+                          'singles': 0,
+                          }
+
+    def accepts(self, hub, url, post_data=None, expected_format='json.load'):
+        """whether `hub.api_proxy(url, ...)` can be coalesced: json GET requests for the hub's Graph url"""
+        return (not post_data) and (expected_format in ('json.load', 'json.loads')) and url.startswith(hub.fb_graph_api)
+
+    def call(self, hub, url, ssl_verify=None):
+        """requests `url`, as part of a batch if other calls join it; returns the decoded body or raises an `ApiError`"""
+        if hub.cache is not None:
+            (cache_entry, is_fresh) = hub.cache.lookup(url)
+            if is_fresh:
+                return hub.cache.content(cache_entry)
+        if hub.token_index is not None:
+            error = hub.token_index.error_for(hub._access_token_for(url))
+            if error is not None:
+                if hub.mask_unhandled_exceptions:
+                    raise ApiUnhandledError(raised=error)
+                raise error
+        future = Future()
+        key = (hub, ssl_verify)
+        with self._lock:
+            self._counters['calls'] += 1
+            group = self._groups.get(key)
+            is_leader = group is None
+            if is_leader:
+                group = self._groups[key] = _Group()
+            group.calls.append((url, future))
+            if len(group.calls) >= self.max_batch:
+                del self._groups[key]
+                group.full.set()
+        if is_leader:
+            group.full.wait(self.window)
+            with self._lock:
+                if self._groups.get(key) is group:
+                    del self._groups[key]
+            self._send(hub, ssl_verify, group.calls)
+        return result_within_deadline(future)
+
+    def _send(self, hub, ssl_verify, calls):
+        if len(calls) == 1:
+            (url, future) = calls[0]
+            with self._lock:
+                self._counters['singles'] += 1
+            try:
+                future.set_result(hub._instrumented(hub._api_proxy, url, None, False, 'json.load', ssl_verify))
+            except:
+                future.set_exception(sys.exc_info())
+            return
+        with self._lock:
+            self._counters['batches'] += 1
+            self._counters['coalesced'] += len(calls)
+        prefix = len(hub.fb_graph_api)
+        operations = [{'method': 'GET', 'relative_url': url[prefix:]} for (url, future) in calls]
+        post_data = {'access_token': u'%s|%s' % (hub.app_id, hub.app_secret),
+                     'batch': operations,
+                     }
+        try:
+            items = hub._instrumented(hub._api_proxy, hub.fb_graph_api, post_data, False, 'json.load', ssl_verify)
+            results = [batch_item_result(item, hub.error_classifier) for item in items]
+        except:
+            exc_info = sys.exc_info()
+            for (url, future) in calls:
+                future.set_exception(exc_info)
+            return
+        for ((url, future), item, result) in zip(calls, items, results):
+            if isinstance(result, ApiError):
+                hub._observe_token_error(url, None, result)
+                if hub.mask_unhandled_exceptions:
+                    result = ApiUnhandledError(raised=result)
+                future.set_exception((result.__class__, result, None))
+                continue
+            if hub.cache is not None:
+                # the item's body was decoded with the batch; its size is that of the re-encoded body
+                hub.cache.store(url,
+                                result,
+                                etag=_item_etag(item),
+                                size=len(json.dumps(result)),
+                                )
+            future.set_result(result)
+        for (url, future) in calls[len(results):]:
+            # a short batch response; don't leave the callers waiting
+            error = ApiResponseError(message='Batched Graph response has %s items for %s requests' % (len(results), len(calls)),
+                                     response=items,
+                                     )
+            if hub.mask_unhandled_exceptions:
+                error = ApiUnhandledError(raised=error)
+            future.set_exception((error.__class__, error, None))
+
+    def stats(self):
+        """`calls` seen, `batches` sent and the `coalesced` calls they carried, and `singles` sent alone"""
+        with self._lock:
+            return dict(self._counters)
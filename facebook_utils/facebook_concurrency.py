@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import Queue
+import copy
+import sys
+
+from facebook_deadline import current_deadline
+from facebook_exceptions import ApiTimeoutError
+
+
+class FutureTimeoutError(Exception):
+    """Raised by `Future.result()` when the result is not ready in time"""
+    pass
+
+
+class Future(object):
+    """The eventual result of a call submitted to a `BoundedExecutor`.
+
+    `result()` blocks until the call finishes, then returns its value or re-raises its exception (with the original traceback).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """`exc_info` is a `sys.exc_info()` tuple"""
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+    def add_done_callback(self, fn):
+        """calls `fn(future)` once the future is done; immediately if it already is."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise FutureTimeoutError()
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise FutureTimeoutError()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+_SHUTDOWN = object()
+
+
+class BoundedExecutor(object):
+    """A small thread pool that runs at most `max_workers` calls at once.
+
+    If `max_pending` is set, `submit()` blocks once that many calls are queued,
+    which applies backpressure to producers instead of buffering without bound.
+    Worker threads are daemons and are started lazily.
+    """
+    max_workers = 10
+    max_pending = 0
+
+    def __init__(self, max_workers=None, max_pending=None):
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if max_pending is not None:
+            self.max_pending = max_pending
+        if self.max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        self._queue = Queue.Queue(maxsize=self.max_pending or 0)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._shutdown = False
+
+    def _ensure_workers(self):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot submit after shutdown')
+            if len(self._threads) >= self.max_workers:
+                return
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _SHUTDOWN:
+                return
+            (future, fn, args, kwargs, deadline) = item
+            try:
+                if deadline is None:
+                    result = fn(*args, **kwargs)
+                else:
+                    with deadline:
+                        result = fn(*args, **kwargs)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    def submit(self, fn, *args, **kwargs):
+        """schedules `fn(*args, **kwargs)` and returns a `Future`; the call runs under the caller's `Deadline`, if any"""
+        self._ensure_workers()
+        future = Future()
+        self._queue.put((future, fn, args, kwargs, current_deadline()))
+        return future
+
+    def map(self, fn, items):
+        """runs `fn` over `items` concurrently; returns the results in order, raising the first error"""
+        return gather([self.submit(fn, item) for item in items])
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            threads = list(self._threads)
+        for thread in threads:
+            self._queue.put(_SHUTDOWN)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+def gather(futures, timeout=None):
+    """waits for every future; returns their results in order, raising the first error encountered"""
+    return [future.result(timeout=timeout) for future in futures]
+
+
+def map_bounded(fn, items, concurrency):
+    """runs `fn` over `items` on at most `concurrency` threads; returns the results in order, raising the first error.
+
+    with a single item (or `concurrency` of 1) this simply runs inline.
+    """
+    items = list(items)
+    if len(items) <= 1 or concurrency <= 1:
+        return [fn(item) for item in items]
+    executor = BoundedExecutor(max_workers=min(concurrency, len(items)))
+    try:
+        return executor.map(fn, items)
+    finally:
+        executor.shutdown(wait=False)
+
+
+def imap_unordered(fn, items, concurrency, max_in_flight=None):
+    """runs `fn` over `items` on at most `concurrency` threads, yielding `(item, future)` pairs as the calls complete.
+
+    `items` is consumed lazily: at most `max_in_flight` calls (default: twice `concurrency`) are submitted
+    but not yet yielded, so any number of items can stream through in constant memory.  If the generator
+    is closed early, the calls already submitted still run.
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * concurrency
+    completed = Queue.Queue()
+    executor = BoundedExecutor(max_workers=concurrency)
+    items = iter(items)
+    exhausted = False
+    in_flight = 0
+    try:
+        while True:
+            while (not exhausted) and (in_flight < max_in_flight):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = executor.submit(fn, item)
+                future.add_done_callback(lambda future, item=item: completed.put((item, future)))
+                in_flight += 1
+            if not in_flight:
+                return
+            while True:
+                # a timeout keeps the wait interruptible (KeyboardInterrupt)
+                try:
+                    result = completed.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    continue
+            in_flight -= 1
+            yield result
+    finally:
+        executor.shutdown(wait=False)
+
+
+def result_within_deadline(future):
+    """`future.result()`, but waits no longer than the current `Deadline` allows; then raises `ApiTimeoutError`"""
+    deadline = current_deadline()
+    if deadline is None:
+        return future.result()
+    try:
+        return future.result(timeout=deadline.remaining())
+    except FutureTimeoutError, e:
+        raise ApiTimeoutError(message='The deadline for this call passed', raised=e)
+
+
+class SingleFlight(object):
+    """Collapses identical calls which are in flight at the same time into one.
+
+    `do(key, fn, ...)` runs `fn` unless a call with the same `key` is already running, in which case it waits
+    for that call and shares its outcome: each waiter gets a deep copy of the result, or re-raises the same
+    exception.  `future(key, submit)` is the non-blocking version, for `AsyncFacebookHub`: it returns the
+    `Future` of the call in flight, or the one `submit()` returns.
+
+    Only use it for idempotent calls; `FacebookHub` (`single_flight=`) uses it for GET requests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> the `Future` of the call in flight
+        self._calls = {}
+        self._counters = {'calls': 0,
+                          'collapsed': 0,
+                          }
+
+    def _join(self, key):
+        """returns `(future, is_leader)`; the leader must run the call and complete the future"""
+        with self._lock:
+            self._counters['calls'] += 1
+            future = self._calls.get(key)
+            if future is not None:
+                self._counters['collapsed'] += 1
+                return (future, False)
+            future = self._calls[key] = Future()
+            return (future, True)
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def do(self, key, fn, *args, **kwargs):
+        (future, is_leader) = self._join(key)
+        if not is_leader:
+            return copy.deepcopy(result_within_deadline(future))
+        try:
+            result = fn(*args, **kwargs)
+        except:
+            self._done(key, future)
+            future.set_exception(sys.exc_info())
+            raise
+        self._done(key, future)
+        future.set_result(result)
+        return result
+
+    def future(self, key, submit):
+        """the `Future` of the call with `key` in flight, or else the `Future` returned by `submit()`"""
+        (future, is_leader) = self._join(key)
+        if not is_leader:
+            return future
+        # `submit()` may block (see `BoundedExecutor.max_pending`), so it runs outside the lock
+        try:
+            submitted = submit()
+        except:
+            self._done(key, future)
+            future.set_exception(sys.exc_info())
+            raise
+
+        def _finish(submitted):
+            self._done(key, future)
+            if submitted._exc_info is not None:
+                future.set_exception(submitted._exc_info)
+            else:
+                future.set_result(submitted._result)
+        submitted.add_done_callback(_finish)
+        return future
+
+    def stats(self):
+        """`calls` seen, how many were `collapsed` into a call in flight, and the number `in_flight` now"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = len(self._calls)
+            return stats
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import functools
+import types
+import time
+
+from facebook_exceptions import ApiTimeoutError
+
+
+# the stack of deadlines entered on this thread; the last one is in effect
+_context = threading.local()
+
+
+class Deadline(object):
+    """A time budget for one or more Graph calls.
+
+    Pass one (or a number of seconds) as `deadline=` to a `FacebookHub` method, or enter it around any code:
+
+        with Deadline(2.0):
+            (access_token, profile) = hub.oauth_code__get_access_token_and_profile(code)
+
+    Every request made inside is sent with its timeouts capped to the time left, retries don't back off past
+    it, and once it is spent calls raise `ApiTimeoutError` instead of going to Facebook.  Composite calls
+    (an access token, then a profile) share the one budget.  Deadlines nest: an inner one can only shorten
+    the budget.  Calls run on a `BoundedExecutor` (batches, `AsyncFacebookHub`, ...) inherit the deadline
+    of the thread which submitted them.
+    """
+
+    def __init__(self, seconds=None, expires_at=None):
+        if expires_at is None:
+            if seconds is None:
+                raise ValueError('must submit seconds or expires_at')
+            expires_at = time.time() + seconds
+        self.expires_at = expires_at
+
+    def remaining(self):
+        """seconds left, never less than 0"""
+        return max(self.expires_at - time.time(), 0.0)
+
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def check(self):
+        """raises `ApiTimeoutError` if the deadline has passed"""
+        if self.expired():
+            raise ApiTimeoutError(message='The deadline for this call passed')
+
+    def timeout(self, timeout):
+        """caps a `requests` timeout (seconds, or a `(connect, read)` tuple) to the time left"""
+        remaining = self.remaining()
+        if timeout is None:
+            return remaining
+        if isinstance(timeout, tuple):
+            return tuple(min(i, remaining) if i is not None else remaining for i in timeout)
+        return min(timeout, remaining)
+
+    def __enter__(self):
+        stack = getattr(_context, 'stack', None)
+        if stack is None:
+            stack = _context.stack = []
+        if stack and (stack[-1].expires_at < self.expires_at):
+            # an outer deadline which is sooner stays in effect
+            stack.append(stack[-1])
+        else:
+            stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _context.stack.pop()
+
+    def __repr__(self):
+        return '<Deadline remaining=%.3fs>' % self.remaining()
+
+
+def current_deadline():
+    """the `Deadline` in effect on this thread, or None"""
+    stack = getattr(_context, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+def _iter_within(deadline, iterator):
+    while True:
+        with deadline:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def with_deadline(fn):
+    """lets a method take a `deadline=` argument (a `Deadline` or seconds), which is in effect while it runs.
+
+    if the method returns a generator, the deadline is in effect while it is iterated.
+    """
+
+    @functools.wraps(fn)
+    def _with_deadline(*args, **kwargs):
+        deadline = kwargs.pop('deadline', None)
+        if deadline is None:
+            return fn(*args, **kwargs)
+        if not isinstance(deadline, Deadline):
+            deadline = Deadline(deadline)
+        with deadline:
+            result = fn(*args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            return _iter_within(deadline, result)
+        return result
+    return _with_deadline
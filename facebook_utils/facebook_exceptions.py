@@ -1,5 +1,10 @@
 import datetime
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 
 class ApiError(Exception):
 
@@ -8,10 +13,13 @@ class ApiError(Exception):
     """
 
     code = None
+    subcode = None
     type = None
     message = None
     response = None
     raised = None
+    http_status = None
+    retry_after = None
 
     def __init__(self,
                  code=None,
@@ -19,12 +27,18 @@ class ApiError(Exception):
                  message=None,
                  response=None,
                  raised=None,
+                 http_status=None,
+                 retry_after=None,
+                 subcode=None,
                  ):
         self.code = code
         self.type = type
         self.message = message
         self.response = response
         self.raised = raised
+        self.http_status = http_status
+        self.retry_after = retry_after
+        self.subcode = subcode
 
     def __str__(self):
         return u'ApiError: {code} | {type} | {message}'.format(code=self.code,
@@ -54,6 +68,27 @@ class ApiApplicationError(ApiError):
     pass
 
 
+class ApiRateLimitError(ApiError):
+    """ Facebook is throttling the application, user or page; retry later
+
+    """
+    pass
+
+
+class ApiCircuitOpenError(ApiError):
+    """ The `CircuitBreaker` for this kind of endpoint is open; the call failed without going to Facebook.  `retry_after` is when it will let a probe through
+
+    """
+    pass
+
+
+class ApiTimeoutError(ApiError):
+    """ The call's `Deadline` passed before Facebook answered; `raised` is the transport timeout, if that is how it ended
+
+    """
+    pass
+
+
 class ApiResponseError(ApiError):
     """
     Api Response Error
@@ -134,11 +169,150 @@ def reformat_error(json_string, raised=None):
     for k in rval.keys():
         if k in json_string:
             rval[k] = json_string[k]
+    if 'error_subcode' in json_string:
+        rval['subcode'] = json_string['error_subcode']
     if raised is not None:
         rval['raised'] = raised
     return rval
 
 
+class ErrorClassifier(object):
+    """Maps Graph error payloads onto `ApiError` subclasses with table lookups instead of an if-chain.
+
+    Rules are registered with `register()` and are checked most specific first:
+
+        1. code + subcode
+        2. code + type
+        3. code + message prefix
+        4. code
+        5. message prefix
+        6. type
+        7. `ApiError`
+
+    Every step is a dict lookup; message prefixes are indexed by prefix length, and only the
+    (few) distinct lengths are probed, longest first, so the cost doesn't depend on the traffic.
+    Rules can be added at runtime; `copy()` a classifier to customize it for one hub.
+    """
+
+    def __init__(self):
+        self._rules = {}
+        # scope (code or None) -> ([lengths, longest first], {(length, prefix): class})
+        self._prefixes = {}
+
+    def register(self, exc_class, code=None, subcode=None, type=None, message_prefix=None):
+        """maps errors matching every given criteria to `exc_class`"""
+        if message_prefix is not None:
+            if (subcode is not None) or (type is not None):
+                raise ValueError('message_prefix can only be combined with a code')
+            (lengths, prefixes) = self._prefixes.setdefault(code, ([], {}))
+            length = len(message_prefix)
+            prefixes[(length, message_prefix)] = exc_class
+            if length not in lengths:
+                lengths.append(length)
+                lengths.sort(reverse=True)
+            return
+        if (subcode is not None) and (code is None):
+            raise ValueError('subcode must be combined with a code')
+        if (subcode is not None) and (type is not None):
+            raise ValueError('subcode can not be combined with a type')
+        if (code is None) and (type is None):
+            raise ValueError('must submit a code, type or message_prefix')
+        self._rules[(code, subcode, type)] = exc_class
+
+    def copy(self):
+        rval = ErrorClassifier()
+        rval._rules = dict(self._rules)
+        rval._prefixes = dict((k, (list(lengths), dict(prefixes))) for (k, (lengths, prefixes)) in self._prefixes.items())
+        return rval
+
+    def _match_prefix(self, scope, message):
+        if scope not in self._prefixes:
+            return None
+        (lengths, prefixes) = self._prefixes[scope]
+        for length in lengths:
+            exc_class = prefixes.get((length, message[:length]))
+            if exc_class is not None:
+                return exc_class
+        return None
+
+    def classify(self, error):
+        """returns the `ApiError` subclass for a (`reformat_error`ed) error dict"""
+        rules = self._rules
+        code = error.get('code')
+        message = error.get('message')
+        type = error.get('type')
+        if code:
+            subcode = error.get('subcode')
+            if subcode and (code, subcode, None) in rules:
+                return rules[(code, subcode, None)]
+            if type and (code, None, type) in rules:
+                return rules[(code, None, type)]
+            if message:
+                exc_class = self._match_prefix(code, message)
+                if exc_class is not None:
+                    return exc_class
+            if (code, None, None) in rules:
+                return rules[(code, None, None)]
+        if message:
+            exc_class = self._match_prefix(None, message)
+            if exc_class is not None:
+                return exc_class
+        if type and (None, None, type) in rules:
+            return rules[(None, None, type)]
+        return ApiError
+
+    def exception(self, error, http_status=None):
+        """builds the exception for the `error` object of a Graph response"""
+        if not isinstance(error, dict):
+            return ApiError(message=error, http_status=http_status)
+        error = reformat_error(error)
+        return self.classify(error)(http_status=http_status, **error)
+
+    def exception_for_response(self, status_code, content):
+        """builds the exception for a non-200 response with a (raw, json-encoded) body of `content`"""
+        try:
+            rval = json.loads(content)
+        except ValueError, e:
+            if status_code == 400:
+                return ApiError(message='Could not parse JSON from the error (%s)' % content, code=400, raised=e, http_status=status_code)
+            return ApiError(message='Could not communicate with the API', code=status_code, http_status=status_code)
+        if isinstance(rval, dict) and ('error' in rval):
+            return self.exception(rval['error'], http_status=status_code)
+        if status_code == 400:
+            return ApiError(message='I don\'t know how to handle this error (%s)' % rval, code=400, http_status=status_code)
+        return ApiError(message='Could not communicate with the API', code=status_code, http_status=status_code)
+
+
+def _default_error_classifier():
+    classifier = ErrorClassifier()
+    for (exc_class, criteria) in (
+        (ApiApplicationError, {'code': 1, 'message_prefix': 'Error validating client secret'}),
+        (ApiError, {'code': 1}),  # An unknown error occurred; transient
+        (ApiError, {'code': 2}),  # Service temporarily unavailable
+        (ApiApplicationError, {'code': 101}),  # Error validating application. Invalid application ID
+        (ApiRuntimeGraphMethodError, {'code': 100, 'type': 'GraphMethodException'}),
+        (ApiRuntimeVerirficationFormatError, {'code': 100, 'message_prefix': 'Invalid verification code format'}),
+        (ApiRuntimeGrantError, {'code': 100, 'message_prefix': 'Invalid grant_type:'}),
+        (ApiRuntimeScopeError, {'code': 100, 'message_prefix': 'Unsupported scope:'}),
+        (ApiAuthError, {'code': 104}),
+        (ApiAuthExpiredError, {'code': 190, 'subcode': 463}),
+        (ApiRateLimitError, {'code': 4}),  # Application request limit reached
+        (ApiRateLimitError, {'code': 17}),  # User request limit reached
+        (ApiRateLimitError, {'code': 32}),  # Page request limit reached
+        (ApiRateLimitError, {'code': 341}),  # Application limit reached
+        (ApiRateLimitError, {'code': 613}),  # Calls to this api have exceeded the rate limit
+        (ApiAuthExpiredError, {'message_prefix': 'Error validating access token: Session has expired'}),
+        (ApiAuthError, {'message_prefix': 'Invalid OAuth access token'}),
+        (ApiAuthError, {'message_prefix': 'Error validating access token'}),
+        (ApiAuthError, {'type': 'OAuthException'}),
+    ):
+        classifier.register(exc_class, **criteria)
+    return classifier
+
+
+default_error_classifier = _default_error_classifier()
+
+
 def facebook_time(fb_time):
     """parses facebook's timestamp into a datetime object"""
     return datetime.datetime.strptime(fb_time, '%Y-%m-%dT%H:%M:%S+0000')
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import bisect
+import time
+
+from facebook_api_urls import url_endpoint_template, url_endpoint_class
+from facebook_exceptions import ApiUnhandledError
+
+
+# the phases of a call, in order; `total` covers every attempt (and the backoff between them)
+PHASES = ('dns', 'connect', 'tls', 'first_byte', 'total')
+
+
+class GraphCall(object):
+    """What `FacebookHub` records about one Graph call (one `api_proxy` call, including its retries).
+
+    endpoint: the endpoint template, without host, version, ids or tokens (`/{id}/friends`)
+    endpoint_class: the coarse endpoint class ('profile', 'edge', 'batch', ...)
+    method: the HTTP method
+    status: the HTTP status of the last response, if any
+    error: the class name of the `ApiError` (or other exception) the call raised, if any
+    bytes_out / bytes_in: request and response body sizes, over every attempt
+    attempts: the number of HTTP requests sent; a fresh cache hit sends none
+    cache: the `ResponseCache` outcome: 'hit', 'revalidated' or 'miss'; None if the cache wasn't consulted
+    timings: seconds per phase (see `PHASES`); connection phases are only there if the last attempt opened a connection
+    """
+
+    def __init__(self, method, url):
+        self.method = method
+        self.endpoint = url_endpoint_template(url)
+        self.endpoint_class = url_endpoint_class(url, method)
+        self.status = None
+        self.error = None
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.attempts = 0
+        self.cache = None
+        self.timings = {}
+        self.started = time.time()
+
+    @property
+    def retries(self):
+        return max(self.attempts - 1, 0)
+
+    def observe(self, trace, status=None):
+        """records one attempt, from a `FacebookTransport.request` trace"""
+        self.attempts += 1
+        if status is not None:
+            self.status = status
+        self.bytes_out += trace.get('bytes_out', 0)
+        self.bytes_in += trace.get('bytes_in', 0)
+        for phase in PHASES[:-1]:
+            if phase in trace:
+                self.timings[phase] = trace[phase]
+            else:
+                self.timings.pop(phase, None)
+
+    def __repr__(self):
+        return '<GraphCall %s %s status=%s error=%s attempts=%s cache=%s total=%.3fs>' % (
+            self.method, self.endpoint, self.status, self.error, self.attempts, self.cache, self.timings.get('total', 0))
+
+
+class Instrumentation(object):
+    """Records every Graph call a `FacebookHub` makes, and hands it to the sinks.
+
+    A sink is an object with a `record(call)` method (see `HistogramSink`, `PrometheusSink`), or
+    any callable taking the `GraphCall`; sinks run on the calling thread, so they should be quick.
+    An exception raised by a sink is counted (`stats()['sink_errors']`) and otherwise ignored,
+    so a broken sink never breaks a call.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+        self._lock = threading.Lock()
+        self._counters = {'calls': 0,
+                          'sink_errors': 0,
+                          }
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def begin(self, method, url):
+        return GraphCall(method, url)
+
+    def finish(self, call, error=None):
+        """completes `call`, optionally with the exception it raised, and hands it to the sinks"""
+        call.timings['total'] = time.time() - call.started
+        if error is not None:
+            if isinstance(error, ApiUnhandledError) and error.raised is not None:
+                error = error.raised
+            call.error = error.__class__.__name__
+            if call.status is None:
+                call.status = getattr(error, 'http_status', None)
+        failed = 0
+        for sink in self.sinks:
+            try:
+                getattr(sink, 'record', sink)(call)
+            except Exception:
+                failed += 1
+        with self._lock:
+            self._counters['calls'] += 1
+            self._counters['sink_errors'] += failed
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+class _Histogram(object):
+    """bucketed observations: `counts[i]` is the number of observations <= `buckets[i]`, plus one overflow bucket"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, pct):
+        """estimates the `pct` percentile, interpolating within the bucket it falls in"""
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    # beyond the last bucket; the best we know is its bound
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class _EndpointStats(object):
+
+    def __init__(self, buckets):
+        self.calls = 0
+        self.retries = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self.cache = collections.Counter()
+        self.timings = dict((phase, _Histogram(buckets)) for phase in PHASES)
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'retries': self.retries,
+                'bytes_out': self.bytes_out,
+                'bytes_in': self.bytes_in,
+                'statuses': dict(self.statuses),
+                'errors': dict(self.errors),
+                'cache': dict(self.cache),
+                'timings': dict((phase, {'count': h.count,
+                                         'sum': h.sum,
+                                         'p50': h.percentile(50),
+                                         'p90': h.percentile(90),
+                                         'p99': h.percentile(99),
+                                         })
+                                for (phase, h) in self.timings.items() if h.count),
+                }
+
+
+class HistogramSink(object):
+    """An in-memory sink which aggregates calls per `(endpoint, method)`: counters by status, error class and
+    cache outcome, retries, bytes, and a latency histogram per phase (with estimated percentiles).
+
+    `buckets` are the upper bounds, in seconds, of the histogram buckets.
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, call):
+        key = (call.endpoint, call.method)
+        with self._lock:
+            stats = self._endpoints.get(key)
+            if stats is None:
+                stats = self._endpoints[key] = _EndpointStats(self.buckets)
+            stats.calls += 1
+            stats.retries += call.retries
+            stats.bytes_out += call.bytes_out
+            stats.bytes_in += call.bytes_in
+            stats.statuses[call.status] += 1
+            if call.error is not None:
+                stats.errors[call.error] += 1
+            if call.cache is not None:
+                stats.cache[call.cache] += 1
+            for (phase, seconds) in call.timings.items():
+                stats.timings[phase].observe(seconds)
+
+    def percentile(self, endpoint, method='GET', pct=90, phase='total'):
+        """the estimated `pct` percentile of `phase` for an endpoint template, in seconds; None if there are no calls"""
+        with self._lock:
+            stats = self._endpoints.get((endpoint, method))
+            if stats is None:
+                return None
+            return stats.timings[phase].percentile(pct)
+
+    def slowest(self, count=10, pct=90, phase='total'):
+        """the `count` slowest endpoints by their `pct` percentile, as a list of `(seconds, endpoint, method)`"""
+        with self._lock:
+            ranked = [(stats.timings[phase].percentile(pct), endpoint, method)
+                      for ((endpoint, method), stats) in self._endpoints.items()
+                      if stats.timings[phase].count]
+        ranked.sort(reverse=True)
+        return ranked[:count]
+
+    def snapshot(self):
+        """a dict of `(endpoint, method)` to that endpoint's counters and timing percentiles"""
+        with self._lock:
+            return dict((key, stats.as_dict()) for (key, stats) in self._endpoints.items())
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+
+def _label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (k, _label(v)) for (k, v) in sorted(labels.items()))
+
+
+class PrometheusSink(HistogramSink):
+    """A `HistogramSink` which renders its data in the Prometheus text exposition format, for a `/metrics` view:
+
+        sink = PrometheusSink()
+        hub = FacebookHub(..., instrumentation=Instrumentation(sink))
+        ...
+        return Response(sink.exposition(), content_type=PrometheusSink.content_type)
+    """
+    namespace = 'facebook_graph'
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, buckets=None, namespace=None):
+        HistogramSink.__init__(self, buckets=buckets)
+        if namespace is not None:
+            self.namespace = namespace
+
+    def exposition(self):
+        ns = self.namespace
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            lines = []
+
+            def metric(name, kind, help):
+                lines.append('# HELP %s_%s %s' % (ns, name, help))
+                lines.append('# TYPE %s_%s %s' % (ns, name, kind))
+
+            metric('calls_total', 'counter', 'Graph API calls, by endpoint template, method and HTTP status.')
+            for ((endpoint, method), stats) in endpoints:
+                for (status, count) in sorted(stats.statuses.items()):
+                    lines.append('%s_calls_total%s %s' % (ns, _labels(endpoint=endpoint, method=method, status=status or ''), count))
+            metric('errors_total', 'counter', 'Graph API calls which raised, by error class.')
+            for ((endpoint, method), stats) in endpoints:
+                for (error, count) in sorted(stats.errors.items()):
+                    lines.append('%s_errors_total%s %s' % (ns, _labels(endpoint=endpoint, method=method, error=error), count))
+            metric('retries_total', 'counter', 'Retried Graph API requests.')
+            for ((endpoint, method), stats) in endpoints:
+                lines.append('%s_retries_total%s %s' % (ns, _labels(endpoint=endpoint, method=method), stats.retries))
+            metric('cache_total', 'counter', 'Response cache outcomes.')
+            for ((endpoint, method), stats) in endpoints:
+                for (outcome, count) in sorted(stats.cache.items()):
+                    lines.append('%s_cache_total%s %s' % (ns, _labels(endpoint=endpoint, method=method, outcome=outcome), count))
+            for direction in ('out', 'in'):
+                metric('bytes_%s_total' % direction, 'counter', 'Body bytes %s.' % ('sent' if direction == 'out' else 'received'))
+                for ((endpoint, method), stats) in endpoints:
+                    lines.append('%s_bytes_%s_total%s %s' % (ns, direction, _labels(endpoint=endpoint, method=method), getattr(stats, 'bytes_' + direction)))
+            metric('duration_seconds', 'histogram', 'Graph API call timings, by phase.')
+            for ((endpoint, method), stats) in endpoints:
+                for phase in PHASES:
+                    histogram = stats.timings[phase]
+                    if not histogram.count:
+                        continue
+                    cumulative = 0
+                    for (bound, count) in zip(self.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append('%s_duration_seconds_bucket%s %s' % (ns, _labels(endpoint=endpoint, method=method, phase=phase, le=bound), cumulative))
+                    lines.append('%s_duration_seconds_sum%s %r' % (ns, _labels(endpoint=endpoint, method=method, phase=phase), histogram.sum))
+                    lines.append('%s_duration_seconds_count%s %s' % (ns, _labels(endpoint=endpoint, method=method, phase=phase), histogram.count))
+        return '\n'.join(lines) + '\n'
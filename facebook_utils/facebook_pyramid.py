@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from facebook_utils import FacebookHub
+from facebook_api_urls import FB_GRAPH_API_URL
+from facebook_transport import FacebookTransport, RetryPolicy
+from facebook_cache import ResponseCache, MemoryCacheBackend
+from facebook_ratelimit import RateLimiter
+from facebook_coalesce import BatchCoalescer
+from facebook_concurrency import SingleFlight
+from facebook_breaker import CircuitBreaker
+from facebook_deadline import with_deadline
+
+
+# guards the lazy creation of a registry's shared hub
+_registry_lock = threading.Lock()
+
+
+def _asbool(value):
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('true', 'yes', 'on', 'y', 't', '1')
+    return bool(value)
+
+
+def hub_kwargs_from_settings(settings):
+    """Parses the `facebook.*` settings of a Pyramid app into `FacebookHub` keyword arguments.
+
+        facebook.app.id / facebook.app.secret / facebook.app.scope
+        facebook.app.oauth_code_redirect_uri / facebook.app.oauth_token_redirect_uri
+        facebook.app.ssl_verify = true
+        facebook.graph_api_version = v2.3
+        app_domain
+
+    and, for the shared components:
+
+        facebook.transport.pool_maxsize = 10
+        facebook.transport.timeout_connect = 5
+        facebook.transport.timeout_read = 30
+        facebook.transport.retry = false          (a default `RetryPolicy`)
+        facebook.cache.max_entries = 0            (a `ResponseCache` on a `MemoryCacheBackend`, if > 0)
+        facebook.rate_limiter = false             (a default `RateLimiter`)
+        facebook.coalescer.window = 0             (a `BatchCoalescer` with this window in seconds, if > 0)
+        facebook.single_flight = false            (a `SingleFlight`)
+        facebook.circuit_breaker = false          (a default `CircuitBreaker`)
+        facebook.signed_request_cache_size = 0
+    """
+    kwargs = {'app_id': settings.get('facebook.app.id'),
+              'app_secret': settings.get('facebook.app.secret'),
+              'app_scope': settings.get('facebook.app.scope'),
+              'app_domain': settings.get('app_domain'),
+              'oauth_code_redirect_uri': settings.get('facebook.app.oauth_code_redirect_uri'),
+              'oauth_token_redirect_uri': settings.get('facebook.app.oauth_token_redirect_uri'),
+              'fb_grap_api_version': settings.get('facebook.graph_api_version'),
+              'ssl_verify': _asbool(settings.get('facebook.app.ssl_verify', True)),
+              'signed_request_cache_size': int(settings.get('facebook.signed_request_cache_size') or 0),
+              }
+
+    transport_kwargs = {}
+    for (key, cast) in (('pool_maxsize', int), ('timeout_connect', float), ('timeout_read', float)):
+        value = settings.get('facebook.transport.%s' % key)
+        if value not in (None, ''):
+            transport_kwargs[key] = cast(value)
+    if _asbool(settings.get('facebook.transport.retry', False)):
+        transport_kwargs['retry_policy'] = RetryPolicy()
+    kwargs['transport'] = FacebookTransport(**transport_kwargs)
+
+    max_entries = int(settings.get('facebook.cache.max_entries') or 0)
+    if max_entries > 0:
+        kwargs['cache'] = ResponseCache(MemoryCacheBackend(max_entries=max_entries))
+    if _asbool(settings.get('facebook.rate_limiter', False)):
+        kwargs['rate_limiter'] = RateLimiter()
+    window = float(settings.get('facebook.coalescer.window') or 0)
+    if window > 0:
+        kwargs['coalescer'] = BatchCoalescer(window=window)
+    if _asbool(settings.get('facebook.single_flight', False)):
+        kwargs['single_flight'] = SingleFlight()
+    if _asbool(settings.get('facebook.circuit_breaker', False)):
+        kwargs['circuit_breaker'] = CircuitBreaker()
+    return kwargs
+
+
+def registry_hub_kwargs(registry):
+    """The `FacebookHub` keyword arguments for a Pyramid registry (see `hub_kwargs_from_settings`), parsed once.
+
+    The components (transport, cache, rate limiter, ...) are built on first use and cached on the registry,
+    so every hub built from them shares their connection pools and state.  Returns a copy.
+    """
+    kwargs = getattr(registry, 'facebook_hub_kwargs', None)
+    if kwargs is None:
+        with _registry_lock:
+            kwargs = getattr(registry, 'facebook_hub_kwargs', None)
+            if kwargs is None:
+                kwargs = registry.facebook_hub_kwargs = hub_kwargs_from_settings(registry.settings)
+    return dict(kwargs)
+
+
+def registry_hub(registry):
+    """The shared `FacebookHub` of a Pyramid registry; built from its settings on first use if `includeme` didn't set one up.
+
+    Raises `ValueError` if the settings have no app credentials; that is remembered, so the hub isn't rebuilt on every call.
+    """
+    hub = getattr(registry, 'facebook_hub', None)
+    if hub is None:
+        error = getattr(registry, 'facebook_hub_error', None)
+        if error is not None:
+            raise error
+        kwargs = registry_hub_kwargs(registry)
+        with _registry_lock:
+            hub = getattr(registry, 'facebook_hub', None)
+            if hub is None:
+                try:
+                    hub = registry.facebook_hub = FacebookHub(**kwargs)
+                except ValueError as e:
+                    registry.facebook_hub_error = e
+                    raise
+    return hub
+
+
+class FacebookRequestHub(object):
+    """A lightweight, request-bound view of a shared `FacebookHub`.
+
+    The `oauth_code__*` methods default `submitted_code` to `request.params['code']`;
+    everything else is proxied straight through to the shared hub.
+    """
+    __slots__ = ('hub', 'request')
+
+    def __init__(self, hub, request):
+        self.hub = hub
+        self.request = request
+
+    def __getattr__(self, name):
+        return getattr(self.hub, name)
+
+    def oauth_code__url_access_token(self, submitted_code=None, redirect_uri=None, scope=None):
+        if submitted_code is None:
+            submitted_code = self.request.params.get('code')
+        return self.hub.oauth_code__url_access_token(submitted_code=submitted_code, redirect_uri=redirect_uri, scope=scope)
+
+    @with_deadline
+    def oauth_code__get_access_token(self, submitted_code=None, redirect_uri=None, scope=None):
+        if submitted_code is None:
+            submitted_code = self.request.params.get('code')
+        return self.hub.oauth_code__get_access_token(submitted_code=submitted_code, redirect_uri=redirect_uri, scope=scope)
+
+    @with_deadline
+    def oauth_code__get_access_token_and_profile(self, submitted_code=None, redirect_uri=None, scope=None):
+        if submitted_code is None:
+            submitted_code = self.request.params.get('code')
+        return self.hub.oauth_code__get_access_token_and_profile(submitted_code=submitted_code, redirect_uri=redirect_uri, scope=scope)
+
+
+def set_facebook_hub(config, hub):
+    """config directive: use `hub` as the app's shared `FacebookHub`"""
+    config.registry.facebook_hub = hub
+
+
+def _request_facebook(request):
+    return FacebookRequestHub(registry_hub(request.registry), request)
+
+
+def includeme(config):
+    """Pyramid integration; `config.include('facebook_utils')`.
+
+    Builds one shared, thread-safe `FacebookHub` from the settings (see `hub_kwargs_from_settings`),
+    so connection pools, caches and rate-limit state survive between requests, and adds:
+
+    * `request.facebook`: a `FacebookRequestHub` bound to the request
+    * `config.set_facebook_hub(hub)`: to use a hub of your own instead
+
+    A hub already set on the registry is kept.
+    """
+    if getattr(config.registry, 'facebook_hub', None) is None:
+        config.registry.facebook_hub = FacebookHub(**registry_hub_kwargs(config.registry))
+    config.add_directive('set_facebook_hub', set_facebook_hub)
+    config.add_request_method(_request_facebook, 'facebook', reify=True)
+
+
+class FacebookPyramid(FacebookHub):
+
+    def __init__(
+        self,
+        request,
+        oauth_token_redirect_uri=None,
+        oauth_code_redirect_uri=None,
+        fb_graph_api_version=None,
+        app_secret=None,
+        app_domain=None,
+        ssl_verify=None,
+        app_scope=None,
+        app_id=None
+    ):
+        """Creates a new FacebookHub object, sets it up with Pyramid Config vars, and then proxies other functions into it.
+
+        The settings are only parsed once per app: this copies the configuration of the registry's shared hub (see `registry_hub`), and shares its transport, cache, rate limiter and instrumentation.  For new code, `request.facebook` (see `includeme`) avoids building a hub per request.
+        """
+        self.request = request
+        try:
+            shared = registry_hub(request.registry)
+        except ValueError:
+            # the settings have no app credentials, so they must be passed in; nothing can be shared
+            shared = None
+        if shared is None:
+            kwargs = registry_hub_kwargs(request.registry)
+            if app_id is not None:
+                kwargs['app_id'] = app_id
+            if app_secret is not None:
+                kwargs['app_secret'] = app_secret
+            FacebookHub.__init__(self, **kwargs)
+        else:
+            # the transport is created on first use; make sure it exists before sharing it
+            shared.transport
+            self.__dict__.update(shared.__dict__)
+            if app_secret is None:
+                self._signed_request_verifier = shared.signed_request_verifier
+            else:
+                self._signed_request_verifier = None
+                self.app_secret = app_secret
+            if app_id is not None:
+                self.app_id = app_id
+        if fb_graph_api_version is not None:
+            self.fb_graph_api = u'{fb_graph_api_url}/{version}/'.format(fb_graph_api_url=FB_GRAPH_API_URL,
+                                                                        version=fb_graph_api_version,
+                                                                        )
+        if app_scope is not None:
+            self.app_scope = app_scope
+        if app_domain is not None:
+            self.app_domain = app_domain
+        if oauth_code_redirect_uri is not None:
+            self.oauth_code_redirect_uri = oauth_code_redirect_uri
+        if oauth_token_redirect_uri is not None:
+            self.oauth_token_redirect_uri = oauth_token_redirect_uri
+        if ssl_verify is not None:
+            self.ssl_verify = ssl_verify
+
+    def oauth_code__url_access_token(self, submitted_code=None, redirect_uri=None, scope=None):
+        if submitted_code is None:
+            submitted_code = self.request.params.get('code')
+        return FacebookHub.oauth_code__url_access_token(self, submitted_code=submitted_code, redirect_uri=redirect_uri, scope=scope)
+
+    @with_deadline
+    def oauth_code__get_access_token(self, submitted_code=None, redirect_uri=None, scope=None):
+        if submitted_code is None:
+            submitted_code = self.request.params.get('code')
+        return FacebookHub.oauth_code__get_access_token(self, submitted_code=submitted_code, redirect_uri=redirect_uri, scope=scope)
+
+    @with_deadline
+    def oauth_code__get_access_token_and_profile(self, submitted_code=None, redirect_uri=None, scope=None):
+        if submitted_code is None:
+            submitted_code = self.request.params.get('code')
+        return FacebookHub.oauth_code__get_access_token_and_profile(self, submitted_code=submitted_code, redirect_uri=redirect_uri, scope=scope)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from facebook_api_urls import hash_access_token
+from facebook_exceptions import ApiTimeoutError
+
+
+def _loads(value):
+    try:
+        value = json.loads(value)
+    except ValueError:
+        return {}
+    if not isinstance(value, dict):
+        return {}
+    return value
+
+
+class RateLimiter(object):
+    """Paces outgoing Graph calls using the usage headers Facebook sends back.
+
+    Every response may carry `X-App-Usage` (app-wide), `X-Ad-Account-Usage` and
+    `X-Business-Use-Case-Usage` headers, reporting how much of a rolling budget
+    has been used, as a percentage.  `observe()` records the highest of those
+    numbers for the app and for the access token; `acquire()` is called before
+    every request and delays it once either utilization crosses `soft_limit`:
+
+    * below `soft_limit`: no delay
+    * between `soft_limit` and `hard_limit`: callers are spaced out, up to `max_interval` seconds apart
+    * at or above `hard_limit`: calls are held for `hard_wait` seconds (or until Facebook's `estimated_time_to_regain_access`)
+
+    The spacing is a shared schedule, so threads queue up in order instead of all waking at once.
+    Utilization readings older than `decay` seconds are ignored, since Facebook's window rolls.
+    At most `max_tokens` per-token readings are kept.
+    """
+    soft_limit = 75.0
+    hard_limit = 95.0
+    max_interval = 2.0
+    hard_wait = 60.0
+    decay = 300.0
+    max_tokens = 10000
+
+    def __init__(self,
+                 max_interval=None,
+                 max_tokens=None,
+                 soft_limit=None,
+                 hard_limit=None,
+                 hard_wait=None,
+                 decay=None,
+                 ):
+        if max_interval is not None:
+            self.max_interval = max_interval
+        if soft_limit is not None:
+            self.soft_limit = soft_limit
+        if hard_limit is not None:
+            self.hard_limit = hard_limit
+        if hard_wait is not None:
+            self.hard_wait = hard_wait
+        if decay is not None:
+            self.decay = decay
+        if max_tokens is not None:
+            self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        # key -> (utilization, observed_at, regain_at); tokens are dropped least-recently-observed first
+        self._usage = collections.OrderedDict()
+        self._next_slot = 0
+        self.delayed = 0
+        self.delayed_seconds = 0.0
+
+    def _key(self, access_token):
+        if access_token is None:
+            return 'app'
+        return 'token:' + hash_access_token(access_token)
+
+    @classmethod
+    def parse_headers(cls, headers):
+        """returns `(app_utilization, token_utilization, regain_seconds)` from a response's usage headers; each is None if not reported.
+
+        `X-App-Usage` is app-wide; `X-Ad-Account-Usage` and `X-Business-Use-Case-Usage` are counted against the caller's token.
+        """
+        app_utilization = None
+        token_utilization = None
+        regain = None
+        value = headers.get('X-App-Usage')
+        if value:
+            app_utilization = cls._max_percentage([_loads(value)])
+        value = headers.get('X-Ad-Account-Usage')
+        if value:
+            token_utilization = cls._max_percentage([_loads(value)])
+        value = headers.get('X-Business-Use-Case-Usage')
+        if value:
+            for entries in _loads(value).values():
+                if not isinstance(entries, list):
+                    continue
+                token_utilization = max(token_utilization, cls._max_percentage(entries))
+                for entry in entries:
+                    minutes = entry.get('estimated_time_to_regain_access') if isinstance(entry, dict) else None
+                    if minutes:
+                        regain = max(regain, minutes * 60)
+        return (app_utilization, token_utilization, regain)
+
+    @classmethod
+    def _max_percentage(cls, usages):
+        rval = None
+        for usage in usages:
+            if not isinstance(usage, dict):
+                continue
+            for (k, v) in usage.items():
+                if k != 'estimated_time_to_regain_access' and isinstance(v, (int, long, float)):
+                    rval = max(rval, v)
+        return rval
+
+    def _record(self, key, utilization, now, regain_at):
+        self._usage.pop(key, None)
+        self._usage[key] = (utilization, now, regain_at)
+
+    def observe(self, headers, access_token=None):
+        """records the usage reported by a response; `access_token` is the token the request was made with"""
+        (app_utilization, token_utilization, regain) = self.parse_headers(headers)
+        if app_utilization is None and token_utilization is None:
+            return
+        now = time.time()
+        regain_at = (now + regain) if regain else None
+        with self._lock:
+            if app_utilization is not None:
+                self._record('app', app_utilization, now, None)
+            if token_utilization is not None and access_token is not None:
+                self._record(self._key(access_token), token_utilization, now, regain_at)
+                while len(self._usage) > self.max_tokens + 1:
+                    for stale in self._usage:
+                        if stale != 'app':
+                            del self._usage[stale]
+                            break
+
+    def _delay_for(self, key, now):
+        """returns `(is_hard, seconds)` for one usage record"""
+        record = self._usage.get(key)
+        if record is None:
+            return (False, 0)
+        (utilization, observed_at, regain_at) = record
+        if now - observed_at > self.decay:
+            return (False, 0)
+        if utilization >= self.hard_limit:
+            if regain_at is not None:
+                return (True, max(regain_at - now, 0))
+            return (True, max(observed_at + self.hard_wait - now, 0))
+        if utilization <= self.soft_limit:
+            return (False, 0)
+        return (False, self.max_interval * (utilization - self.soft_limit) / (self.hard_limit - self.soft_limit))
+
+    def acquire(self, access_token=None, max_wait=None):
+        """blocks until the caller may send its request; returns the seconds waited.
+
+        raises `ApiTimeoutError` at once, without taking a slot, if that would take longer than `max_wait` seconds (e.g. a `Deadline`'s remaining time)
+        """
+        with self._lock:
+            now = time.time()
+            (is_hard, delay) = self._delay_for('app', now)
+            if access_token is not None:
+                (token_is_hard, token_delay) = self._delay_for(self._key(access_token), now)
+                is_hard = is_hard or token_is_hard
+                delay = max(delay, token_delay)
+            if not delay:
+                return 0
+            if is_hard:
+                # everyone holds until the budget is back
+                wait = delay
+            else:
+                # reserve the next slot on the shared schedule, `delay` apart from the previous one
+                slot = max(now, self._next_slot)
+                wait = slot - now
+            if (max_wait is not None) and (wait > max_wait):
+                raise ApiTimeoutError(message='The deadline for this call would pass while it is throttled',
+                                      retry_after=wait,
+                                      )
+            if not is_hard:
+                self._next_slot = slot + delay
+            if wait > 0:
+                self.delayed += 1
+                self.delayed_seconds += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def utilization(self, access_token=None):
+        """the most recent (non-decayed) utilization percentage for the app, or for a token"""
+        key = self._key(access_token)
+        with self._lock:
+            record = self._usage.get(key)
+        if record is None or time.time() - record[1] > self.decay:
+            return 0
+        return record[0]
+
+    def stats(self):
+        with self._lock:
+            record = self._usage.get('app')
+            return {'utilization': record[0] if record and (time.time() - record[1] <= self.decay) else 0,
+                    'tracked_tokens': len(self._usage) - (1 if record else 0),
+                    'delayed': self.delayed,
+                    'delayed_seconds': self.delayed_seconds,
+                    }
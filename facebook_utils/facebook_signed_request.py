@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import hashlib
+import base64
+import string
+import hmac
+import copy
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+# base64url -> base64, built once
+_base64url_table = string.maketrans('-_', '+/')
+
+
+def base64_url_decode(inp):
+    if isinstance(inp, unicode):
+        inp = inp.encode('ascii')
+    padding_factor = (4 - len(inp) % 4) % 4
+    return base64.b64decode(inp.translate(_base64url_table) + '=' * padding_factor)
+
+
+class SignedRequestVerifier(object):
+    """Verifies the `signed_request` parameter Facebook sends to canvas and page-tab apps.
+
+    The HMAC key is set up once per verifier, signatures are compared in constant time,
+    and `verify_many()` checks a whole list in one call.  With `cache_size`, the payloads
+    of the most recently verified requests are kept, so seeing the same signed request
+    again (e.g. every page view of a session) skips the HMAC and the json decode.
+
+    Results follow `FacebookHub.verify_signed_request`.
+    """
+    cache_size = 0
+
+    def __init__(self, app_secret, cache_size=None):
+        if not app_secret:
+            raise ValueError('must submit app_secret')
+        if isinstance(app_secret, unicode):
+            app_secret = app_secret.encode('utf-8')
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self._hmac = hmac.new(app_secret, digestmod=hashlib.sha256)
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self.cache_hits = 0
+
+    def _cached(self, signed_request):
+        with self._lock:
+            data = self._cache.pop(signed_request, None)
+            if data is not None:
+                self._cache[signed_request] = data
+                self.cache_hits += 1
+            return data
+
+    def _remember(self, signed_request, data):
+        with self._lock:
+            self._cache[signed_request] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _verify_signature(self, signed_request):
+        """returns `(data, None)` for a correctly signed request, or `(None, error_result)`"""
+        (signature, payload) = signed_request.split('.')
+        if isinstance(payload, unicode):
+            payload = payload.encode('ascii')
+
+        decoded_signature = base64_url_decode(signature)
+        data = json.loads(base64_url_decode(payload))
+
+        algorithm = (data.get('algorithm') or '').upper()
+        if algorithm != 'HMAC-SHA256':
+            return (None, (False, {'python-error': 'Unknown algorithm - %s' % algorithm}))
+
+        mac = self._hmac.copy()
+        mac.update(payload)
+        expected_sig = mac.digest()
+
+        if not hmac.compare_digest(decoded_signature, expected_sig):
+            # never echo either digest: the expected one is a valid signature for this payload
+            return (None, (None, {'python-error': 'signature mismatch'}))
+        return (data, None)
+
+    def verify(self, signed_request, timeout=None):
+        """verifies one signed request; see `FacebookHub.verify_signed_request`"""
+        if signed_request is None:
+            raise ValueError('must submit signed_request')
+
+        data = None
+        if self.cache_size:
+            data = self._cached(signed_request)
+        if data is None:
+            (data, error) = self._verify_signature(signed_request)
+            if error is not None:
+                return error
+            if self.cache_size:
+                self._remember(signed_request, data)
+        # callers may alter the payload, so never hand out the cached copy
+        data = copy.deepcopy(data)
+
+        if timeout:
+            issued_at = data.get('issued_at')
+            if not isinstance(issued_at, (int, long, float)):
+                data['python-error'] = "payload has no issued_at"
+                return (False, data)
+            time_now = int(time.time())
+            diff = time_now - issued_at
+            if (diff > timeout):
+                data['python-error'] = "payload issued outside of timeout window"
+                return (False, data)
+
+        return (True, data)
+
+    def verify_many(self, signed_requests, timeout=None):
+        """verifies a list of signed requests; returns a list of results in the same order.
+
+        a malformed request doesn't abort the batch; its result is `(False, {'python-error': ...})`
+        """
+        results = []
+        for signed_request in signed_requests:
+            try:
+                results.append(self.verify(signed_request, timeout=timeout))
+            except (ValueError, TypeError, AttributeError, KeyError) as e:
+                results.append((False, {'python-error': 'malformed signed_request (%s)' % e}))
+        return results
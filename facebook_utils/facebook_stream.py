@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from facebook_exceptions import ApiResponseError
+
+
+_re_structural = re.compile(r'["\[\]{},:]')
+_re_string_special = re.compile(r'["\\]')
+
+
+class JsonArrayScanner(object):
+    """Incrementally splits a json document into the elements of one array, as the bytes arrive.
+
+    `mode` is either 'array', for a document which is an array (a batch response), or 'data',
+    for an object whose top-level "data" key is an array (a page of an edge).
+
+    `feed()` returns the raw json of every element completed by the chunk; only the element
+    being received is buffered, so memory is bounded by the largest element, not the document.
+    In 'data' mode everything around the array is kept, and `close()` returns it decoded
+    (with an empty "data"), for the `paging` cursors.
+
+    The scan only looks at structural characters, which never occur inside a multi-byte utf-8
+    sequence, so it works directly on the raw bytes.
+    """
+
+    def __init__(self, mode='array'):
+        if mode not in ('array', 'data'):
+            raise ValueError('mode must be "array" or "data"')
+        self.mode = mode
+        self._buf = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._string_start = None
+        self._last_string = None
+        self._key = None
+        self._target_depth = None
+        self._target_done = False
+        self._element_start = None
+        self._envelope = []
+
+    def feed(self, chunk):
+        """returns a list of the raw elements completed by `chunk`"""
+        elements = []
+        buf = self._buf = self._buf + chunk
+        pos = self._pos
+        while True:
+            if self._in_string:
+                m = _re_string_special.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                if m.group() == '\\':
+                    if m.end() >= len(buf):
+                        # need the escaped character before going on
+                        pos = m.start()
+                        break
+                    pos = m.end() + 1
+                    continue
+                pos = m.end()
+                self._in_string = False
+                if self._depth == 1 and self._target_depth is None:
+                    self._last_string = buf[self._string_start:m.start()]
+                continue
+
+            m = _re_structural.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            c = m.group()
+            pos = m.end()
+            if c == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif c == ':':
+                if self._depth == 1:
+                    self._key = self._last_string
+            elif c in '[{':
+                self._depth += 1
+                if (c == '[') and (self._target_depth is None) and not self._target_done:
+                    if ((self.mode == 'array') and (self._depth == 1)) or ((self.mode == 'data') and (self._depth == 2) and (self._key == 'data')):
+                        self._target_depth = self._depth
+                        self._envelope.append(buf[:pos])
+                        self._element_start = pos
+            elif c in ']}':
+                if (c == ']') and (self._depth == self._target_depth):
+                    element = buf[self._element_start:m.start()].strip()
+                    if element:
+                        elements.append(element)
+                    self._target_depth = None
+                    self._target_done = True
+                    # keep the closing bracket and everything after it
+                    buf = self._buf = buf[m.start():]
+                    pos = 1
+                self._depth -= 1
+            elif c == ',':
+                if self._depth == self._target_depth:
+                    elements.append(buf[self._element_start:m.start()].strip())
+                    self._element_start = pos
+
+        if self._target_depth is not None:
+            # only the element being received needs to be kept
+            start = self._element_start
+            if self._in_string and self._string_start < start:
+                start = self._string_start
+            buf = self._buf = buf[start:]
+            self._element_start -= start
+            if self._string_start is not None:
+                self._string_start -= start
+            pos -= start
+        self._pos = pos
+        return elements
+
+    def close(self):
+        """checks the document was complete; in 'data' mode returns the envelope around the array"""
+        if (self._depth != 0) or self._in_string or ((self.mode == 'array') and not self._target_done):
+            raise ApiResponseError(message='Incomplete json document')
+        if self.mode == 'array':
+            return None
+        try:
+            return json.loads(''.join(self._envelope) + self._buf)
+        except ValueError, e:
+            raise ApiResponseError(message='Could not parse JSON (%s)' % e, raised=e)
+
+
+class LazyBatchItem(dict):
+    """One element of a batch response, whose json-encoded 'body' is only decoded when it is read."""
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._decoded = False
+
+    def _decode(self):
+        if not self._decoded:
+            self._decoded = True
+            body = dict.get(self, 'body')
+            if isinstance(body, basestring):
+                dict.__setitem__(self, 'body', json.loads(body))
+
+    def __getitem__(self, key):
+        if key == 'body':
+            self._decode()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key == 'body':
+            self._decode()
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        if key == 'body':
+            self._decoded = True
+        dict.__setitem__(self, key, value)
+
+    def items(self):
+        self._decode()
+        return dict.items(self)
+
+    def iteritems(self):
+        self._decode()
+        return dict.iteritems(self)
+
+    def values(self):
+        self._decode()
+        return dict.values(self)
+
+    def itervalues(self):
+        self._decode()
+        return dict.itervalues(self)
+
+    def copy(self):
+        self._decode()
+        return dict(self)
+
+    def __eq__(self, other):
+        self._decode()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+class GraphStream(object):
+    """The body of a Graph response, decoded incrementally while it downloads.
+
+    Iterating yields the elements of a batch response (as `LazyBatchItem`s, or None for an
+    operation which didn't complete), or the items of the `data` array of an edge page.  Once
+    the iteration is done, `envelope` holds the rest of an edge page (`paging`, ...).  A stream
+    can only be iterated once.
+    """
+    chunk_size = 16 * 1024
+    envelope = None
+
+    def __init__(self, response, batch=False, chunk_size=None):
+        self.response = response
+        self.batch = batch
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        self._consumed = False
+
+    def _batch_item(self, li):
+        if li is None:
+            # Graph returns null for an operation which didn't complete
+            return None
+        if not isinstance(li, dict):
+            raise ApiResponseError(message="Batched Graph request expects a list of dicts. Got a list, element not a dict.",
+                                   response=li)
+        if not all(k in li for k in ('body', 'headers', 'code')):
+            raise ApiResponseError(message="Batched Graph response dict should contain 'body', 'headers', 'code'.",
+                                   response=li)
+        return LazyBatchItem(li)
+
+    def __iter__(self):
+        if self._consumed:
+            raise ValueError('a GraphStream can only be iterated once')
+        self._consumed = True
+        scanner = JsonArrayScanner('array' if self.batch else 'data')
+        try:
+            for chunk in self.response.iter_content(self.chunk_size):
+                for raw in scanner.feed(chunk):
+                    item = json.loads(raw)
+                    if self.batch:
+                        item = self._batch_item(item)
+                    yield item
+            self.envelope = scanner.close()
+        finally:
+            self.response.close()
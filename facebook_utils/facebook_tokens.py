@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import random
+import heapq
+import time
+
+from facebook_api_urls import hash_access_token
+from facebook_exceptions import *
+
+
+def _last(value):
+    # `urlparse.parse_qs` responses have lists of values
+    if isinstance(value, list):
+        return value[-1] if value else None
+    return value
+
+
+class TokenStateIndex(object):
+    """Remembers what the hub has learned about access tokens, so calls with a token known to be dead fail locally.
+
+    * `mark_bad()` records the `ApiAuthError` (or `ApiAuthExpiredError`) a token failed with; `FacebookHub` does this for every auth error Facebook returns.
+      Only errors that mean the token itself is invalid (see `is_token_error()`) are recorded; a permission
+      error, e.g. `(#200)`, is about one call, not the token
+    * `set_expires()` records when a token expires; `FacebookHub` does this from `graph__extend_access_token`, `oauth_code__get_access_token` and `graph__debug_token` responses
+
+    `check()` raises an exception of the recorded class (or `ApiAuthExpiredError` once a token is past its
+    expiry) without a network round trip.  An auth error is remembered for `bad_ttl` seconds, since some are
+    fixed on Facebook's side (e.g. the user logs back in); an expiry is final.
+
+    Tokens are keyed by a digest, never stored as-is.  At most `max_tokens` are tracked; the least recently
+    used are evicted first.
+    """
+    max_tokens = 100000
+    bad_ttl = 3600.0
+    # error codes and subcodes which mean the access token itself is invalid
+    token_codes = (102, 190)
+    token_subcodes = (458, 459, 460, 463, 464, 467)
+
+    def __init__(self, max_tokens=None, bad_ttl=None):
+        if max_tokens is not None:
+            self.max_tokens = max_tokens
+        if bad_ttl is not None:
+            self.bad_ttl = bad_ttl
+        self._lock = threading.Lock()
+        # key -> (expires_at, error_class, error_kwargs, bad_until)
+        self._tokens = collections.OrderedDict()
+        self._counters = {'short_circuits': 0,
+                          'evictions': 0,
+                          }
+
+    def _update(self, access_token, **changes):
+        key = hash_access_token(access_token)
+        with self._lock:
+            (expires_at, error_class, error_kwargs, bad_until) = self._tokens.pop(key, (None, None, None, None))
+            if 'expires_at' in changes:
+                expires_at = changes['expires_at']
+            if 'error_class' in changes:
+                (error_class, error_kwargs, bad_until) = (changes['error_class'], changes['error_kwargs'], changes['bad_until'])
+            self._tokens[key] = (expires_at, error_class, error_kwargs, bad_until)
+            while len(self._tokens) > self.max_tokens:
+                self._tokens.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    @classmethod
+    def is_token_error(cls, error):
+        """whether `error` means the access token itself is invalid: an `ApiAuthExpiredError`, or an invalid token code or subcode"""
+        if isinstance(error, ApiAuthExpiredError):
+            return True
+        return (error.code in cls.token_codes) or (error.subcode in cls.token_subcodes)
+
+    def mark_bad(self, access_token, error):
+        """records the `ApiError` a call with `access_token` failed with, if it means the token is invalid"""
+        if (not access_token) or (not self.is_token_error(error)):
+            return
+        error_kwargs = {'code': error.code,
+                        'subcode': error.subcode,
+                        'type': error.type,
+                        'message': error.message,
+                        }
+        self._update(access_token,
+                     error_class=error.__class__,
+                     error_kwargs=error_kwargs,
+                     bad_until=time.time() + self.bad_ttl,
+                     )
+
+    def set_expires(self, access_token, expires_at):
+        """records that `access_token` expires at the unix time `expires_at`; 0 or None means it doesn't expire"""
+        if not access_token:
+            return
+        self._update(access_token, expires_at=expires_at or None)
+
+    def expires_at(self, access_token):
+        """the recorded expiry of `access_token`, as a unix time, or None"""
+        with self._lock:
+            entry = self._tokens.get(hash_access_token(access_token))
+        return entry[0] if entry else None
+
+    def forget(self, access_token):
+        """drops everything known about `access_token`, e.g. after the user re-authorized"""
+        with self._lock:
+            self._tokens.pop(hash_access_token(access_token), None)
+
+    def error_for(self, access_token):
+        """the exception a call with `access_token` would fail with, or None if it isn't known to be dead"""
+        if not access_token:
+            return None
+        key = hash_access_token(access_token)
+        now = time.time()
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry is None:
+                return None
+            (expires_at, error_class, error_kwargs, bad_until) = entry
+            if (error_class is not None) and (bad_until > now):
+                self._counters['short_circuits'] += 1
+                return error_class(**error_kwargs)
+            if (expires_at is not None) and (expires_at <= now):
+                self._counters['short_circuits'] += 1
+                return ApiAuthExpiredError(code=190,
+                                           subcode=463,
+                                           type='OAuthException',
+                                           message='Error validating access token: Session has expired (known locally)',
+                                           )
+        return None
+
+    def check(self, access_token):
+        """raises the exception a call with `access_token` would fail with, if it is known to be dead"""
+        error = self.error_for(access_token)
+        if error is not None:
+            raise error
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['tracked'] = len(self._tokens)
+            return stats
+
+
+class TokenRefreshManager(object):
+    """Keeps long-lived access tokens fresh by extending them on a background thread, ahead of their expiry.
+
+        manager = TokenRefreshManager(hub, on_refresh=save_token)
+        manager.track(user_id, access_token, expires_in=5183999)
+        manager.start()
+        ...
+        access_token = manager.token(user_id)   # never blocks
+
+    A token is extended with `graph__extend_access_token` about `refresh_ahead` seconds before it expires; each
+    is moved earlier by a random part of `spread` seconds, and extensions run at least `min_interval` seconds
+    apart, so tokens issued together don't all come due at once.  A token tracked without a known expiry
+    (and none in the hub's `token_index`) is extended within `spread` seconds, to learn it; if the extension
+    doesn't return one either, the token doesn't expire, and is only extended again `no_expiry_interval`
+    seconds later.
+
+    `on_refresh(key, access_token, expires_at)` is called after every extension, e.g. to persist the token.
+    A token Facebook rejects as invalid (see `TokenStateIndex.is_token_error`; also when the hub wraps the error in an
+    `ApiUnhandledError`) is dropped and `on_error(key, error)` is called; after other errors, including auth errors
+    which don't mean the token is invalid (e.g. `(#200)` permission errors), the extension is retried `retry_delay` seconds later.
+    """
+    refresh_ahead = 86400.0 * 7
+    spread = 3600.0
+    min_interval = 0.1
+    retry_delay = 300.0
+    no_expiry_interval = 86400.0 * 30
+
+    def __init__(self,
+                 hub,
+                 refresh_ahead=None,
+                 spread=None,
+                 min_interval=None,
+                 retry_delay=None,
+                 no_expiry_interval=None,
+                 on_refresh=None,
+                 on_error=None,
+                 ):
+        if refresh_ahead is not None:
+            self.refresh_ahead = refresh_ahead
+        if min_interval is not None:
+            self.min_interval = min_interval
+        if retry_delay is not None:
+            self.retry_delay = retry_delay
+        if no_expiry_interval is not None:
+            self.no_expiry_interval = no_expiry_interval
+        if spread is not None:
+            self.spread = spread
+        self.hub = hub
+        self.on_refresh = on_refresh
+        self.on_error = on_error
+        self._cond = threading.Condition()
+        # key -> [access_token, expires_at, due]
+        self._tokens = {}
+        self._schedule = []
+        self._thread = None
+        self._stopped = False
+        self._counters = {'refreshed': 0,
+                          'failed': 0,
+                          'dropped': 0,
+                          }
+
+    def _due(self, expires_at, now):
+        jitter = random.uniform(0, self.spread)
+        if expires_at is None:
+            return now + jitter
+        return max(now, expires_at - self.refresh_ahead - jitter)
+
+    def _schedule_locked(self, key, due):
+        self._tokens[key][2] = due
+        heapq.heappush(self._schedule, (due, key))
+        self._cond.notify()
+
+    def track(self, key, access_token, expires_at=None, expires_in=None):
+        """starts keeping `access_token` fresh, under the caller's `key` (e.g. a user id); replaces any token tracked under `key`"""
+        now = time.time()
+        if expires_in is not None:
+            expires_at = now + int(expires_in)
+        if (expires_at is None) and (getattr(self.hub, 'token_index', None) is not None):
+            expires_at = self.hub.token_index.expires_at(access_token)
+        with self._cond:
+            self._tokens[key] = [access_token, expires_at, None]
+            self._schedule_locked(key, self._due(expires_at, now))
+
+    def untrack(self, key):
+        with self._cond:
+            self._tokens.pop(key, None)
+
+    def token(self, key):
+        """the freshest token tracked under `key`, or None"""
+        entry = self._tokens.get(key)
+        return entry[0] if entry is not None else None
+
+    def expires_at(self, key):
+        entry = self._tokens.get(key)
+        return entry[1] if entry is not None else None
+
+    def refresh(self, key):
+        """extends the token tracked under `key` now, on the calling thread; returns the new token, or None if it was dropped"""
+        with self._cond:
+            entry = self._tokens.get(key)
+            if entry is None:
+                return None
+            access_token = entry[0]
+        try:
+            response = self.hub.graph__extend_access_token(access_token=access_token)
+        except Exception, e:
+            if isinstance(e, ApiUnhandledError) and isinstance(e.raised, ApiAuthError):
+                e = e.raised
+            if isinstance(e, ApiAuthError) and TokenStateIndex.is_token_error(e):
+                with self._cond:
+                    if self._tokens.get(key, [None])[0] == access_token:
+                        del self._tokens[key]
+                    self._counters['dropped'] += 1
+                if self.on_error is not None:
+                    self.on_error(key, e)
+                return None
+            with self._cond:
+                self._counters['failed'] += 1
+                if self._tokens.get(key, [None])[0] == access_token:
+                    self._schedule_locked(key, time.time() + self.retry_delay)
+            raise
+        now = time.time()
+        new_token = _last(response.get('access_token')) or access_token
+        expires = _last(response.get('expires') or response.get('expires_in'))
+        expires_at = (now + int(expires)) if expires and unicode(expires).isdigit() else None
+        with self._cond:
+            if self._tokens.get(key, [None])[0] == access_token:
+                self._tokens[key] = [new_token, expires_at, None]
+                if expires_at is None:
+                    # the token doesn't expire; `_due` would extend it again within `spread` seconds
+                    self._schedule_locked(key, now + self.no_expiry_interval)
+                else:
+                    self._schedule_locked(key, self._due(expires_at, now))
+            self._counters['refreshed'] += 1
+        if self.on_refresh is not None:
+            self.on_refresh(key, new_token, expires_at)
+        return new_token
+
+    def _next_due(self):
+        """waits for the next token which is due, and returns its key; None once stopped"""
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                while self._schedule:
+                    (due, key) = self._schedule[0]
+                    entry = self._tokens.get(key)
+                    if (entry is None) or (entry[2] != due):
+                        # untracked or rescheduled since
+                        heapq.heappop(self._schedule)
+                        continue
+                    break
+                if self._schedule and self._schedule[0][0] <= now:
+                    (due, key) = heapq.heappop(self._schedule)
+                    self._tokens[key][2] = None
+                    return key
+                self._cond.wait(min(self._schedule[0][0] - now, 60) if self._schedule else 60)
+        return None
+
+    def _run(self):
+        while True:
+            key = self._next_due()
+            if key is None:
+                return
+            try:
+                self.refresh(key)
+            except Exception:
+                # counted and rescheduled by `refresh`
+                pass
+            if self.min_interval:
+                time.sleep(self.min_interval)
+
+    def start(self):
+        """starts the background worker (a daemon thread)"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, wait=True):
+        with self._cond:
+            thread = self._thread
+            self._thread = None
+            self._stopped = True
+            self._cond.notify()
+        if wait and thread is not None:
+            thread.join()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats['tracked'] = len(self._tokens)
+            stats['next_due'] = min([entry[2] for entry in self._tokens.values() if entry[2] is not None] or [None])
+            return stats
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import random
+import socket
+import time
+import sys
+
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    from requests.packages.urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+except ImportError:
+    # older `requests`; only first byte and total timings are traced
+    HTTPConnectionPool = HTTPSConnectionPool = None
+
+from facebook_exceptions import *
+from facebook_deadline import current_deadline
+
+
+class RetryPolicy(object):
+    """Decides whether a failed Graph call is retried, and when.
+
+    An error is retryable if it is transient:
+
+    * Graph throttling codes (`throttle_codes`); the request was rejected, so these are retried for any method
+    * Graph transient codes (`retryable_codes`) and HTTP 5xx (`retryable_statuses`); only for `idempotent_methods`
+    * connection errors and timeouts; only for `idempotent_methods`, except connect timeouts, which never reached Facebook
+
+    Other `fatal_classes` errors (auth and application errors, ...) are never retried.
+
+    Attempts back off exponentially (`backoff_base` * 2 ** n, capped at `backoff_max`) with jitter.  A retry-after hint
+    from Facebook (`ApiError.retry_after`) is honored as a minimum.  Retrying stops after `max_attempts` attempts, or once
+    the next attempt would start more than `max_total_time` seconds after the first, or after the current `Deadline`.
+    """
+    max_attempts = 3
+    max_total_time = 30.0
+    backoff_base = 0.5
+    backoff_max = 10.0
+    jitter = True
+    throttle_codes = (4, 17, 32, 341, 613)
+    retryable_codes = (1, 2)
+    retryable_statuses = (500, 502, 503, 504)
+    idempotent_methods = ('GET', 'DELETE')
+    fatal_classes = (ApiAuthError, ApiApplicationError, ApiRuntimeError, ApiRuntimeGraphMethodError)
+
+    def __init__(self,
+                 max_total_time=None,
+                 max_attempts=None,
+                 backoff_base=None,
+                 backoff_max=None,
+                 jitter=None,
+                 ):
+        if max_total_time is not None:
+            self.max_total_time = max_total_time
+        if max_attempts is not None:
+            self.max_attempts = max_attempts
+        if backoff_base is not None:
+            self.backoff_base = backoff_base
+        if backoff_max is not None:
+            self.backoff_max = backoff_max
+        if jitter is not None:
+            self.jitter = jitter
+        self._lock = threading.Lock()
+        self._counters = {'calls': 0,
+                          'retries': 0,
+                          'recovered': 0,
+                          'exhausted': 0,
+                          }
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def is_retryable(self, exc, method='GET'):
+        if isinstance(exc, ApiUnhandledError) and exc.raised is not None:
+            exc = exc.raised
+        if isinstance(exc, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+            return method in self.idempotent_methods
+        if not isinstance(exc, ApiError):
+            return False
+        # throttling errors come back as `OAuthException`, so check for them before the fatal classes
+        if exc.code in self.throttle_codes:
+            return True
+        if isinstance(exc, self.fatal_classes):
+            return False
+        if method not in self.idempotent_methods:
+            return False
+        return (exc.code in self.retryable_codes) or (exc.http_status in self.retryable_statuses)
+
+    def backoff(self, attempt, exc=None):
+        """seconds to wait before retrying, after `attempt` attempts have failed"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        if self.jitter:
+            delay = random.uniform(delay / 2, delay)
+        retry_after = getattr(exc, 'retry_after', None)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, fn, method, *args, **kwargs):
+        """runs `fn(*args, **kwargs)`, retrying it according to this policy"""
+        self._count('calls')
+        started = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                exc_info = sys.exc_info()
+                if not self.is_retryable(e, method):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                delay = self.backoff(attempt, e)
+                deadline = current_deadline()
+                if (attempt >= self.max_attempts) or (time.time() + delay - started > self.max_total_time) or \
+                        ((deadline is not None) and (time.time() + delay >= deadline.expires_at)):
+                    self._count('exhausted')
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                self._count('retries')
+                time.sleep(delay)
+                continue
+            if attempt > 1:
+                self._count('recovered')
+            return result
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+# the trace dict of the request being sent on this thread, if it is traced
+_tracing = threading.local()
+
+
+class _TracedConnectionMixin(object):
+    """Splits the setup of a new connection into `dns`, `connect` and `tls` timings, for traced requests."""
+
+    def _new_conn(self):
+        trace = getattr(_tracing, 'trace', None)
+        if trace is None:
+            return super(_TracedConnectionMixin, self)._new_conn()
+        # urllib3 1.22+ (requests 2.18+) connects to `_dns_host`; older versions to `host`
+        attribute = '_dns_host' if hasattr(self, '_dns_host') else 'host'
+        host = getattr(self, attribute)
+        started = time.time()
+        try:
+            addresses = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)
+        except socket.error:
+            # let urllib3 raise its usual error
+            return super(_TracedConnectionMixin, self)._new_conn()
+        resolved = time.time()
+        trace['dns'] = resolved - started
+        # try each resolved address in turn, as `create_connection` would; `host` is only swapped
+        # for the connect, so TLS still uses the hostname for SNI and certificate checks
+        error = None
+        for address in addresses:
+            setattr(self, attribute, address[4][0])
+            try:
+                conn = super(_TracedConnectionMixin, self)._new_conn()
+                break
+            except (ConnectTimeoutError, NewConnectionError) as e:
+                error = e
+            finally:
+                setattr(self, attribute, host)
+        else:
+            raise error
+        trace['connect'] = time.time() - resolved
+        return conn
+
+    def connect(self):
+        trace = getattr(_tracing, 'trace', None)
+        started = time.time()
+        super(_TracedConnectionMixin, self).connect()
+        if (trace is not None) and (self.scheme == 'https'):
+            trace['tls'] = max(time.time() - started - trace.get('dns', 0) - trace.get('connect', 0), 0)
+
+
+if HTTPConnectionPool is not None:
+    class _TracedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = type('_TracedHTTPConnection', (_TracedConnectionMixin, HTTPConnectionPool.ConnectionCls), {'scheme': 'http'})
+
+    class _TracedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = type('_TracedHTTPSConnection', (_TracedConnectionMixin, HTTPSConnectionPool.ConnectionCls), {'scheme': 'https'})
+
+
+class _TracingHTTPAdapter(HTTPAdapter):
+    """An `HTTPAdapter` which can trace the phases of a request (see `FacebookTransport.request`)."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        if HTTPConnectionPool is not None:
+            self.poolmanager.pool_classes_by_scheme = {'http': _TracedHTTPConnectionPool,
+                                                       'https': _TracedHTTPSConnectionPool,
+                                                       }
+
+    def send(self, request, *args, **kwargs):
+        response = HTTPAdapter.send(self, request, *args, **kwargs)
+        trace = getattr(_tracing, 'trace', None)
+        if trace is not None:
+            # the adapter returns once the status line and headers are in
+            trace['first_byte'] = time.time() - trace['started']
+        return response
+
+
+class FacebookTransport(object):
+    """A long-lived, thread-safe HTTP transport for talking to the Graph API.
+
+    Every thread gets its own `requests.Session`, but all of those sessions
+    mount one shared `HTTPAdapter`.  The adapter's urllib3 pool manager is
+    thread-safe, so keep-alive connections to graph.facebook.com are reused
+    by every thread instead of paying a TCP+TLS handshake per call.
+
+    pool_connections: number of per-host pools to keep around
+    pool_maxsize: max number of connections kept open per host
+    pool_block: if True, block when a host's pool is exhausted instead of opening a throwaway connection
+    keep_alive: if False, every request asks the server to close the connection
+    timeout_connect / timeout_read: seconds, passed to `requests` as a (connect, read) tuple
+    retry_policy: an optional `RetryPolicy`, which `FacebookHub.api_proxy` applies to every call
+    """
+    pool_connections = 10
+    pool_maxsize = 10
+    pool_block = False
+    keep_alive = True
+    timeout_connect = 5.0
+    timeout_read = 30.0
+    retry_policy = None
+
+    def __init__(self,
+                 pool_connections=None,
+                 retry_policy=None,
+                 timeout_connect=None,
+                 pool_maxsize=None,
+                 timeout_read=None,
+                 keep_alive=None,
+                 pool_block=None,
+                 ):
+        if pool_connections is not None:
+            self.pool_connections = pool_connections
+        if timeout_connect is not None:
+            self.timeout_connect = timeout_connect
+        if pool_maxsize is not None:
+            self.pool_maxsize = pool_maxsize
+        if timeout_read is not None:
+            self.timeout_read = timeout_read
+        if keep_alive is not None:
+            self.keep_alive = keep_alive
+        if pool_block is not None:
+            self.pool_block = pool_block
+        if retry_policy is not None:
+            self.retry_policy = retry_policy
+
+        self._adapter = self._new_adapter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._in_flight = 0
+        self._in_flight_peak = 0
+
+    def _new_adapter(self):
+        return _TracingHTTPAdapter(pool_connections=self.pool_connections,
+                                   pool_maxsize=self.pool_maxsize,
+                                   pool_block=self.pool_block,
+                                   )
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+            self._local.session = session
+        return session
+
+    @property
+    def timeout(self):
+        return (self.timeout_connect, self.timeout_read)
+
+    def request(self, method, url, data=None, headers=None, verify=True, timeout=None, stream=False, trace=None):
+        """Issues a single HTTP request over the shared pool and returns the `requests.Response`.
+
+        If `trace` is a dict, it is filled in with the seconds spent on the phases of the request
+        (`dns`, `connect` and `tls` when a new connection is opened, `first_byte`, `total`) and
+        the body sizes (`bytes_out`, `bytes_in`).  For a `stream`ed response, `total` and
+        `bytes_in` stop at the headers (`bytes_in` is the Content-Length).
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if not self.keep_alive:
+            headers = dict(headers or {})
+            headers['Connection'] = 'close'
+        with self._lock:
+            self._requests += 1
+            self._in_flight += 1
+            if self._in_flight > self._in_flight_peak:
+                self._in_flight_peak = self._in_flight
+        if trace is not None:
+            trace['started'] = time.time()
+            _tracing.trace = trace
+        try:
+            response = self._session().request(method,
+                                               url,
+                                               data=data,
+                                               headers=headers,
+                                               verify=verify,
+                                               timeout=timeout,
+                                               stream=stream,
+                                               )
+        except:
+            with self._lock:
+                self._errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            if trace is not None:
+                _tracing.trace = None
+                trace['total'] = time.time() - trace.pop('started')
+        if trace is not None:
+            body = getattr(response.request, 'body', None)
+            trace['bytes_out'] = len(body) if isinstance(body, basestring) else 0
+            if stream:
+                length = response.headers.get('Content-Length')
+                trace['bytes_in'] = int(length) if length and length.isdigit() else 0
+            else:
+                trace['bytes_in'] = len(response.content)
+        return response
+
+    def stats(self):
+        """Returns a dict of request counters and per-host pool usage, for sizing the pool per worker."""
+        pools = []
+        container = self._adapter.poolmanager.pools
+        for key in list(container.keys()):
+            pool = container.get(key)
+            if pool is None:
+                continue
+            idle = getattr(pool, 'pool', None)
+            pools.append({'scheme': pool.scheme,
+                          'host': pool.host,
+                          'port': pool.port,
+                          'maxsize': idle.maxsize if idle is not None else None,
+                          'idle': idle.qsize() if idle is not None else 0,
+                          'connections_opened': pool.num_connections,
+                          'requests': pool.num_requests,
+                          })
+        with self._lock:
+            return {'requests': self._requests,
+                    'errors': self._errors,
+                    'in_flight': self._in_flight,
+                    'in_flight_peak': self._in_flight_peak,
+                    'pool_connections': self.pool_connections,
+                    'pool_maxsize': self.pool_maxsize,
+                    'pools': pools,
+                    }
+
+    def close(self):
+        """Closes every pooled connection."""
+        self._adapter.close()
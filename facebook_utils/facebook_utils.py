@@ -1,28 +1,39 @@
 # -*- coding: utf-8 -*-
 
 
+import collections
 import datetime
-import requests
 import urlparse
-import hashlib
-import base64
+import urllib
+import threading
 import types
 import time
-import hmac
-import cgi
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
+# only simplejson has JSONDecodeError; the stdlib raises a plain ValueError
+JSONDecodeError = getattr(json, 'JSONDecodeError', ValueError)
 
-from facebook_api_urls import FacebookApiUrls, FB_GRAPH_API_URL
+
+from facebook_api_urls import FacebookApiUrls, FB_GRAPH_API_URL, FB_BATCH_MAX_OPERATIONS, FB_IDS_MAX
+from facebook_api_urls import url_access_token, url_normalized, url_endpoint_class, GraphQuery
 from facebook_exceptions import *
+from facebook_batch import BatchResult
+from facebook_ratelimit import RateLimiter
+from facebook_signed_request import SignedRequestVerifier
+from facebook_stream import GraphStream
+from facebook_concurrency import map_bounded, imap_unordered, BoundedExecutor
+from facebook_deadline import current_deadline, with_deadline
 
 
 DEBUG = False
 
+# guards the lazy creation of a hub's default transport
+_transport_lock = threading.Lock()
+
 
 class FacebookHub(object):
     app_id = None
@@ -34,20 +45,53 @@ class FacebookHub(object):
     debug_error = False
     mask_unhandled_exceptions = False
     ssl_verify = True
+    _transport = None
+    cache = None
+    rate_limiter = None
+    error_classifier = None
+    instrumentation = None
+    token_index = None
+    coalescer = None
+    single_flight = None
+    circuit_breaker = None
+    signed_request_cache_size = 0
+    _signed_request_verifier = None
 
     def __init__(self,
+                 signed_request_cache_size=0,
                  mask_unhandled_exceptions=False,
                  oauth_token_redirect_uri=None,
+                 error_classifier=None,
+                 instrumentation=None,
                  oauth_code_redirect_uri=None,
                  fb_grap_api_version=None,
                  debug_error=False,
                  app_domain=None,
                  app_secret=None,
+                 rate_limiter=None,
                  ssl_verify=True,
+                 transport=None,
+                 token_index=None,
+                 coalescer=None,
+                 single_flight=None,
+                 circuit_breaker=None,
                  app_scope=None,
                  app_id=None,
+                 cache=None,
                  ):
-        """Initialize the FacebookHub object with some variables.  app_id and app_secret are required."""
+        """Initialize the FacebookHub object with some variables.  app_id and app_secret are required.
+
+        `transport` is a `FacebookTransport` (or compatible object); if not provided, a new one with the default pool settings is created on first use, so hubs which never go to the network don't import `requests`.  Share one transport between hubs to share the connection pool.
+        `cache` is an optional `ResponseCache`, used for json GET requests.
+        `rate_limiter` is an optional `RateLimiter`; share one between every hub in a process so they pace against the same budget.
+        `error_classifier` maps error responses to `ApiError` subclasses; defaults to `default_error_classifier`.
+        `instrumentation` is an optional `Instrumentation`, which records every Graph call (endpoint, status, error, bytes, timings, retries, cache outcome) for its sinks.
+        `token_index` is an optional `TokenStateIndex`; calls with a token it knows to be expired or invalid fail locally, with the same exception class, instead of going to Facebook.
+        `coalescer` is an optional `BatchCoalescer`, which sends concurrent json GET requests together as batch requests.
+        `single_flight` is an optional `SingleFlight`; GET requests for a url which is already being requested wait for that request and share its result (or exception), instead of going to Facebook again.
+        `circuit_breaker` is an optional `CircuitBreaker`; while Graph is failing for a class of endpoints, calls to them raise `ApiCircuitOpenError` at once, instead of waiting for a timeout.
+        `signed_request_cache_size` is the number of recently verified signed requests `verify_signed_request` remembers.
+        """
         if app_id is None or app_secret is None:
             raise ValueError("Must initialize FacebookHub() with an app_id and an app_secret")
 
@@ -67,6 +111,31 @@ class FacebookHub(object):
         self.ssl_verify = ssl_verify
         self.app_scope = app_scope
         self.app_id = app_id
+        self._transport = transport
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        if error_classifier is None:
+            error_classifier = default_error_classifier
+        self.error_classifier = error_classifier
+        self.instrumentation = instrumentation
+        self.token_index = token_index
+        self.coalescer = coalescer
+        self.single_flight = single_flight
+        self.circuit_breaker = circuit_breaker
+        self.signed_request_cache_size = signed_request_cache_size
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            with _transport_lock:
+                if self._transport is None:
+                    from facebook_transport import FacebookTransport
+                    self._transport = FacebookTransport()
+        return self._transport
+
+    @transport.setter
+    def transport(self, transport):
+        self._transport = transport
 
     def oauth_code__url_dialog(self, redirect_uri=None, scope=None):
         """Generates the URL for an oAuth dialog to facebook for a "code" flow.  This flow will return the user to your website with a 'code' object in a query param. """
@@ -96,27 +165,221 @@ class FacebookHub(object):
                                                             app_id=self.app_id,
                                                             redirect_uri=redirect_uri,
                                                             app_secret=self.app_secret,
-                                                            code=submitted_code,
+                                                            submitted_code=submitted_code,
                                                             )
 
+    def _access_token_for(self, url, post_data=None):
+        """the access token a request is made with, from the post data or the url"""
+        if post_data and isinstance(post_data, types.DictType) and post_data.get('access_token'):
+            return post_data['access_token']
+        return url_access_token(url)
+
+    def _observe_token_error(self, url, post_data, error):
+        """records a token that Facebook rejected in the `token_index`, if any"""
+        if (self.token_index is not None) and isinstance(error, ApiAuthError):
+            self.token_index.mark_bad(self._access_token_for(url, post_data), error)
+
+    def _observe_token_expires(self, response):
+        """records the expiry of the token in an oauth response (`expires` or `expires_in` seconds) in the `token_index`, if any"""
+        if self.token_index is None:
+            return
+        (access_token, expires) = (response.get('access_token'), response.get('expires') or response.get('expires_in'))
+        if isinstance(access_token, types.ListType):
+            access_token = access_token[-1]
+        if isinstance(expires, types.ListType):
+            expires = expires[-1]
+        if access_token and expires and unicode(expires).isdigit():
+            self.token_index.set_expires(access_token, time.time() + int(expires))
+
+    def _response_retry_after(self, response):
+        """seconds Facebook asked us to wait before retrying, from `Retry-After` or the business use case usage header"""
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        (app_utilization, token_utilization, regain) = RateLimiter.parse_headers(response.headers)
+        return regain
+
+    @with_deadline
     def api_proxy(self, url, post_data=None, expected_format='json.load', is_delete=False, ssl_verify=None):
+        """Requests `url` from Facebook and decodes the response according to `expected_format`; raises an `ApiError` (subclass) on errors.
+
+        If the transport has a `retry_policy`, transient errors are retried according to it.
+        With a `coalescer`, json GET requests may be sent as part of a batch request.
+        With `single_flight`, GET requests identical to one in flight share its outcome.
+        """
+        if (self.single_flight is not None) and not post_data:
+            return self.single_flight.do(self._single_flight_key(url, expected_format, ssl_verify),
+                                         self._api_proxy_call, url, post_data, expected_format, is_delete, ssl_verify)
+        return self._api_proxy_call(url, post_data, expected_format, is_delete, ssl_verify)
+
+    def _single_flight_key(self, url, expected_format, ssl_verify):
+        if ssl_verify is None:
+            ssl_verify = self.ssl_verify
+        return (url_normalized(url), expected_format, bool(ssl_verify))
+
+    def _api_proxy_call(self, url, post_data, expected_format, is_delete, ssl_verify):
+        """`api_proxy`, past the `single_flight` check"""
+        if (self.coalescer is not None) and self.coalescer.accepts(self, url, post_data, expected_format):
+            return self.coalescer.call(self, url, ssl_verify)
+        return self._instrumented(self._api_proxy, url, post_data, is_delete, expected_format, ssl_verify)
+
+    def _instrumented(self, fn, url, post_data, is_delete, *args):
+        """runs `fn(url, post_data, ..., is_delete, ..., call)` for `api_proxy` and `api_proxy_stream`, applying the retry policy and recording the call"""
+        if not post_data:
+            method = 'GET'
+        elif is_delete:
+            method = 'DELETE'
+        else:
+            method = 'POST'
+        call = None
+        if self.instrumentation is not None:
+            call = self.instrumentation.begin(method, url)
+        args = (url, post_data, is_delete) + args + (call, )
+        try:
+            retry_policy = getattr(self.transport, 'retry_policy', None)
+            if retry_policy is None:
+                result = fn(*args)
+            else:
+                result = retry_policy.call(fn, method, *args)
+        except Exception as e:
+            if call is not None:
+                self.instrumentation.finish(call, error=e)
+            raise
+        if call is not None:
+            self.instrumentation.finish(call)
+        return result
+
+    def _send(self, method, url, post_data=None, headers=None, ssl_verify=True, stream=False, call=None):
+        """sends one request over the transport, pacing it with the rate limiter (if any); returns the response.
+
+        `call` is the `GraphCall` being instrumented, if any; the request is traced into it.
+        Under a `Deadline`, the request's timeouts are capped to the time left, and `ApiTimeoutError` is raised once it is spent.
+        """
+        if (self.token_index is not None) or (self.rate_limiter is not None):
+            access_token = self._access_token_for(url, post_data)
+        if self.token_index is not None:
+            self.token_index.check(access_token)
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check()
+        if self.rate_limiter is not None:
+            # don't sleep past the deadline waiting for a slot
+            self.rate_limiter.acquire(access_token, max_wait=deadline.remaining() if deadline is not None else None)
+        kwargs = {'data': post_data or None,
+                  'headers': headers,
+                  'verify': ssl_verify,
+                  'stream': stream,
+                  }
+        if deadline is not None:
+            deadline.check()
+            kwargs['timeout'] = deadline.timeout(getattr(self.transport, 'timeout', None))
+        if self.circuit_breaker is not None:
+            endpoint_class = url_endpoint_class(url, method)
+            is_probe = self.circuit_breaker.before(endpoint_class)
+            started = time.time()
+        if call is not None:
+            kwargs['trace'] = trace = {}
+        try:
+            response = self.transport.request(method, url, **kwargs)
+        except Exception as e:
+            if call is not None:
+                call.observe(trace)
+            timed_out = (deadline is not None) and deadline.expired() and isinstance(e, IOError)
+            if self.circuit_breaker is not None:
+                if timed_out:
+                    # running out of our own budget says nothing about Graph
+                    self.circuit_breaker.release(endpoint_class, is_probe=is_probe)
+                else:
+                    self.circuit_breaker.record(endpoint_class, time.time() - started, error=e, is_probe=is_probe)
+            if timed_out:
+                raise ApiTimeoutError(message='The deadline for this call passed', raised=e)
+            raise
+        if call is not None:
+            call.observe(trace, status=response.status_code)
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(endpoint_class, time.time() - started, status=response.status_code, is_probe=is_probe)
+        if self.rate_limiter is not None:
+            self.rate_limiter.observe(response.headers, access_token)
+        return response
+
+    @with_deadline
+    def api_proxy_stream(self, url, post_data=None, is_delete=False, ssl_verify=None, chunk_size=None):
+        """Like `api_proxy` for json responses, but returns a `GraphStream` which decodes the body while it downloads.
+
+        Iterate it for the elements of a batch response (`LazyBatchItem`s, whose 'body' is only decoded when read), or for the items of the `data` array of an edge page; afterwards, its `envelope` has the page's `paging`.
+        Error responses raise the same `ApiError` subclasses as `api_proxy`.  The response cache is not used, and retries (if configured) only cover opening the response.
+        """
+        return self._instrumented(self._api_proxy_stream, url, post_data, is_delete, ssl_verify, chunk_size)
+
+    def _api_proxy_stream(self, url, post_data, is_delete, ssl_verify, chunk_size, call=None):
+        """a single attempt of `api_proxy_stream`"""
+        if ssl_verify is None:
+            ssl_verify = self.ssl_verify
+        is_batch = False
+        method = 'GET'
+        if post_data:
+            if 'batch' in post_data:
+                is_batch = True
+                if isinstance(post_data['batch'], types.ListType):
+                    post_data['batch'] = json.dumps(post_data['batch'])
+            if is_delete:
+                method = 'DELETE'
+            else:
+                method = 'POST'
+        try:
+            response = self._send(method, url, post_data=post_data, ssl_verify=ssl_verify, stream=True, call=call)
+        except Exception as e:
+            if self.mask_unhandled_exceptions:
+                raise ApiUnhandledError(raised=e)
+            raise
+        if response.status_code != 200:
+            try:
+                e = self.error_classifier.exception_for_response(response.status_code, response.text)
+            finally:
+                response.close()
+            e.http_status = response.status_code
+            e.retry_after = self._response_retry_after(response)
+            self._observe_token_error(url, post_data, e)
+            if self.mask_unhandled_exceptions:
+                raise ApiUnhandledError(raised=e)
+            raise e
+        return GraphStream(response, batch=is_batch, chunk_size=chunk_size)
+
+    def _api_proxy(self, url, post_data, is_delete, expected_format, ssl_verify, call=None):
+        """a single attempt of `api_proxy`"""
         response = None
         response_content = None
+        cache_entry = None
         if ssl_verify is None:
             ssl_verify = self.ssl_verify
         try:
+            method = 'GET'
+            headers = None
             if not post_data:
                 # normal get
-                response = requests.get(url, verify=ssl_verify)
+                if (self.cache is not None) and (expected_format in ('json.load', 'json.loads')):
+                    (cache_entry, is_fresh) = self.cache.lookup(url)
+                    if call is not None:
+                        call.cache = 'hit' if is_fresh else 'miss'
+                    if is_fresh:
+                        return self.cache.content(cache_entry)
+                    if (cache_entry is not None) and cache_entry.get('etag'):
+                        headers = {'If-None-Match': cache_entry['etag']}
             else:
                 if post_data:
                     if 'batch' in post_data:
                         if isinstance(post_data['batch'], types.ListType):
                             post_data['batch'] = json.dumps(post_data['batch'])
                 if is_delete:
-                    response = requests.delete(url, data=post_data, verify=ssl_verify)
+                    method = 'DELETE'
                 else:
-                    response = requests.post(url, data=post_data, verify=ssl_verify)
+                    method = 'POST'
+            response = self._send(method, url, post_data=post_data, headers=headers, ssl_verify=ssl_verify, call=call)
+            if (response.status_code == 304) and (cache_entry is not None):
+                if call is not None:
+                    call.cache = 'revalidated'
+                self.cache.revalidated(url, cache_entry)
+                return self.cache.content(cache_entry)
             response_content = response.text
             if response.status_code == 200:
                 if expected_format in ('json.load', 'json.loads'):
@@ -126,6 +389,9 @@ class FacebookHub(object):
                             raise ApiResponseError(message="Batched Graph request expects a list of dicts. Did not get a list.",
                                                    response=response_content)
                         for li in response_content:
+                            if li is None:
+                                # Graph returns null for an operation which didn't complete
+                                continue
                             if not isinstance(li, types.DictType):
                                 raise ApiResponseError(message="Batched Graph request expects a list of dicts. Got a list, element not a dict.",
                                                        response=response_content)
@@ -134,9 +400,16 @@ class FacebookHub(object):
                                                        response=response_content)
                             # the body is a json encoded string itself.  it was previously escaped, so unescape it!
                             li['body'] = json.loads(li['body'])
+                    elif (self.cache is not None) and not post_data:
+                        self.cache.store(url,
+                                         response_content,
+                                         etag=response.headers.get('ETag'),
+                                         size=len(response.text),
+                                         )
 
                 elif expected_format == 'cgi.parse_qs':
-                    response_content = cgi.parse_qs(response_content)
+                    # `cgi.parse_qs` is a deprecated alias of `urlparse.parse_qs`; importing `cgi` is slow
+                    response_content = urlparse.parse_qs(response_content)
                 elif expected_format == 'urlparse.parse_qs':
                     response_content = urlparse.parse_qs(response_content)
                 else:
@@ -145,61 +418,24 @@ class FacebookHub(object):
                 if DEBUG:
                     print response
                     print response.__dict__
-                if response.status_code == 400:
-                    rval = ''
-                    try:
-                        rval = json.loads(response_content)
-                        if 'error' in rval:
-                            error = reformat_error(rval['error'])
-                            if ('code' in error) and error['code']:
-                                if error['code'] == 1:
-                                    # Error validating client secret
-                                    raise ApiApplicationError(**error)
-                                elif error['code'] == 101:
-                                    # Error validating application. Invalid application ID
-                                    raise ApiApplicationError(**error)
-                                elif error['code'] == 100:
-                                    if ('type' in error) and error['type']:
-                                        if error['type'] == 'GraphMethodException':
-                                            raise ApiRuntimeGraphMethodError(**error)
-
-                                    if ('message' in error) and error['message']:
-                                        if error['message'][:32] == 'Invalid verification code format':
-                                            raise ApiRuntimeVerirficationFormatError(**error)
-                                        elif error['message'][:19] == 'Invalid grant_type:':
-                                            raise ApiRuntimeGrantError(**error)
-                                        elif error['message'][:18] == 'Unsupported scope:':
-                                            raise ApiRuntimeScopeError(**error)
-                                        elif error['message'][:18] == 'Unsupported scope:':
-                                            raise ApiRuntimeScopeError(**error)
-
-                                elif error['code'] == 104:
-                                    raise ApiAuthError(**error)
-
-                            if ('message' in error) and error['message']:
-                                if error['message'][:63] == 'Error validating access token: Session has expired at unix time':
-                                    raise ApiAuthExpiredError(**error)
-                                elif error['message'][:26] == 'Invalid OAuth access token':
-                                    raise ApiAuthError(**error)
-                                elif error['message'][:29] == 'Error validating access token':
-                                    raise ApiAuthError(**error)
-                            if ('type' in error) and (error['type'] == 'OAuthException'):
-                                raise ApiAuthError(**error)
-                            raise ApiError(**error)
-                        raise ApiError(message = 'I don\'t know how to handle this error (%s)' % rval, code=400)
-                    except json.JSONDecodeError, e:
-                        raise ApiError(message = 'Could not parse JSON from the error (%s)' % rval, code=400, raised=e)
-                    except:
-                        raise
-                raise ApiError(message = 'Could not communicate with the API', code=response.status_code)
+                raise self.error_classifier.exception_for_response(response.status_code, response_content)
             return response_content
-        except json.JSONDecodeError, e:
+        except JSONDecodeError, e:
             raise ApiError(message = 'Could not parse JSON from the error (%s)' % e, raised=e)
+        except ApiError as e:
+            if response is not None:
+                e.http_status = response.status_code
+                e.retry_after = self._response_retry_after(response)
+                self._observe_token_error(url, post_data, e)
+            if self.mask_unhandled_exceptions:
+                raise ApiUnhandledError(raised=e)
+            raise
         except Exception as e:
             if self.mask_unhandled_exceptions:
                 raise ApiUnhandledError(raised=e)
             raise
 
+    @with_deadline
     def oauth_code__get_access_token(self, submitted_code=None, redirect_uri=None, scope=None):
         """Gets the access token from Facebook that corresponds with a code.  This uses `requests` to open the url, so should be considered as blocking code."""
         if submitted_code is None:
@@ -218,10 +454,12 @@ class FacebookHub(object):
             if 'access_token' not in response:
                 raise ApiError(message='invalid response')
             access_token = response["access_token"][-1]
+            self._observe_token_expires(response)
         except:
             raise
         return access_token
 
+    @with_deadline
     def oauth_code__get_access_token_and_profile(self, submitted_code=None, redirect_uri=None, scope=None):
         """Gets the access token AND a profile from Facebook that corresponds with a code.  This method wraps a call to `oauth_code__get_access_token`, then wraps `graph__get_profile_for_access_token` which opens a json object at the url returned by `graph__url_me_for_access_token`.  This is a convenince method, since most people want to do that (at least on the initial Facebook auth.  This wraps methods which use `requests` to open urls, so should be considered as blocking code."""
         if submitted_code is None:
@@ -273,17 +511,57 @@ class FacebookHub(object):
             access_token=access_token
         )
 
+    @with_deadline
     def graph__extend_access_token(self, access_token=None):
         """ see oauth__url_extend_access_token  """
         if access_token is None or not access_token:
             raise ValueError('must submit access_token')
+        if self.token_index is not None:
+            # the token is sent as `fb_exchange_token`, which `api_proxy` doesn't look at
+            try:
+                self.token_index.check(access_token)
+            except ApiError as e:
+                if self.mask_unhandled_exceptions:
+                    raise ApiUnhandledError(raised=e)
+                raise
         try:
             url = self.oauth__url_extend_access_token(access_token=access_token)
             response = self.api_proxy(url, expected_format='urlparse.parse_qs')
-        except:
+        except ApiAuthError as e:
+            if self.token_index is not None:
+                self.token_index.mark_bad(access_token, e)
             raise
+        self._observe_token_expires(response)
         return response
 
+    @with_deadline
+    def graph__debug_token(self, input_token=None, access_token=None):
+        """Inspects `input_token` with Facebook's `debug_token` endpoint, and returns its `data` (`is_valid`, `expires_at`, `scopes`, ...).
+
+        `access_token` defaults to the app token (`app_id|app_secret`).
+        The token's expiry (or invalidity) is recorded in the `token_index`, if any.
+        This uses `requests` to open the url, so should be considered as blocking code."""
+        if not input_token:
+            raise ValueError('must submit input_token')
+        if access_token is None:
+            access_token = u'%s|%s' % (self.app_id, self.app_secret)
+        url = FacebookApiUrls.graph__url_debug_token(fb_graph_api=self.fb_graph_api,
+                                                     input_token=input_token,
+                                                     access_token=access_token,
+                                                     )
+        data = self.api_proxy(url, expected_format='json.load').get('data') or {}
+        if self.token_index is not None:
+            if data.get('is_valid') is False:
+                error = data.get('error') or {}
+                self.token_index.mark_bad(input_token, ApiAuthError(code=error.get('code', 190),
+                                                                    subcode=error.get('subcode'),
+                                                                    type='OAuthException',
+                                                                    message=error.get('message', 'Invalid OAuth access token.'),
+                                                                    ))
+            elif data.get('expires_at'):
+                self.token_index.set_expires(input_token, data['expires_at'])
+        return data
+
     def graph__url_me(self, access_token):
         raise ValueError('Deprecated; call graph__url_me_for_access_token instead')
 
@@ -316,8 +594,11 @@ class FacebookHub(object):
             action=None
         )
 
-    def graph__get_profile_for_access_token(self, access_token=None, user=None, action=None):
-        """Grabs a profile for a user, corresponding to a profile, from Facebook.  This uses `requests` to open the url, so should be considered as blocking code."""
+    @with_deadline
+    def graph__get_profile_for_access_token(self, access_token=None, user=None, action=None, query=None):
+        """Grabs a profile for a user, corresponding to a profile, from Facebook.  This uses `requests` to open the url, so should be considered as blocking code.
+
+        `query` is an optional `GraphQuery`, whose fields and modifiers are added to the request (its path is ignored)."""
         if access_token is None:
             raise ValueError('must submit access_token')
         profile = None
@@ -335,17 +616,306 @@ class FacebookHub(object):
                                                             user=user,
                                                             action=action
                                                             )
+            url = self._url_with_query(url, query)
             profile = self.api_proxy(url, expected_format='json.load')
         except:
             raise
         return profile
 
+    def _url_with_query(self, url, query):
+        """appends the parameters of a `GraphQuery` to a url"""
+        if query is None:
+            return url
+        querystring = query.querystring()
+        if not querystring:
+            return url
+        return u'{url}{sep}{querystring}'.format(url=url,
+                                                 sep='&' if '?' in url else '?',
+                                                 querystring=querystring,
+                                                 )
+
+    @with_deadline
+    def graph__query(self, access_token=None, query=None):
+        """Runs a `GraphQuery`, so that one request can fetch an object together with the (nested) edges and fields you need.  This uses `requests` to open the url, so should be considered as blocking code."""
+        if access_token is None:
+            raise ValueError('must submit access_token')
+        if query is None:
+            raise ValueError('must submit query')
+        url = query.url(self.fb_graph_api, access_token)
+        return self.api_proxy(url, expected_format='json.load')
+
+    @with_deadline
+    def graph__iter_url(self, url, max_items=None, prefetch=False, stream=False):
+        """Yields the `data` items of a paginated Graph url one at a time, following `paging.next` lazily, so a crawl runs in constant memory.
+
+        `max_items` stops the iteration after that many items.
+        If `prefetch` is True, the next page is requested in the background while the caller works through the current one.
+        If `stream` is True, each page is decoded while it downloads (see `api_proxy_stream`), so items are yielded before the page is complete; this can't be combined with `prefetch`.
+        This uses `requests` to open the url, so should be considered as blocking code."""
+        if stream:
+            if prefetch:
+                raise ValueError('can not combine stream and prefetch')
+            for item in self._iter_url_stream(url, max_items=max_items):
+                yield item
+            return
+        executor = None
+        if prefetch:
+            executor = BoundedExecutor(max_workers=1)
+        count = 0
+        try:
+            page = self.api_proxy(url, expected_format='json.load')
+            while True:
+                items = page.get('data') or []
+                next_url = (page.get('paging') or {}).get('next')
+                if not items:
+                    next_url = None
+                if max_items is not None and count + len(items) >= max_items:
+                    items = items[:max_items - count]
+                    next_url = None
+                next_page = None
+                if next_url and executor is not None:
+                    next_page = executor.submit(self.api_proxy, next_url, expected_format='json.load')
+                for item in items:
+                    yield item
+                count += len(items)
+                if not next_url:
+                    return
+                if next_page is not None:
+                    page = next_page.result()
+                else:
+                    page = self.api_proxy(next_url, expected_format='json.load')
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def _iter_url_stream(self, url, max_items=None):
+        count = 0
+        while url:
+            page = self.api_proxy_stream(url)
+            items = 0
+            for item in page:
+                yield item
+                count += 1
+                items += 1
+                if max_items is not None and count >= max_items:
+                    return
+            if not items:
+                return
+            url = ((page.envelope or {}).get('paging') or {}).get('next')
+
+    @with_deadline
+    def graph__iter_edge(self, access_token=None, edge=None, user=None, page_size=None, max_items=None, prefetch=False, query=None, stream=False):
+        """Yields the items of a user's `edge` (e.g. 'friends', or an 'app_namespace:action') one at a time; see `graph__iter_url`.
+
+        `user` defaults to 'me'.  `page_size` is sent to Facebook as the `limit` of each page.
+        `query` is an optional `GraphQuery` for the fields (and modifiers) of the edge's items.
+        This uses `requests` to open the url, so should be considered as blocking code."""
+        if access_token is None:
+            raise ValueError('must submit access_token')
+        if edge is None:
+            raise ValueError('must submit edge')
+        url = self.graph__url_user_for_access_token(access_token,
+                                                    user=user or 'me',
+                                                    action=edge,
+                                                    )
+        if page_size:
+            url = u'{url}&limit={page_size}'.format(url=url, page_size=int(page_size))
+        url = self._url_with_query(url, query)
+        return self.graph__iter_url(url, max_items=max_items, prefetch=prefetch, stream=stream)
+
+    @with_deadline
+    def graph__batch(self, access_token=None, operations=None, chunk_size=None, concurrency=4):
+        """Runs any number of Graph batch `operations` (dicts of `method`, `relative_url`, ...).
+
+        The operations are split into chunks of at most `chunk_size` (Graph allows FB_BATCH_MAX_OPERATIONS per batch), the chunks are sent over at most `concurrency` threads, and the (body-decoded) results are returned as one list in the original order.
+        The list is a `BatchResult`: its `results` map each failed item to an `ApiError` subclass, and `retry()` resubmits only the retryable failures.
+        This uses `requests` to open the url, so should be considered as blocking code."""
+        if access_token is None:
+            raise ValueError('must submit access_token')
+        if operations is None:
+            raise ValueError('must submit operations')
+        if chunk_size is None:
+            chunk_size = FB_BATCH_MAX_OPERATIONS
+        if not 0 < chunk_size <= FB_BATCH_MAX_OPERATIONS:
+            raise ValueError('chunk_size must be between 1 and %s' % FB_BATCH_MAX_OPERATIONS)
+
+        operations = list(operations)
+        chunks = [operations[i:i + chunk_size] for i in range(0, len(operations), chunk_size)]
+
+        def _batch(chunk):
+            post_data = {'access_token': access_token,
+                         'batch': chunk,
+                         }
+            return self.api_proxy(self.fb_graph_api, post_data=post_data, expected_format='json.load')
+
+        items = []
+        for payload in map_bounded(_batch, chunks, concurrency):
+            items.extend(payload)
+        return BatchResult(items,
+                           operations,
+                           hub=self,
+                           access_token=access_token,
+                           chunk_size=chunk_size,
+                           concurrency=concurrency,
+                           )
+
+    def _graph__batch_with_retry(self, access_token, operations, chunk_size, concurrency, max_attempts):
+        """runs batch `operations`, resubmitting only the retryable failures; returns a result (decoded body or `ApiError`) per operation"""
+        batch = self.graph__batch(access_token, operations, chunk_size=chunk_size, concurrency=concurrency)
+        return batch.retry(max_attempts=max_attempts).results
+
+    @with_deadline
+    def graph__action_create_many(self, access_token=None, actions=None, chunk_size=None, concurrency=4, max_attempts=3):
+        """Publishes many Open Graph actions with batch requests, instead of one request per action.
+
+        `actions` is a list of dicts with the arguments of `graph__action_create`: `fb_app_namespace`, `fb_action_type_name`, `object_type_name` and `object_instance_url`.
+        Returns a list with a result per action, in order: the created action (`{'id': ...}`), or the `ApiError` it failed with.
+        Actions which failed with a retryable error (throttling; see `RetryPolicy`) are resubmitted, alone, up to `max_attempts` times.
+        This uses `requests` to open the url, so should be considered as blocking code."""
+        if access_token is None:
+            raise ValueError('must submit access_token')
+        if actions is None:
+            raise ValueError('must submit actions')
+        operations = []
+        for action in actions:
+            if not all((action.get('fb_app_namespace'), action.get('fb_action_type_name'))):
+                raise ValueError('must submit fb_app_namespace, fb_action_type_name')
+            if not all((action.get('object_type_name'), action.get('object_instance_url'))):
+                raise ValueError('must submit object_type_name, object_instance_url')
+            url = FacebookApiUrls.graph__action_create_url(fb_graph_api='',
+                                                           fb_app_namespace=action['fb_app_namespace'],
+                                                           fb_action_type_name=action['fb_action_type_name'],
+                                                           )
+            operations.append({'method': 'POST',
+                               'relative_url': url.lstrip('/'),
+                               'body': urllib.urlencode({action['object_type_name']: action['object_instance_url']}),
+                               })
+        return self._graph__batch_with_retry(access_token, operations, chunk_size, concurrency, max_attempts)
+
+    @with_deadline
+    def graph__action_delete_many(self, access_token=None, action_ids=None, chunk_size=None, concurrency=4, max_attempts=3):
+        """Deletes many Open Graph actions with batch requests, instead of one request per action.
+
+        Returns a list with a result per action id, in order: Facebook's response, or the `ApiError` the delete failed with.
+        Deletes which failed with a retryable error (see `RetryPolicy`) are resubmitted, alone, up to `max_attempts` times.
+        This uses `requests` to open the url, so should be considered as blocking code."""
+        if access_token is None:
+            raise ValueError('must submit access_token')
+        if action_ids is None:
+            raise ValueError('must submit action_ids')
+        operations = []
+        for action_id in action_ids:
+            url = FacebookApiUrls.graph__action_delete_url(fb_graph_api='',
+                                                           action_id=action_id,
+                                                           )
+            operations.append({'method': 'DELETE',
+                               'relative_url': url.lstrip('/'),
+                               })
+        return self._graph__batch_with_retry(access_token, operations, chunk_size, concurrency, max_attempts)
+
+    @with_deadline
+    def graph__get_objects(self, access_token=None, ids=None, fields=None, chunk_size=None, concurrency=4):
+        """Fetches many objects by id, using `?ids=` requests of at most `chunk_size` ids (Graph allows FB_IDS_MAX), run over at most `concurrency` threads.
+
+        `fields` is a list or comma-separated string of fields to request, or a `GraphQuery` whose fields are used.
+        Returns a tuple of `(objects, errors)`: dicts keyed by id, of the objects and of the `ApiError` each failed id raised.
+        A request that fails because of a bad id (Graph code 100, or 803 for ids which don't exist) is split until the bad ids are isolated; other errors (auth, throttling, ...) are reported for every id of the request.
+        This uses `requests` to open the url, so should be considered as blocking code."""
+        if access_token is None:
+            raise ValueError('must submit access_token')
+        if ids is None:
+            raise ValueError('must submit ids')
+        if chunk_size is None:
+            chunk_size = FB_IDS_MAX
+        if not 0 < chunk_size <= FB_IDS_MAX:
+            raise ValueError('chunk_size must be between 1 and %s' % FB_IDS_MAX)
+        if isinstance(fields, GraphQuery):
+            fields = fields.field_list()
+        elif fields and not isinstance(fields, types.StringTypes):
+            fields = u','.join(fields)
+
+        ids = list(collections.OrderedDict.fromkeys(unicode(i) for i in ids))
+        chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+        def _fetch(chunk):
+            url = FacebookApiUrls.graph__url_objects_for_access_token(fb_graph_api=self.fb_graph_api,
+                                                                      access_token=access_token,
+                                                                      ids=chunk,
+                                                                      fields=fields,
+                                                                      )
+            try:
+                payload = self.api_proxy(url, expected_format='json.load')
+            except ApiError as e:
+                if (e.code not in (100, 803)) or (len(chunk) == 1):
+                    return ({}, dict((i, e) for i in chunk))
+                # one of the ids is bad; bisect to find it
+                middle = len(chunk) // 2
+                (objects, errors) = _fetch(chunk[:middle])
+                (objects_b, errors_b) = _fetch(chunk[middle:])
+                objects.update(objects_b)
+                errors.update(errors_b)
+                return (objects, errors)
+            (objects, errors) = ({}, {})
+            for i in chunk:
+                if isinstance(payload, types.DictType) and (i in payload):
+                    objects[i] = payload[i]
+                else:
+                    errors[i] = ApiResponseError(message='id %s missing from the response' % i, response=payload)
+            return (objects, errors)
+
+        (objects, errors) = ({}, {})
+        for (chunk_objects, chunk_errors) in map_bounded(_fetch, chunks, concurrency):
+            objects.update(chunk_objects)
+            errors.update(chunk_errors)
+        return (objects, errors)
+
+    @with_deadline
+    def map_tokens(self, fn, access_tokens, concurrency=10):
+        """Fans a per-token call out over many access tokens, yielding `(access_token, result)` pairs as the calls complete (not in order).
+
+        `fn` is called as `fn(access_token)`, or is the name of a hub method which is called with `access_token=`.
+        A call which fails yields the `ApiError` it raised as its result (other exceptions are wrapped in an `ApiUnhandledError`), so one bad token never aborts the run.
+        Calls run on at most `concurrency` threads, and `access_tokens` (a list or any iterable) is consumed lazily, so hundreds of thousands of tokens stream through in constant memory.  Every call still goes through the hub's rate limiter, if any, which paces the workers when the app or a token nears its budget.
+        This uses `requests` to open the urls, so should be considered as blocking code."""
+        if isinstance(fn, basestring):
+            method = getattr(self, fn)
+            fn = lambda access_token: method(access_token=access_token)
+
+        def _call(access_token):
+            try:
+                return fn(access_token)
+            except ApiError as e:
+                return e
+            except Exception as e:
+                return ApiUnhandledError(raised=e)
+
+        for (access_token, future) in imap_unordered(_call, access_tokens, concurrency):
+            yield (access_token, future.result())
+
+    @with_deadline
+    def graph__get_profiles_for_access_tokens(self, access_tokens=None, concurrency=10, query=None):
+        """`graph__get_profile_for_access_token` for many tokens; see `map_tokens`"""
+        if access_tokens is None:
+            raise ValueError('must submit access_tokens')
+        return self.map_tokens(lambda access_token: self.graph__get_profile_for_access_token(access_token=access_token, query=query),
+                               access_tokens,
+                               concurrency=concurrency,
+                               )
+
+    @with_deadline
+    def graph__extend_access_tokens(self, access_tokens=None, concurrency=10):
+        """`graph__extend_access_token` for many tokens; see `map_tokens`"""
+        if access_tokens is None:
+            raise ValueError('must submit access_tokens')
+        return self.map_tokens('graph__extend_access_token', access_tokens, concurrency=concurrency)
+
     def graph__get_profile(
         self,
         access_token=None
     ):
         raise ValueError('Deprecated; call graph__get_profile_for_access_token instead')
 
+    @with_deadline
     def graph__action_create(
         self,
         access_token=None,
@@ -373,6 +943,7 @@ class FacebookHub(object):
         except:
             raise
 
+    @with_deadline
     def graph__action_list(
         self,
         access_token=None,
@@ -393,6 +964,7 @@ class FacebookHub(object):
         except:
             raise
 
+    @with_deadline
     def graph__action_delete(self, access_token=None, action_id=None):
         if not all((access_token, action_id)):
             raise ValueError('must submit action_id')
@@ -436,95 +1008,18 @@ class FacebookHub(object):
 
         after starting this, i found someone already did the hard work.
         following is based on Sunil Arora's blog post - http://sunilarora.org/parsing-signedrequest-parameter-in-python-bas
+
+        the work is done by `self.signed_request_verifier`; see `SignedRequestVerifier`
         """
         if signed_request is None:
             raise ValueError('must submit signed_request')
-
-        def base64_url_decode(inp):
-            padding_factor = (4 - len(inp) % 4) % 4
-            inp += "=" * padding_factor
-            return base64.b64decode(unicode(inp).translate(dict(zip(map(ord, u'-_'), u'+/'))))
-
-        (signature, payload) = signed_request.split('.')
-
-        decoded_signature = base64_url_decode(signature)
-        data = json.loads(base64_url_decode(payload))
-
-        if data.get('algorithm').upper() != 'HMAC-SHA256':
-            return (False, {'python-error': 'Unknown algorithm - %s' % data.get('algorithm').upper()})
-
-        expected_sig = hmac.new(self.app_secret, msg=payload, digestmod=hashlib.sha256).digest()
-
-        if decoded_signature != expected_sig:
-            return (None, {'python-error': 'signature (%s) != expected_sig (%s)' % (decoded_signature, expected_sig)})
-
-        if timeout:
-            time_now = int(time())
-            diff = time_now - data['issued_at']
-            if (diff > timeout):
-                data['python-error'] = "payload issued outside of timeout window"
-                return (False, data)
-
-        return (True, data)
-
-
-class FacebookPyramid(FacebookHub):
-
-    def __init__(
-        self,
-        request,
-        oauth_token_redirect_uri=None,
-        oauth_code_redirect_uri=None,
-        fb_graph_api_version=None,
-        app_secret=None,
-        app_domain=None,
-        ssl_verify=None,
-        app_scope=None,
-        app_id=None
-    ):
-        """Creates a new FacebookHub object, sets it up with Pyramid Config vars, and then proxies other functions into it"""
-        self.request = request
-
-        if fb_graph_api_version is None and 'facebook.graph_api_version' in request.registry.settings:
-            fb_graph_api_version = request.registry.settings['facebook.graph_api_version']
-
-        if app_id is None and 'facebook.app.id' in request.registry.settings:
-            app_id = request.registry.settings['facebook.app.id']
-        if app_secret is None and 'facebook.app.secret' in request.registry.settings:
-            app_secret = request.registry.settings['facebook.app.secret']
-        if app_scope is None and 'facebook.app.scope' in request.registry.settings:
-            app_scope = request.registry.settings['facebook.app.scope']
-        if app_domain is None:
-            app_domain = request.registry.settings['app_domain']
-        if oauth_code_redirect_uri is None and 'facebook.app.oauth_code_redirect_uri' in request.registry.settings:
-            oauth_code_redirect_uri = request.registry.settings['facebook.app.oauth_code_redirect_uri']
-        if oauth_token_redirect_uri is None and 'facebook.app.oauth_token_redirect_uri' in request.registry.settings:
-            oauth_token_redirect_uri = request.registry.settings['facebook.app.oauth_token_redirect_uri']
-        if ssl_verify is None and 'facebook.app.ssl_verify' in request.registry.settings:
-            ssl_verify = request.registry.settings['facebook.app.ssl_verify']
-
-        FacebookHub.__init__(self,
-                             app_id=app_id,
-                             app_secret=app_secret,
-                             app_scope=app_scope,
-                             app_domain=app_domain,
-                             oauth_code_redirect_uri=oauth_code_redirect_uri,
-                             oauth_token_redirect_uri=oauth_token_redirect_uri,
-                             ssl_verify=ssl_verify,
-                             fb_grap_api_version=fb_graph_api_version,
-                             )
-
-    def oauth_code__url_access_token(self, submitted_code=None, redirect_uri=None, scope=None):
-        if submitted_code is None:
-            submitted_code = self.request.params.get('code')
-        return FacebookHub.oauth_code__url_access_token(self, submitted_code=submitted_code, redirect_uri=redirect_uri, scope=scope)
-
-    def oauth_code__get_access_token(self, submitted_code=None, redirect_uri=None, scope=None):
-        if submitted_code is None:
-            submitted_code = self.request.params.get('code')
-        return FacebookHub.oauth_code__get_access_token(self, submitted_code=submitted_code, redirect_uri=redirect_uri, scope=scope)
-
-    def oauth_code__get_access_token_and_profile(self, submitted_code=None, redirect_uri=None, scope=None):
-        if submitted_code is None:
-            submitted_code = self.request.params.get('code')
-        return FacebookHub.oauth_code__get_access_token_and_profile(self, submitted_code=submitted_code, redirect_uri=redirect_uri, scope=scope)
+        return self.signed_request_verifier.verify(signed_request, timeout=timeout)
+
+    @property
+    def signed_request_verifier(self):
+        """the `SignedRequestVerifier` for this app, created on first use; use its `verify_many` to check requests in bulk"""
+        if self._signed_request_verifier is None:
+            self._signed_request_verifier = SignedRequestVerifier(self.app_secret,
+                                                                  cache_size=self.signed_request_cache_size,
+                                                                  )
+        return self._signed_request_verifier
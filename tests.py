@@ -1,10 +1,77 @@
 import unittest
+import BaseHTTPServer
+import threading
+import time
 import os
 import pdb
+import subprocess
+import sys
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 import facebook_utils as fb
 
 
+class FakeResponse(object):
+    """quacks enough like a `requests.Response` for `FacebookHub.api_proxy`"""
+
+    def __init__(self, status_code=200, text='', headers=None):
+        if not isinstance(text, basestring):
+            text = json.dumps(text)
+        self.status_code = status_code
+        self.text = text
+        self.content = text
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.text), chunk_size):
+            yield self.text[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTransport(object):
+    """a `FacebookTransport` stand-in that replays canned responses and records requests"""
+
+    def __init__(self, *responses, **kwargs):
+        self.responses = list(responses)
+        self.requests = []
+        # optional `handler(request_dict)` that builds a response, for when requests run concurrently
+        self.handler = kwargs.get('handler')
+
+    def request(self, method, url, data=None, headers=None, verify=True, timeout=None, stream=False, trace=None):
+        self.requests.append({'method': method,
+                              'url': url,
+                              'data': data,
+                              'headers': headers,
+                              'timeout': timeout,
+                              })
+        if self.handler is not None:
+            response = self.handler(self.requests[-1])
+        else:
+            response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        if trace is not None:
+            trace.update({'first_byte': 0.001, 'total': 0.002, 'bytes_out': 0, 'bytes_in': len(response.text)})
+        return response
+
+
+def _newOfflineHub(*responses, **kwargs):
+    hub = fb.FacebookHub(app_id='123',
+                         app_secret='secret',
+                         app_scope='email',
+                         transport=FakeTransport(*responses),
+                         **kwargs
+                         )
+    return hub
+
+
 class TestFacebookUtils(unittest.TestCase):
     PYTHON_FB_UTILS_ACCESS_TOKEN = None
 
@@ -110,3 +177,1217 @@ class TestFacebookUtils(unittest.TestCase):
         }
         fb_data = hub.api_proxy(url="""https://graph.facebook.com""", expected_format='json.load', post_data=fb_post_data)
         self.assertTrue(fb_data)
+
+
+class TestFacebookTransport(unittest.TestCase):
+
+    def test_transport_shared_by_hub(self):
+        transport = fb.FacebookTransport(pool_maxsize=4, timeout_connect=1, timeout_read=2)
+        hub = fb.FacebookHub(app_id='123', app_secret='secret', transport=transport)
+        self.assertIs(hub.transport, transport)
+        self.assertEqual(transport.timeout, (1, 2))
+        stats = transport.stats()
+        self.assertEqual(stats['pool_maxsize'], 4)
+        self.assertEqual(stats['requests'], 0)
+        self.assertEqual(stats['pools'], [])
+
+    def test_transport_default(self):
+        hub = fb.FacebookHub(app_id='123', app_secret='secret')
+        self.assertTrue(isinstance(hub.transport, fb.FacebookTransport))
+
+    def test_api_proxy_uses_transport(self):
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1'}),
+                             FakeResponse(200, {'success': True}),
+                             )
+        self.assertEqual(hub.api_proxy('https://graph.facebook.com/me'), {'id': '1'})
+        hub.graph__action_delete(access_token='token', action_id='42')
+        self.assertEqual([r['method'] for r in hub.transport.requests], ['GET', 'DELETE'])
+
+    def test_oauth_code_access_token(self):
+        hub = _newOfflineHub(FakeResponse(200, 'access_token=abc&expires=5183999'),
+                             oauth_code_redirect_uri='http://example.com/oauth',
+                             )
+        self.assertEqual(hub.oauth_code__get_access_token(submitted_code='xyz'), 'abc')
+        self.assertIn('code=xyz', hub.transport.requests[0]['url'])
+
+
+class TestAsyncFacebookHub(unittest.TestCase):
+
+    def test_futures(self):
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1'}))
+        async_hub = fb.AsyncFacebookHub(hub=hub, max_concurrency=2)
+        future = async_hub.graph__get_profile_for_access_token(access_token='token')
+        self.assertEqual(future.result(timeout=5), {'id': '1'})
+        self.assertEqual(async_hub.graph__url_me_for_access_token('token'), hub.graph__url_me_for_access_token('token'))
+        self.assertIs(async_hub.fb_graph_api, hub.fb_graph_api)
+        async_hub.close()
+
+    def test_network_methods_never_block(self):
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1', 'name': 'a'}))
+        async_hub = fb.AsyncFacebookHub(hub=hub)
+        future = async_hub.graph__get_profile_for_access_token(access_token='token', query=fb.GraphQuery().fields('name'))
+        self.assertEqual(future.result(timeout=5), {'id': '1', 'name': 'a'})
+        self.assertIn('fields=name', hub.transport.requests[0]['url'])
+        for name in ('graph__iter_edge', 'graph__iter_url', 'api_proxy_stream', 'map_tokens', 'graph__get_profiles_for_access_tokens'):
+            self.assertRaises(AttributeError, getattr, async_hub, name)
+        async_hub.close()
+
+    def test_error_mapping(self):
+        error = {'error': {'message': 'Error validating access token: Session has expired at unix time 1', 'type': 'OAuthException', 'code': 190}}
+        hub = _newOfflineHub(FakeResponse(400, error))
+        async_hub = fb.AsyncFacebookHub(hub=hub)
+        future = async_hub.graph__get_profile_for_access_token(access_token='token')
+        self.assertRaises(fb.ApiAuthExpiredError, future.result, 5)
+        self.assertTrue(isinstance(future.exception(), fb.ApiAuthExpiredError))
+        async_hub.close()
+
+    def test_bounded_concurrency(self):
+        import threading
+        import time
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def work(i):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            return i
+
+        executor = fb.BoundedExecutor(max_workers=3)
+        self.assertEqual(executor.map(work, range(20)), range(20))
+        self.assertTrue(state['peak'] <= 3)
+        executor.shutdown()
+
+
+class TestGraphBatch(unittest.TestCase):
+
+    def _echo_batch(self, request):
+        batch = json.loads(request['data']['batch'])
+        return FakeResponse(200, [{'code': 200,
+                                   'headers': [],
+                                   'body': json.dumps({'url': op['relative_url']}),
+                                   } for op in batch])
+
+    def test_chunking_preserves_order(self):
+        hub = _newOfflineHub()
+        hub.transport.handler = self._echo_batch
+        operations = [{'method': 'GET', 'relative_url': '/%s' % i} for i in range(123)]
+        results = hub.graph__batch(access_token='token', operations=operations, concurrency=3)
+        self.assertEqual([r['body']['url'] for r in results], ['/%s' % i for i in range(123)])
+        self.assertEqual(len(hub.transport.requests), 3)
+        for request in hub.transport.requests:
+            self.assertTrue(len(json.loads(request['data']['batch'])) <= fb.FB_BATCH_MAX_OPERATIONS)
+
+    def test_chunk_size_limit(self):
+        hub = _newOfflineHub()
+        self.assertRaises(ValueError, hub.graph__batch, 'token', [], 51)
+        self.assertEqual(hub.graph__batch(access_token='token', operations=[]), [])
+
+    def test_batch_result(self):
+        expired = {'error': {'message': 'Error validating access token: Session has expired at unix time 1', 'type': 'OAuthException', 'code': 190}}
+        throttled = {'error': {'message': 'User request limit reached', 'type': 'OAuthException', 'code': 17}}
+        responses = [FakeResponse(200, [{'code': 200, 'headers': [], 'body': '{"id": "1"}'},
+                                        {'code': 400, 'headers': [], 'body': json.dumps(expired)},
+                                        {'code': 400, 'headers': [], 'body': json.dumps(throttled)},
+                                        None,
+                                        ]),
+                     FakeResponse(200, [{'code': 200, 'headers': [], 'body': '{"id": "3"}'},
+                                        {'code': 200, 'headers': [], 'body': '{"id": "4"}'},
+                                        ]),
+                     ]
+        hub = _newOfflineHub(*responses)
+        hub.transport.retry_policy = fb.RetryPolicy(backoff_base=0.001, jitter=False)
+        operations = [{'method': 'GET', 'relative_url': str(i)} for i in range(1, 5)]
+        batch = hub.graph__batch(access_token='token', operations=operations)
+        self.assertEqual(batch[0]['body'], {'id': '1'})
+        self.assertEqual([i for (i, body) in batch.succeeded], [0])
+        self.assertEqual([e.__class__ for (i, e) in batch.failed], [fb.ApiAuthExpiredError, fb.ApiRateLimitError, fb.ApiError])
+        self.assertEqual(batch.retryable(), [2, 3])
+        batch.retry()
+        self.assertEqual(json.loads(hub.transport.requests[1]['data']['batch']), operations[2:])
+        self.assertEqual(batch.results[2:], [{'id': '3'}, {'id': '4'}])
+        self.assertEqual(batch.attempts, [1, 1, 2, 2])
+        self.assertTrue(isinstance(batch.results[1], fb.ApiAuthExpiredError))
+
+
+class TestBatchCoalescer(unittest.TestCase):
+
+    def _batch_handler(self, request):
+        if request['method'] == 'GET':
+            return FakeResponse(200, {'single': True})
+        items = []
+        for op in json.loads(request['data']['batch']):
+            if 'dead' in op['relative_url']:
+                items.append({'code': 400, 'headers': [], 'body': json.dumps(TestTokenStateIndex.expired)})
+            else:
+                items.append({'code': 200, 'headers': [], 'body': json.dumps({'url': op['relative_url']})})
+        return FakeResponse(200, items)
+
+    def _run_concurrently(self, hub, tokens):
+        results = {}
+
+        def _call(token):
+            try:
+                results[token] = hub.graph__get_profile_for_access_token(access_token=token)
+            except Exception as e:
+                results[token] = e
+        threads = [threading.Thread(target=_call, args=(token, )) for token in tokens]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_short_batch_response(self):
+        coalescer = fb.BatchCoalescer(window=0.5, max_batch=3)
+        hub = _newOfflineHub(coalescer=coalescer)
+        hub.transport.handler = lambda request: FakeResponse(200, [{'code': 200, 'headers': [], 'body': json.dumps({'id': '1'})}])
+        results = self._run_concurrently(hub, ['t1', 't2', 't3'])
+        self.assertEqual(len(hub.transport.requests), 1)
+        self.assertEqual(results.values().count({'id': '1'}), 1)
+        self.assertEqual(len([e for e in results.values() if isinstance(e, fb.ApiResponseError)]), 2)
+
+    def test_coalesced_responses_are_sized_for_the_cache(self):
+        def handler(request):
+            return FakeResponse(200, [{'code': 200,
+                                       'headers': [{'name': 'ETag', 'value': '"%s"' % op['relative_url']}],
+                                       'body': json.dumps({'url': op['relative_url']}),
+                                       } for op in json.loads(request['data']['batch'])])
+        backend = fb.MemoryCacheBackend()
+        hub = _newOfflineHub(coalescer=fb.BatchCoalescer(window=0.5, max_batch=2), cache=fb.ResponseCache(backend))
+        hub.transport.handler = handler
+        results = self._run_concurrently(hub, ['t1', 't2'])
+        self.assertEqual(len(hub.transport.requests), 1)
+        self.assertEqual(backend.stats()['bytes'], sum(len(json.dumps(result)) for result in results.values()))
+        (entry, is_fresh) = hub.cache.lookup(hub.graph__url_me_for_access_token('t1'))
+        self.assertTrue(is_fresh)
+        self.assertEqual(entry['etag'], '"%s"' % results['t1']['url'])
+
+    def test_coalesces_concurrent_gets(self):
+        coalescer = fb.BatchCoalescer(window=0.5, max_batch=5)
+        hub = _newOfflineHub(coalescer=coalescer)
+        hub.transport.handler = self._batch_handler
+        tokens = ['t1', 't2', 't3', 't4', 'dead']
+        results = self._run_concurrently(hub, tokens)
+        self.assertEqual(len(hub.transport.requests), 1)
+        request = hub.transport.requests[0]
+        self.assertEqual((request['method'], request['url']), ('POST', hub.fb_graph_api))
+        self.assertEqual(request['data']['access_token'], '123|secret')
+        for token in tokens[:-1]:
+            self.assertIn('access_token=%s' % token, results[token]['url'])
+            self.assertFalse(results[token]['url'].startswith('http'))
+        self.assertTrue(isinstance(results['dead'], fb.ApiAuthExpiredError))
+        self.assertEqual(coalescer.stats(), {'calls': 5, 'batches': 1, 'coalesced': 5, 'singles': 0})
+
+    def test_lone_call_is_sent_as_usual(self):
+        coalescer = fb.BatchCoalescer(window=0.001)
+        hub = _newOfflineHub(coalescer=coalescer)
+        hub.transport.handler = self._batch_handler
+        self.assertEqual(hub.graph__get_profile_for_access_token(access_token='t1'), {'single': True})
+        self.assertEqual(hub.transport.requests[0]['method'], 'GET')
+        self.assertFalse(coalescer.accepts(hub, hub.fb_graph_api + 'me', post_data={'a': 1}))
+        self.assertFalse(coalescer.accepts(hub, hub.fb_graph_api + 'oauth/access_token', expected_format='cgi.parse_qs'))
+        self.assertEqual(coalescer.stats()['singles'], 1)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_collapses_identical_gets(self):
+        single_flight = fb.SingleFlight()
+        hub = _newOfflineHub(single_flight=single_flight)
+        release = threading.Event()
+
+        def handler(request):
+            release.wait(5)
+            if 'access_token=dead' in request['url']:
+                return FakeResponse(400, TestTokenStateIndex.expired)
+            return FakeResponse(200, {'id': '1'})
+        hub.transport.handler = handler
+        results = []
+
+        def _call(url):
+            try:
+                results.append(hub.api_proxy(url))
+            except Exception as e:
+                results.append(e)
+        urls = [hub.fb_graph_api + 'me?access_token=abc&fields=id',
+                hub.fb_graph_api + 'me?fields=id&access_token=abc',
+                hub.fb_graph_api + 'me?access_token=abc&fields=id',
+                hub.fb_graph_api + 'me?access_token=dead',
+                hub.fb_graph_api + 'me?access_token=dead',
+                ]
+        threads = [threading.Thread(target=_call, args=(url, )) for url in urls]
+        for thread in threads:
+            thread.start()
+        while single_flight.stats()['calls'] < len(urls):
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(hub.transport.requests), 2)
+        profiles = [r for r in results if isinstance(r, dict)]
+        self.assertEqual(profiles, [{'id': '1'}] * 3)
+        self.assertEqual(len(set(id(r) for r in profiles)), 3)
+        self.assertEqual(len([r for r in results if isinstance(r, fb.ApiAuthExpiredError)]), 2)
+        self.assertEqual(single_flight.stats(), {'calls': 5, 'collapsed': 3, 'in_flight': 0})
+
+        # posts are never collapsed, and a finished call is not reused
+        hub.transport.handler = lambda request: FakeResponse(200, {'id': '2'})
+        hub.api_proxy(urls[0])
+        hub.api_proxy(urls[0], post_data={'message': 'hi'})
+        self.assertEqual(len(hub.transport.requests), 4)
+
+    def test_async_shares_futures(self):
+        release = threading.Event()
+
+        def handler(request):
+            release.wait(5)
+            return FakeResponse(200, {'id': '1'})
+        hub = _newOfflineHub(single_flight=fb.SingleFlight())
+        hub.transport.handler = handler
+        async_hub = fb.AsyncFacebookHub(hub=hub, max_concurrency=2)
+        url = hub.fb_graph_api + 'me?access_token=abc'
+        first = async_hub.api_proxy(url)
+        second = async_hub.api_proxy(url)
+        self.assertIs(first, second)
+        release.set()
+        self.assertEqual(first.result(timeout=5), {'id': '1'})
+        self.assertEqual(len(hub.transport.requests), 1)
+        async_hub.close()
+
+
+class TestGraphActionsMany(unittest.TestCase):
+
+    def _handler(self, request):
+        throttled = {'error': {'message': 'Application request limit reached', 'type': 'OAuthException', 'code': 4}}
+        invalid = {'error': {'message': 'Invalid object url', 'type': 'OAuthException', 'code': 100}}
+        items = []
+        for op in json.loads(request['data']['batch']):
+            self.seen.append(op)
+            body = op.get('body') or op['relative_url']
+            first = len([i for i in self.seen if i == op]) == 1
+            if 'throttled' in body and first:
+                items.append({'code': 400, 'headers': [], 'body': json.dumps(throttled)})
+            elif 'invalid' in body:
+                items.append({'code': 400, 'headers': [], 'body': json.dumps(invalid)})
+            elif 'incomplete' in body and first:
+                items.append(None)
+            elif op['method'] == 'DELETE':
+                items.append({'code': 200, 'headers': [], 'body': 'true'})
+            else:
+                items.append({'code': 200, 'headers': [], 'body': json.dumps({'id': 'action-%s' % body.split('%2F')[-1]})})
+        return FakeResponse(200, items)
+
+    def _hub(self):
+        self.seen = []
+        hub = _newOfflineHub()
+        hub.transport.handler = self._handler
+        hub.transport.retry_policy = fb.RetryPolicy(backoff_base=0.001, jitter=False)
+        return hub
+
+    def test_create_many(self):
+        hub = self._hub()
+        actions = [{'fb_app_namespace': 'app',
+                    'fb_action_type_name': 'cook',
+                    'object_type_name': 'recipe',
+                    'object_instance_url': 'http://example.com/%s' % name,
+                    } for name in ('1', 'throttled', 'invalid', '4')]
+        results = hub.graph__action_create_many(access_token='token', actions=actions)
+        self.assertEqual(results[0], {'id': 'action-1'})
+        self.assertEqual(results[1], {'id': 'action-throttled'})
+        self.assertTrue(isinstance(results[2], fb.ApiError))
+        self.assertEqual(results[2].code, 100)
+        self.assertEqual(results[3], {'id': 'action-4'})
+        self.assertEqual(self.seen[0]['relative_url'], 'me/app:cook')
+        # only the throttled action was resent
+        self.assertEqual(len(hub.transport.requests), 2)
+        self.assertEqual(len(json.loads(hub.transport.requests[1]['data']['batch'])), 1)
+
+    def test_delete_many(self):
+        hub = self._hub()
+        results = hub.graph__action_delete_many(access_token='token', action_ids=['1', 'incomplete', 'invalid'], max_attempts=2)
+        self.assertEqual(results[:2], [True, True])
+        self.assertTrue(isinstance(results[2], fb.ApiError))
+        self.assertEqual([op['relative_url'] for op in self.seen], ['1', 'incomplete', 'invalid', 'incomplete'])
+
+
+class TestGraphIterEdge(unittest.TestCase):
+
+    def _pages(self, request):
+        # three pages of two items; the cursor is the page number
+        page = int(request['url'].split('after=')[1]) if 'after=' in request['url'] else 0
+        payload = {'data': [{'id': str(page * 2 + i)} for i in range(2)]}
+        if page < 2:
+            payload['paging'] = {'next': 'https://graph.facebook.com/me/friends?after=%s' % (page + 1)}
+        return FakeResponse(200, payload)
+
+    def test_follows_cursors(self):
+        for prefetch in (False, True):
+            hub = _newOfflineHub()
+            hub.transport.handler = self._pages
+            items = list(hub.graph__iter_edge(access_token='token', edge='friends', page_size=2, prefetch=prefetch))
+            self.assertEqual([i['id'] for i in items], [str(i) for i in range(6)])
+            self.assertTrue(hub.transport.requests[0]['url'].endswith('&limit=2'))
+
+    def test_is_lazy_and_capped(self):
+        hub = _newOfflineHub()
+        hub.transport.handler = self._pages
+        iterator = hub.graph__iter_edge(access_token='token', edge='friends', max_items=3)
+        self.assertEqual(hub.transport.requests, [])
+        self.assertEqual([i['id'] for i in iterator], ['0', '1', '2'])
+        self.assertEqual(len(hub.transport.requests), 2)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_hit_and_token_hashing(self):
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1'}), cache=fb.ResponseCache())
+        self.assertEqual(hub.graph__get_profile_for_access_token(access_token='sekrit'), {'id': '1'})
+        profile = hub.graph__get_profile_for_access_token(access_token='sekrit')
+        self.assertEqual(profile, {'id': '1'})
+        profile['id'] = 'altered'
+        self.assertEqual(hub.graph__get_profile_for_access_token(access_token='sekrit'), {'id': '1'})
+        self.assertEqual(len(hub.transport.requests), 1)
+        stats = hub.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 1, 1))
+        self.assertFalse([k for k in hub.cache.backend._entries if 'sekrit' in k])
+
+    def test_etag_revalidation(self):
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1'}, headers={'ETag': '"abc"'}),
+                             FakeResponse(304, ''),
+                             cache=fb.ResponseCache(ttls={'profile': 0}),
+                             )
+        hub.graph__get_profile_for_access_token(access_token='token')
+        self.assertEqual(hub.graph__get_profile_for_access_token(access_token='token'), {'id': '1'})
+        self.assertEqual(hub.transport.requests[1]['headers'], {'If-None-Match': '"abc"'})
+        self.assertEqual(hub.cache.stats()['revalidated'], 1)
+
+    def test_oauth_not_cached(self):
+        hub = _newOfflineHub(FakeResponse(200, 'access_token=abc'),
+                             FakeResponse(200, 'access_token=def'),
+                             cache=fb.ResponseCache(),
+                             )
+        self.assertEqual(hub.graph__extend_access_token(access_token='token')['access_token'], ['abc'])
+        self.assertEqual(hub.graph__extend_access_token(access_token='token')['access_token'], ['def'])
+
+    def test_lru_eviction(self):
+        backend = fb.MemoryCacheBackend(max_entries=2, max_bytes=100)
+        for (key, size) in (('a', 10), ('b', 10), ('c', 10), ('d', 95)):
+            backend.set(key, {'size': size}, 60)
+        self.assertEqual(backend._entries.keys(), ['d'])
+        self.assertEqual(backend.stats()['evictions'], 3)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_parse_headers(self):
+        headers = {'X-App-Usage': '{"call_count": 28, "total_time": 25, "total_cputime": 25}',
+                   'X-Business-Use-Case-Usage': '{"1": [{"type": "pages", "call_count": 80, "total_cputime": 5, "total_time": 5, "estimated_time_to_regain_access": 2}]}',
+                   }
+        self.assertEqual(fb.RateLimiter.parse_headers(headers), (28, 80, 120))
+        self.assertEqual(fb.RateLimiter.parse_headers({'X-App-Usage': 'garbage'}), (None, None, None))
+
+    def test_hub_observes_and_paces(self):
+        limiter = fb.RateLimiter(soft_limit=50, hard_limit=100, max_interval=0.05)
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1'}, headers={'X-App-Usage': '{"call_count": 75}'}),
+                             FakeResponse(200, {'id': '1'}),
+                             FakeResponse(200, {'id': '1'}),
+                             rate_limiter=limiter,
+                             )
+        hub.graph__get_profile_for_access_token(access_token='token')
+        self.assertEqual(limiter.utilization(), 75)
+        self.assertEqual(limiter.utilization('token'), 0)
+        hub.graph__get_profile_for_access_token(access_token='token')
+        hub.graph__get_profile_for_access_token(access_token='token')
+        # the first paced call reserves a slot, the second has to wait ~25ms for the next one
+        self.assertEqual(limiter.stats()['delayed'], 1)
+        self.assertTrue(0 < limiter.stats()['delayed_seconds'] <= 0.025)
+
+    def test_hard_limit_per_token(self):
+        limiter = fb.RateLimiter(hard_wait=0.01)
+        limiter.observe({'X-Business-Use-Case-Usage': '{"1": [{"call_count": 100}]}'}, 'token')
+        self.assertEqual(limiter.utilization('token'), 100)
+        self.assertEqual(limiter.acquire('other'), 0)
+        self.assertTrue(limiter.acquire('token') > 0)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def _hub(self, *responses, **kwargs):
+        hub = _newOfflineHub(*responses)
+        hub.transport.retry_policy = fb.RetryPolicy(backoff_base=0.001, **kwargs)
+        return hub
+
+    def test_retries_transient_get(self):
+        import requests
+        hub = self._hub(FakeResponse(503, 'unavailable'),
+                        requests.ConnectionError('reset'),
+                        FakeResponse(200, {'id': '1'}),
+                        )
+        self.assertEqual(hub.graph__get_profile_for_access_token(access_token='token'), {'id': '1'})
+        self.assertEqual(hub.transport.retry_policy.stats(), {'calls': 1, 'retries': 2, 'recovered': 1, 'exhausted': 0})
+
+    def test_post_only_retried_when_throttled(self):
+        throttled = {'error': {'message': 'Application request limit reached', 'type': 'OAuthException', 'code': 4}}
+        hub = self._hub(FakeResponse(400, throttled),
+                        FakeResponse(500, 'oops'),
+                        )
+        self.assertRaises(fb.ApiError, hub.api_proxy, 'https://graph.facebook.com/me/feed', {'access_token': 'token', 'message': 'hi'})
+        self.assertEqual(len(hub.transport.requests), 2)
+        self.assertEqual(hub.transport.retry_policy.stats()['retries'], 1)
+
+    def test_fatal_and_exhausted(self):
+        expired = {'error': {'message': 'Error validating access token: Session has expired at unix time 1', 'type': 'OAuthException', 'code': 190}}
+        hub = self._hub(FakeResponse(400, expired))
+        self.assertRaises(fb.ApiAuthExpiredError, hub.graph__get_profile_for_access_token, 'token')
+        hub = self._hub(FakeResponse(500, ''), FakeResponse(502, ''), max_attempts=2)
+        try:
+            hub.graph__get_profile_for_access_token(access_token='token')
+            self.fail('should have raised')
+        except fb.ApiError as e:
+            self.assertEqual(e.http_status, 502)
+        self.assertEqual(hub.transport.retry_policy.stats()['exhausted'], 1)
+
+    def test_retry_after_hint(self):
+        policy = fb.RetryPolicy(backoff_base=0.001, jitter=False)
+        self.assertEqual(policy.backoff(1, fb.ApiError(code=4, retry_after=7)), 7)
+        self.assertEqual(policy.backoff(3), 0.004)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    server_error = {'error': {'message': 'An unknown error has occurred.', 'type': 'OAuthException', 'code': 1}}
+
+    def test_trips_and_recovers(self):
+        transitions = []
+        breaker = fb.CircuitBreaker(window_size=4,
+                                    min_calls=4,
+                                    error_rate=0.5,
+                                    open_seconds=0.05,
+                                    on_transition=lambda *change: transitions.append(change),
+                                    )
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1'}),
+                             FakeResponse(500, self.server_error),
+                             FakeResponse(200, {'id': '1'}),
+                             FakeResponse(500, self.server_error),
+                             FakeResponse(200, 'access_token=abc&expires=100'),
+                             FakeResponse(200, {'id': '1'}),
+                             circuit_breaker=breaker,
+                             )
+        for i in range(4):
+            try:
+                hub.graph__get_profile_for_access_token(access_token='abc')
+            except fb.ApiError:
+                pass
+        self.assertEqual(breaker.state('profile'), fb.OPEN)
+        self.assertRaises(fb.ApiCircuitOpenError, hub.graph__get_profile_for_access_token, access_token='abc')
+        self.assertEqual(len(hub.transport.requests), 4)
+        # other endpoint classes are not affected
+        hub.graph__extend_access_token(access_token='abc')
+        self.assertEqual(breaker.state('oauth'), fb.CLOSED)
+
+        time.sleep(0.06)
+        self.assertEqual(hub.graph__get_profile_for_access_token(access_token='abc'), {'id': '1'})
+        self.assertEqual(breaker.state('profile'), fb.CLOSED)
+        self.assertEqual(transitions, [('profile', fb.CLOSED, fb.OPEN),
+                                       ('profile', fb.OPEN, fb.HALF_OPEN),
+                                       ('profile', fb.HALF_OPEN, fb.CLOSED),
+                                       ])
+        stats = breaker.stats()['profile']
+        self.assertEqual((stats['trips'], stats['rejected'], stats['calls']), (1, 1, 0))
+
+    def test_failed_probe_reopens(self):
+        breaker = fb.CircuitBreaker(window_size=2, min_calls=2, open_seconds=0.01)
+        for i in range(2):
+            self.assertFalse(breaker.before('edge'))
+            breaker.record('edge', 0.1, error=IOError('connection reset'))
+        self.assertEqual(breaker.state('edge'), fb.OPEN)
+        time.sleep(0.02)
+        self.assertTrue(breaker.before('edge'))
+        # a single probe at a time
+        self.assertRaises(fb.ApiCircuitOpenError, breaker.before, 'edge')
+        breaker.record('edge', 0.1, status=503, is_probe=True)
+        self.assertEqual(breaker.state('edge'), fb.OPEN)
+        breaker.reset()
+        self.assertEqual(breaker.state('edge'), fb.CLOSED)
+
+    def test_trips_on_latency(self):
+        breaker = fb.CircuitBreaker(window_size=3, min_calls=3, slow_seconds=1.0, slow_rate=0.6)
+        for elapsed in (2.0, 0.1, 2.0):
+            breaker.before('batch')
+            # auth errors and throttling mean Graph is answering
+            breaker.record('batch', elapsed, error=fb.ApiAuthError(code=190), status=400)
+        self.assertEqual(breaker.state('batch'), fb.OPEN)
+        self.assertEqual(breaker.stats()['batch']['failures'], 0)
+
+
+class TestDeadline(unittest.TestCase):
+
+    def test_budget_is_shared_by_composite_calls(self):
+        def handler(request):
+            time.sleep(0.02)
+            if 'oauth' in request['url']:
+                return FakeResponse(200, 'access_token=abc&expires=100')
+            return FakeResponse(200, {'id': '1'})
+        hub = _newOfflineHub()
+        hub.transport.handler = handler
+        hub.transport.timeout = (5.0, 30.0)
+        (access_token, profile) = hub.oauth_code__get_access_token_and_profile('code', redirect_uri='http://example.com/', deadline=2.0)
+        self.assertEqual((access_token, profile), ('abc', {'id': '1'}))
+        (first, second) = [request['timeout'] for request in hub.transport.requests]
+        self.assertTrue(1.9 < first[0] <= 2.0 and first == (first[0], first[0]))
+        self.assertTrue(second[0] <= first[0] - 0.02)
+
+    def test_spent_budget_raises(self):
+        def handler(request):
+            time.sleep(0.05)
+            if 'oauth' in request['url']:
+                return FakeResponse(200, 'access_token=abc&expires=100')
+            raise IOError('read timed out')
+        hub = _newOfflineHub()
+        hub.transport.handler = handler
+        self.assertRaises(fb.ApiTimeoutError, hub.oauth_code__get_access_token_and_profile, 'code', redirect_uri='http://example.com/', deadline=0.03)
+        self.assertEqual(len(hub.transport.requests), 1)
+
+        # a transport timeout once the budget is spent is reported as such
+        with fb.Deadline(0.07):
+            hub.oauth_code__get_access_token('code', redirect_uri='http://example.com/')
+            try:
+                hub.graph__get_profile_for_access_token(access_token='abc')
+                self.fail('expected ApiTimeoutError')
+            except fb.ApiTimeoutError as e:
+                self.assertTrue(isinstance(e.raised, IOError))
+        self.assertIsNone(fb.current_deadline())
+
+    def test_retries_stop_at_the_deadline(self):
+        hub = _newOfflineHub(FakeResponse(500, TestCircuitBreaker.server_error), FakeResponse(200, {'id': '1'}))
+        hub.transport.retry_policy = fb.RetryPolicy(backoff_base=0.5, jitter=False)
+        started = time.time()
+        self.assertRaises(fb.ApiError, hub.graph__get_profile_for_access_token, access_token='abc', deadline=0.2)
+        self.assertTrue(time.time() - started < 0.2)
+        self.assertEqual(len(hub.transport.requests), 1)
+
+    def test_throttling_stops_at_the_deadline(self):
+        limiter = fb.RateLimiter(hard_wait=3.0)
+        limiter.observe({'X-App-Usage': '{"call_count": 100}'})
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1'}), rate_limiter=limiter)
+        started = time.time()
+        self.assertRaises(fb.ApiTimeoutError, hub.graph__get_profile_for_access_token, access_token='abc', deadline=0.5)
+        self.assertTrue(time.time() - started < 0.1)
+        self.assertEqual(len(hub.transport.requests), 0)
+        self.assertEqual(limiter.stats()['delayed'], 0)
+
+    def test_timeouts_are_not_probe_outcomes(self):
+        def handler(request):
+            time.sleep(0.05)
+            raise IOError('read timed out')
+        breaker = fb.CircuitBreaker(window_size=1, min_calls=1, open_seconds=0.01)
+        breaker.before('profile')
+        breaker.record('profile', 0.1, error=IOError('connection reset'))
+        time.sleep(0.02)
+        hub = _newOfflineHub(circuit_breaker=breaker)
+        hub.transport.handler = handler
+        self.assertRaises(fb.ApiTimeoutError, hub.graph__get_profile_for_access_token, access_token='abc', deadline=0.03)
+        # neither closed nor reopened, and the probe slot is free again
+        self.assertEqual(breaker.state('profile'), fb.HALF_OPEN)
+        self.assertTrue(breaker.before('profile'))
+
+    def test_batch_retry_stops_at_the_deadline(self):
+        throttled = {'error': {'message': 'User request limit reached', 'type': 'OAuthException', 'code': 17}}
+        hub = _newOfflineHub(FakeResponse(200, [{'code': 400, 'headers': [], 'body': json.dumps(throttled)}]))
+        hub.transport.retry_policy = fb.RetryPolicy(backoff_base=5.0, jitter=False)
+        started = time.time()
+        with fb.Deadline(0.1):
+            batch = hub.graph__batch(access_token='token', operations=[{'method': 'GET', 'relative_url': '1'}])
+            self.assertRaises(fb.ApiTimeoutError, batch.retry)
+        self.assertTrue(time.time() - started < 0.5)
+        self.assertEqual(len(hub.transport.requests), 1)
+
+    def test_nesting_and_threads(self):
+        outer = fb.Deadline(1.0)
+        with outer:
+            with fb.Deadline(10.0):
+                self.assertIs(fb.current_deadline(), outer)
+            with fb.Deadline(0.5) as inner:
+                self.assertIs(fb.current_deadline(), inner)
+            hub = _newOfflineHub()
+            hub.transport.handler = TestGraphBatch('test_chunk_size_limit')._echo_batch
+            operations = [{'method': 'GET', 'relative_url': '/%s' % i} for i in range(100)]
+            hub.graph__batch(access_token='token', operations=operations, concurrency=2)
+        self.assertEqual(len(hub.transport.requests), 2)
+        for request in hub.transport.requests:
+            self.assertTrue(request['timeout'] <= 1.0)
+
+
+class TestErrorClassifier(unittest.TestCase):
+
+    def _classify(self, error):
+        return fb.default_error_classifier.classify(fb.reformat_error(error))
+
+    def test_default_rules(self):
+        for (error, expected) in (
+            ({'code': 1, 'message': 'Error validating client secret.'}, fb.ApiApplicationError),
+            ({'code': 1, 'message': 'An unknown error has occurred.', 'type': 'OAuthException'}, fb.ApiError),
+            ({'code': 101, 'message': 'Error validating application.'}, fb.ApiApplicationError),
+            ({'code': 100, 'type': 'GraphMethodException'}, fb.ApiRuntimeGraphMethodError),
+            ({'code': 100, 'message': 'Invalid verification code format.'}, fb.ApiRuntimeVerirficationFormatError),
+            ({'code': 100, 'message': 'Invalid grant_type: foo'}, fb.ApiRuntimeGrantError),
+            ({'code': 100, 'message': 'Unsupported scope: foo', 'type': 'OAuthException'}, fb.ApiRuntimeScopeError),
+            ({'code': 100, 'message': 'Something else', 'type': 'OAuthException'}, fb.ApiAuthError),
+            ({'code': 104, 'message': 'Requires access token'}, fb.ApiAuthError),
+            ({'code': 190, 'error_subcode': 463, 'message': 'whatever', 'type': 'OAuthException'}, fb.ApiAuthExpiredError),
+            ({'code': 190, 'message': 'Error validating access token: Session has expired at unix time 1', 'type': 'OAuthException'}, fb.ApiAuthExpiredError),
+            ({'code': 190, 'message': 'Error validating access token: The user has not authorized application 1.'}, fb.ApiAuthError),
+            ({'code': 190, 'message': 'Invalid OAuth access token.'}, fb.ApiAuthError),
+            ({'code': 17, 'message': 'User request limit reached', 'type': 'OAuthException'}, fb.ApiRateLimitError),
+            ({'code': 12345, 'message': 'Something new'}, fb.ApiError),
+        ):
+            self.assertIs(self._classify(error), expected, error)
+
+    def test_every_status_is_classified(self):
+        expired = {'error': {'message': 'Error validating access token: Session has expired at unix time 1', 'type': 'OAuthException', 'code': 190}}
+        for status in (400, 401, 403, 500):
+            hub = _newOfflineHub(FakeResponse(status, expired))
+            try:
+                hub.graph__get_profile_for_access_token(access_token='token')
+                self.fail('should have raised')
+            except fb.ApiAuthExpiredError as e:
+                self.assertEqual((e.http_status, e.code), (status, 190))
+        hub = _newOfflineHub(FakeResponse(502, '<html>bad gateway</html>'))
+        try:
+            hub.graph__get_profile_for_access_token(access_token='token')
+            self.fail('should have raised')
+        except fb.ApiError as e:
+            self.assertEqual((type(e), e.code), (fb.ApiError, 502))
+
+    def test_runtime_registration(self):
+        classifier = fb.default_error_classifier.copy()
+        classifier.register(fb.ApiAuthExpiredError, code=190, subcode=460)
+        classifier.register(fb.ApiResponseError, message_prefix='Error validating access token: weird')
+        self.assertIs(classifier.classify({'code': 190, 'subcode': 460}), fb.ApiAuthExpiredError)
+        self.assertIs(classifier.classify({'message': 'Error validating access token: weird one'}), fb.ApiResponseError)
+        self.assertIs(fb.default_error_classifier.classify({'code': 190, 'subcode': 460}), fb.ApiError)
+        self.assertRaises(ValueError, classifier.register, fb.ApiError, subcode=1)
+
+
+class TestSignedRequestVerifier(unittest.TestCase):
+
+    def _signed_request(self, payload, secret='secret'):
+        import base64
+        import hashlib
+        import hmac
+        payload = base64.urlsafe_b64encode(json.dumps(payload)).rstrip('=')
+        signature = base64.urlsafe_b64encode(hmac.new(secret, msg=payload, digestmod=hashlib.sha256).digest()).rstrip('=')
+        return '%s.%s' % (signature, payload)
+
+    def test_verify(self):
+        import time
+        hub = _newOfflineHub()
+        signed_request = self._signed_request({'algorithm': 'HMAC-SHA256', 'issued_at': int(time.time()), 'user_id': '1'})
+        (verified, data) = hub.verify_signed_request(signed_request, timeout=60)
+        self.assertTrue(verified)
+        self.assertEqual(data['user_id'], '1')
+        (verified, data) = hub.verify_signed_request(self._signed_request({'algorithm': 'HMAC-SHA256', 'issued_at': 1}), timeout=60)
+        self.assertEqual(verified, False)
+        self.assertEqual(data['python-error'], 'payload issued outside of timeout window')
+        (verified, data) = hub.verify_signed_request(self._signed_request({'algorithm': 'HMAC-SHA256'}, secret='wrong'))
+        self.assertEqual(verified, None)
+        # neither digest is echoed back
+        self.assertEqual(data, {'python-error': 'signature mismatch'})
+
+    def test_verify_many_and_cache(self):
+        verifier = fb.SignedRequestVerifier('secret', cache_size=2)
+        good = self._signed_request({'algorithm': 'HMAC-SHA256', 'user_id': '1'})
+        results = verifier.verify_many([good, 'not-a-signed-request', good])
+        self.assertEqual([r[0] for r in results], [True, False, True])
+        self.assertEqual(verifier.cache_hits, 1)
+        # a payload without `issued_at` fails on its own, under a timeout
+        results = verifier.verify_many([good, good], timeout=60)
+        self.assertEqual([(r[0], r[1].get('python-error')) for r in results], [(False, 'payload has no issued_at')] * 2)
+        results[0][1]['user_id'] = 'altered'
+        self.assertEqual(verifier.verify(good)[1]['user_id'], '1')
+
+
+class TestGraphGetObjects(unittest.TestCase):
+
+    def _objects(self, request):
+        import urlparse
+        query = urlparse.parse_qs(urlparse.urlsplit(request['url']).query)
+        ids = query['ids'][0].split(',')
+        if 'bad' in ids:
+            return FakeResponse(400, {'error': {'message': '(#803) Some of the aliases you requested do not exist: bad', 'type': 'OAuthException', 'code': 803}})
+        return FakeResponse(200, dict((i, {'id': i, 'fields': query.get('fields')}) for i in ids if i != 'gone'))
+
+    def test_groups_ids_and_reports_errors(self):
+        hub = _newOfflineHub()
+        hub.transport.handler = self._objects
+        ids = [str(i) for i in range(120)] + ['bad', 'gone', '7']
+        (objects, errors) = hub.graph__get_objects(access_token='token', ids=ids, fields=['id', 'name'])
+        self.assertEqual(sorted(objects.keys()), sorted(str(i) for i in range(120)))
+        self.assertEqual(objects['7']['fields'], ['id,name'])
+        self.assertEqual(sorted(errors.keys()), ['bad', 'gone'])
+        self.assertTrue(isinstance(errors['bad'], fb.ApiError))
+        self.assertTrue(isinstance(errors['gone'], fb.ApiResponseError))
+
+    def test_token_errors_are_not_bisected(self):
+        expired = {'error': {'message': 'Error validating access token: Session has expired at unix time 1', 'type': 'OAuthException', 'code': 190}}
+        hub = _newOfflineHub(FakeResponse(400, expired))
+        (objects, errors) = hub.graph__get_objects(access_token='token', ids=['1', '2', '3'])
+        self.assertEqual(objects, {})
+        self.assertEqual(sorted(errors.keys()), ['1', '2', '3'])
+        self.assertEqual(len(hub.transport.requests), 1)
+
+
+class TestGraphQuery(unittest.TestCase):
+
+    def test_render(self):
+        query = fb.GraphQuery('me', 'id,name').edge('friends', 'id', fb.GraphQuery('picture', 'url', type='large'), limit=100).after('abc')
+        self.assertEqual(query.field_list(), 'id,name,friends.limit(100){id,picture.type(large){url}}')
+        self.assertEqual(query.params(), [('fields', 'id,name,friends.limit(100){id,picture.type(large){url}}'), ('after', 'abc')])
+        self.assertEqual(fb.GraphQuery('me').querystring(), '')
+
+    def test_hub_accepts_queries(self):
+        import urlparse
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1'}),
+                             FakeResponse(200, {'id': '1'}),
+                             FakeResponse(200, {'data': []}),
+                             FakeResponse(200, {'1': {'id': '1'}}),
+                             )
+        query = fb.GraphQuery('me', 'id').edge('friends', 'id', limit=10)
+        hub.graph__query(access_token='token', query=query)
+        hub.graph__get_profile_for_access_token(access_token='token', query=query)
+        list(hub.graph__iter_edge(access_token='token', edge='likes', query=fb.GraphQuery(None, 'id', 'name')))
+        hub.graph__get_objects(access_token='token', ids=['1'], fields=fb.GraphQuery(None, 'id', 'name'))
+        fields = [urlparse.parse_qs(urlparse.urlsplit(r['url']).query)['fields'] for r in hub.transport.requests]
+        self.assertEqual(fields, [['id,friends.limit(10){id}'], ['id,friends.limit(10){id}'], ['id,name'], ['id,name']])
+        self.assertEqual(urlparse.urlsplit(hub.transport.requests[0]['url']).path, '/me')
+
+
+class TestGraphStream(unittest.TestCase):
+
+    def test_batch_items_are_lazy(self):
+        payload = [{'code': 200, 'headers': [], 'body': json.dumps({'id': str(i)})} for i in range(3)]
+        hub = _newOfflineHub(FakeResponse(200, payload))
+        stream = hub.api_proxy_stream('https://graph.facebook.com', post_data={'access_token': 'token', 'batch': [{}] * 3}, chunk_size=7)
+        items = list(stream)
+        self.assertTrue(isinstance(items[0], fb.LazyBatchItem))
+        self.assertTrue(isinstance(dict.get(items[0], 'body'), basestring))
+        self.assertEqual([i['body']['id'] for i in items], ['0', '1', '2'])
+        self.assertTrue(stream.response.closed)
+        self.assertEqual(hub.transport.requests[0]['method'], 'POST')
+
+    def test_streamed_pagination(self):
+        hub = _newOfflineHub(FakeResponse(200, {'data': [{'id': '1'}, {'id': '2'}], 'paging': {'next': 'https://graph.facebook.com/me/friends?after=2'}}),
+                             FakeResponse(200, {'data': [{'id': '3'}], 'paging': {}}),
+                             )
+        items = list(hub.graph__iter_edge(access_token='token', edge='friends', stream=True))
+        self.assertEqual([i['id'] for i in items], ['1', '2', '3'])
+
+    def test_errors(self):
+        expired = {'error': {'message': 'Error validating access token: Session has expired at unix time 1', 'type': 'OAuthException', 'code': 190}}
+        hub = _newOfflineHub(FakeResponse(400, expired), FakeResponse(200, '{"data": [{"id": 1}'))
+        try:
+            hub.api_proxy_stream('https://graph.facebook.com/me/friends')
+            self.fail('expected ApiAuthExpiredError')
+        except fb.ApiAuthExpiredError as e:
+            self.assertEqual(e.http_status, 400)
+        self.assertRaises(fb.ApiResponseError, list, hub.api_proxy_stream('https://graph.facebook.com/me/friends'))
+
+    def test_server_errors_are_retried(self):
+        hub = _newOfflineHub(FakeResponse(503, 'unavailable'), FakeResponse(200, {'data': [{'id': '1'}]}))
+        hub.transport.retry_policy = fb.RetryPolicy(backoff_base=0.001)
+        self.assertEqual(list(hub.api_proxy_stream('https://graph.facebook.com/me/friends')), [{'id': '1'}])
+        self.assertEqual(hub.transport.retry_policy.stats()['recovered'], 1)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_calls_recorded(self):
+        expired = {'error': {'message': 'Error validating access token: Session has expired at unix time 1', 'type': 'OAuthException', 'code': 190}}
+        sink = fb.HistogramSink()
+        calls = []
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1'}),
+                             FakeResponse(400, expired),
+                             cache=fb.ResponseCache(fb.MemoryCacheBackend()),
+                             instrumentation=fb.Instrumentation(sink, calls.append),
+                             )
+        hub.graph__get_profile_for_access_token(access_token='token')
+        hub.graph__get_profile_for_access_token(access_token='token')
+        self.assertRaises(fb.ApiAuthExpiredError, hub.graph__get_profile_for_access_token, access_token='other')
+        self.assertEqual([(c.endpoint, c.status, c.error, c.cache, c.attempts) for c in calls],
+                         [('/me', 200, None, 'miss', 1),
+                          ('/me', None, None, 'hit', 0),
+                          ('/me', 400, 'ApiAuthExpiredError', 'miss', 1),
+                          ])
+        self.assertEqual(calls[0].bytes_in, len('{"id": "1"}'))
+        self.assertEqual(calls[0].timings['first_byte'], 0.001)
+        stats = sink.snapshot()[('/me', 'GET')]
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['errors'], {'ApiAuthExpiredError': 1})
+        self.assertEqual(stats['cache'], {'hit': 1, 'miss': 2})
+        self.assertEqual(sink.slowest(1)[0][1:], ('/me', 'GET'))
+
+    def test_broken_sink(self):
+        def broken(call):
+            raise ValueError()
+        instrumentation = fb.Instrumentation(broken)
+        hub = _newOfflineHub(FakeResponse(200, {'id': '1'}), instrumentation=instrumentation)
+        self.assertEqual(hub.api_proxy('https://graph.facebook.com/12345'), {'id': '1'})
+        self.assertEqual(instrumentation.stats(), {'calls': 1, 'sink_errors': 1})
+
+    def test_prometheus(self):
+        sink = fb.PrometheusSink(buckets=(0.01, 1))
+        hub = _newOfflineHub(FakeResponse(200, {'data': []}), instrumentation=fb.Instrumentation(sink))
+        hub.api_proxy('https://graph.facebook.com/v2.3/12345/friends?access_token=abc')
+        text = sink.exposition()
+        self.assertIn('facebook_graph_calls_total{endpoint="/{id}/friends",method="GET",status="200"} 1', text)
+        self.assertIn('facebook_graph_duration_seconds_bucket{endpoint="/{id}/friends",le="0.01",method="GET",phase="total"} 1', text)
+        self.assertIn('facebook_graph_duration_seconds_bucket{endpoint="/{id}/friends",le="+Inf",method="GET",phase="total"} 1', text)
+        self.assertNotIn('abc', text)
+
+    def test_transport_trace(self):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '11')
+                self.end_headers()
+                self.wfile.write('{"id": "1"}')
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        transport = fb.FacebookTransport()
+        trace = {}
+        try:
+            response = transport.request('GET', 'http://localhost:%s/me' % server.server_address[1], trace=trace)
+        finally:
+            thread.join()
+            server.server_close()
+            transport.close()
+        self.assertEqual(response.json(), {'id': '1'})
+        for phase in ('dns', 'connect', 'first_byte', 'total'):
+            self.assertIn(phase, trace)
+        self.assertNotIn('tls', trace)
+        self.assertEqual((trace['bytes_out'], trace['bytes_in']), (0, 11))
+
+
+class FakeRegistry(object):
+
+    def __init__(self, settings):
+        self.settings = settings
+
+
+class FakeRequest(object):
+
+    def __init__(self, registry, params=None):
+        self.registry = registry
+        self.params = params or {}
+
+
+class FakeConfig(object):
+
+    def __init__(self, settings):
+        self.registry = FakeRegistry(settings)
+        self.directives = {}
+        self.request_methods = {}
+
+    def add_directive(self, name, directive):
+        self.directives[name] = directive
+
+    def add_request_method(self, callable, name, reify=False):
+        self.request_methods[name] = callable
+
+
+class TestPyramid(unittest.TestCase):
+    settings = {'facebook.app.id': '123',
+                'facebook.app.secret': 'secret',
+                'facebook.app.scope': 'email',
+                'facebook.app.ssl_verify': 'false',
+                'facebook.app.oauth_code_redirect_uri': 'http://example.com/oauth',
+                'facebook.transport.pool_maxsize': '20',
+                'facebook.cache.max_entries': '100',
+                'app_domain': 'example.com',
+                }
+
+    def test_includeme(self):
+        config = FakeConfig(self.settings)
+        fb.includeme(config)
+        hub = config.registry.facebook_hub
+        self.assertEqual((hub.app_id, hub.ssl_verify, hub.transport.pool_maxsize), ('123', False, 20))
+        self.assertTrue(isinstance(hub.cache, fb.ResponseCache))
+        self.assertIsNone(hub.rate_limiter)
+
+        hub.transport = FakeTransport(FakeResponse(200, 'access_token=abc&expires=1'))
+        request = FakeRequest(config.registry, {'code': 'xyz'})
+        view = config.request_methods['facebook'](request)
+        self.assertIs(view.transport, hub.transport)
+        self.assertEqual(view.oauth_code__get_access_token(), 'abc')
+        self.assertIn('code=xyz', hub.transport.requests[0]['url'])
+
+    def test_facebook_pyramid_shares_components(self):
+        registry = FakeRegistry(self.settings)
+        first = fb.FacebookPyramid(FakeRequest(registry))
+        second = fb.FacebookPyramid(FakeRequest(registry), oauth_code_redirect_uri='http://example.com/other', fb_graph_api_version='v2.3')
+        shared = registry.facebook_hub
+        for hub in (first, second):
+            self.assertIs(hub.transport, shared.transport)
+            self.assertIs(hub.cache, shared.cache)
+            self.assertIs(hub.signed_request_verifier, shared.signed_request_verifier)
+        self.assertEqual(first.oauth_code_redirect_uri, 'http://example.com/oauth')
+        self.assertEqual(second.oauth_code_redirect_uri, 'http://example.com/other')
+        self.assertEqual(second.fb_graph_api, fb.FacebookHub(app_id='1', app_secret='2', fb_grap_api_version='v2.3').fb_graph_api)
+        self.assertEqual(shared.fb_graph_api, fb.FB_GRAPH_API_URL)
+
+    def test_facebook_pyramid_without_settings(self):
+        registry = FakeRegistry({})
+        hub = fb.FacebookPyramid(FakeRequest(registry), app_id='123', app_secret='secret')
+        self.assertEqual(hub.app_id, '123')
+        # the components are built once per registry, not per request
+        other = fb.FacebookPyramid(FakeRequest(registry), app_id='123', app_secret='secret')
+        self.assertIs(other.transport, hub.transport)
+        self.assertRaises(ValueError, fb.FacebookPyramid, FakeRequest(FakeRegistry({})))
+
+    def test_facebook_pyramid_with_partial_settings(self):
+        registry = FakeRegistry({'facebook.app.id': '123'})
+        hub = fb.FacebookPyramid(FakeRequest(registry), app_secret='secret')
+        self.assertEqual((hub.app_id, hub.app_secret), ('123', 'secret'))
+        # the settings can't build a shared hub; that is only tried once
+        error = registry.facebook_hub_error
+        self.assertTrue(isinstance(error, ValueError))
+        other = fb.FacebookPyramid(FakeRequest(registry), app_secret='secret')
+        self.assertIs(registry.facebook_hub_error, error)
+        self.assertIs(other.transport, hub.transport)
+
+    def test_includeme_keeps_a_hub(self):
+        config = FakeConfig(self.settings)
+        hub = fb.FacebookHub(app_id='456', app_secret='other')
+        config.registry.facebook_hub = hub
+        fb.includeme(config)
+        self.assertIs(config.registry.facebook_hub, hub)
+
+
+class TestMapTokens(unittest.TestCase):
+
+    def _handler(self, request):
+        expired = {'error': {'message': 'Error validating access token: Session has expired at unix time 1', 'type': 'OAuthException', 'code': 190}}
+        if 'expired' in request['url']:
+            return FakeResponse(400, expired)
+        if 'fb_exchange_token' in request['url']:
+            return FakeResponse(200, 'access_token=extended&expires=5183999')
+        return FakeResponse(200, {'id': request['url'].split('access_token=')[1]})
+
+    def test_profiles(self):
+        hub = _newOfflineHub()
+        hub.transport.handler = self._handler
+        tokens = ('token%s' % i for i in range(20))
+        results = dict(hub.graph__get_profiles_for_access_tokens(['expired'], concurrency=4))
+        results.update(hub.graph__get_profiles_for_access_tokens(tokens, concurrency=4))
+        self.assertEqual(len(results), 21)
+        self.assertTrue(isinstance(results['expired'], fb.ApiAuthExpiredError))
+        self.assertEqual(results['token7'], {'id': 'token7'})
+
+    def test_extend_and_callables(self):
+        hub = _newOfflineHub()
+        hub.transport.handler = self._handler
+        results = dict(hub.graph__extend_access_tokens(['a', 'b'], concurrency=2))
+        self.assertEqual(results['a']['access_token'], ['extended'])
+
+        def boom(access_token):
+            raise KeyError(access_token)
+        ((token, error), ) = hub.map_tokens(boom, ['a'])
+        self.assertTrue(isinstance(error, fb.ApiUnhandledError))
+        self.assertTrue(isinstance(error.raised, KeyError))
+
+    def test_lazy(self):
+        consumed = []
+
+        def tokens():
+            for i in range(100):
+                consumed.append(i)
+                yield 'token%s' % i
+        hub = _newOfflineHub()
+        hub.transport.handler = self._handler
+        results = hub.map_tokens('graph__get_profile_for_access_token', tokens(), concurrency=2)
+        next(results)
+        self.assertTrue(len(consumed) <= 5)
+        results.close()
+
+
+class TestTokenStateIndex(unittest.TestCase):
+    expired = {'error': {'message': 'Error validating access token: Session has expired at unix time 1', 'type': 'OAuthException', 'code': 190}}
+
+    def test_short_circuits_known_bad_tokens(self):
+        index = fb.TokenStateIndex()
+        hub = _newOfflineHub(FakeResponse(400, self.expired), FakeResponse(200, {'id': '1'}), token_index=index)
+        for i in range(3):
+            self.assertRaises(fb.ApiAuthExpiredError, hub.graph__get_profile_for_access_token, access_token='dead')
+        self.assertEqual(len(hub.transport.requests), 1)
+        self.assertEqual(index.stats(), {'short_circuits': 2, 'evictions': 0, 'tracked': 1})
+        self.assertEqual(hub.graph__get_profile_for_access_token(access_token='alive'), {'id': '1'})
+        index.forget('dead')
+        self.assertEqual(index.error_for('dead'), None)
+
+    def test_permission_errors_keep_the_token(self):
+        index = fb.TokenStateIndex()
+        denied = {'error': {'message': '(#200) Requires extended permission: publish_actions', 'type': 'OAuthException', 'code': 200}}
+        hub = _newOfflineHub(FakeResponse(403, denied), FakeResponse(200, {'id': '1'}), token_index=index)
+        self.assertRaises(fb.ApiAuthError, hub.graph__get_profile_for_access_token, access_token='alive')
+        self.assertEqual(index.error_for('alive'), None)
+        self.assertEqual(hub.graph__get_profile_for_access_token(access_token='alive'), {'id': '1'})
+        self.assertEqual(len(hub.transport.requests), 2)
+        self.assertTrue(index.is_token_error(fb.ApiAuthError(code=190)))
+        self.assertTrue(index.is_token_error(fb.ApiAuthError(code=2500, subcode=460)))
+        self.assertFalse(index.is_token_error(fb.ApiAuthError(code=10)))
+
+    def test_expiry(self):
+        index = fb.TokenStateIndex()
+        hub = _newOfflineHub(FakeResponse(200, 'access_token=new&expires=100'),
+                             FakeResponse(200, {'data': {'is_valid': True, 'expires_at': 1}}),
+                             FakeResponse(200, {'data': {'is_valid': False, 'error': {'code': 190, 'subcode': 460, 'message': 'password changed'}}}),
+                             token_index=index,
+                             )
+        hub.graph__extend_access_token(access_token='old')
+        self.assertTrue(99 < index.expires_at('new') - time.time() <= 100)
+        hub.graph__debug_token(input_token='old')
+        self.assertIn('input_token=old', hub.transport.requests[1]['url'])
+        self.assertRaises(fb.ApiAuthExpiredError, hub.graph__extend_access_token, access_token='old')
+        hub.graph__debug_token(input_token='changed')
+        self.assertRaises(fb.ApiAuthError, hub.graph__get_profile_for_access_token, access_token='changed')
+        self.assertEqual(len(hub.transport.requests), 3)
+
+    def test_bounded(self):
+        index = fb.TokenStateIndex(max_tokens=2, bad_ttl=60)
+        for token in ('a', 'b', 'c'):
+            index.set_expires(token, 1)
+        self.assertEqual(index.stats()['tracked'], 2)
+        self.assertEqual(index.stats()['evictions'], 1)
+        self.assertEqual(index.error_for('a'), None)
+        self.assertTrue(isinstance(index.error_for('c'), fb.ApiAuthExpiredError))
+
+
+class TestTokenRefreshManager(unittest.TestCase):
+
+    def test_refreshes_ahead_of_expiry(self):
+        def handler(request):
+            old = request['url'].split('fb_exchange_token=')[1].split('&')[0]
+            if old == 'dead':
+                return FakeResponse(400, TestTokenStateIndex.expired)
+            return FakeResponse(200, 'access_token=%s-new&expires=5184000' % old)
+        hub = _newOfflineHub()
+        hub.transport.handler = handler
+        refreshed = []
+        errors = []
+        done = threading.Event()
+
+        def on_refresh(key, access_token, expires_at):
+            refreshed.append((key, access_token))
+            if len(refreshed) == 2:
+                done.set()
+
+        manager = fb.TokenRefreshManager(hub,
+                                         refresh_ahead=60,
+                                         spread=0,
+                                         min_interval=0,
+                                         on_refresh=on_refresh,
+                                         on_error=lambda key, e: errors.append((key, e)),
+                                         )
+        manager.track('u1', 'a', expires_in=30)
+        manager.track('u2', 'b', expires_in=5184000)
+        manager.track('u3', 'dead')
+        manager.track('u4', 'c', expires_in=45)
+        self.assertEqual(manager.token('u1'), 'a')
+        manager.start()
+        try:
+            self.assertTrue(done.wait(5))
+        finally:
+            manager.stop()
+        self.assertEqual(sorted(refreshed), [('u1', 'a-new'), ('u4', 'c-new')])
+        self.assertEqual(manager.token('u1'), 'a-new')
+        self.assertEqual(manager.token('u2'), 'b')
+        self.assertEqual(manager.token('u3'), None)
+        self.assertEqual([key for (key, e) in errors], ['u3'])
+        self.assertTrue(isinstance(errors[0][1], fb.ApiAuthExpiredError))
+        self.assertTrue(manager.expires_at('u1') - time.time() > 5183000)
+        stats = manager.stats()
+        self.assertEqual((stats['refreshed'], stats['dropped'], stats['tracked']), (2, 1, 3))
+        self.assertTrue(stats['next_due'] > time.time() + 5000000)
+
+    def test_spread(self):
+        manager = fb.TokenRefreshManager(_newOfflineHub(), refresh_ahead=100, spread=50)
+        now = time.time()
+        for i in range(20):
+            manager.track(i, 'token-%s' % i, expires_at=now + 1000)
+        dues = [manager._tokens[i][2] for i in range(20)]
+        self.assertTrue(all(now + 850 <= due <= now + 900 for due in dues))
+        self.assertTrue(len(set(dues)) > 1)
+
+    def test_retries_failures_later(self):
+        hub = _newOfflineHub(FakeResponse(500, 'oops'))
+        manager = fb.TokenRefreshManager(hub, retry_delay=120)
+        manager.track('u1', 'a', expires_in=10)
+        self.assertRaises(fb.ApiError, manager.refresh, 'u1')
+        self.assertEqual(manager.token('u1'), 'a')
+        self.assertTrue(manager.stats()['next_due'] > time.time() + 100)
+        self.assertEqual(manager.stats()['failed'], 1)
+
+    def test_keeps_tokens_on_permission_errors(self):
+        denied = {'error': {'message': '(#200) Permissions error', 'type': 'OAuthException', 'code': 200}}
+        hub = _newOfflineHub(FakeResponse(403, denied))
+        errors = []
+        manager = fb.TokenRefreshManager(hub, retry_delay=120, on_error=lambda key, e: errors.append((key, e)))
+        manager.track('u1', 'a', expires_in=10)
+        self.assertRaises(fb.ApiAuthError, manager.refresh, 'u1')
+        self.assertEqual(manager.token('u1'), 'a')
+        self.assertEqual(errors, [])
+        self.assertEqual((manager.stats()['dropped'], manager.stats()['failed']), (0, 1))
+        self.assertTrue(manager.stats()['next_due'] > time.time() + 100)
+
+    def test_tokens_without_expiry(self):
+        hub = _newOfflineHub(FakeResponse(200, 'access_token=forever'))
+        manager = fb.TokenRefreshManager(hub, spread=10)
+        manager.track('u1', 'a')
+        self.assertTrue(manager.stats()['next_due'] <= time.time() + 10)
+        self.assertEqual(manager.refresh('u1'), 'forever')
+        self.assertEqual(manager.expires_at('u1'), None)
+        self.assertTrue(manager.stats()['next_due'] > time.time() + 86400 * 29)
+
+    def test_drops_wrapped_auth_errors(self):
+        hub = _newOfflineHub(FakeResponse(400, TestTokenStateIndex.expired), mask_unhandled_exceptions=True)
+        errors = []
+        manager = fb.TokenRefreshManager(hub, on_error=lambda key, e: errors.append((key, e)))
+        manager.track('u1', 'a', expires_in=10)
+        self.assertEqual(manager.refresh('u1'), None)
+        self.assertEqual(manager.token('u1'), None)
+        self.assertEqual([key for (key, e) in errors], ['u1'])
+        self.assertTrue(isinstance(errors[0][1], fb.ApiAuthExpiredError))
+        self.assertEqual((manager.stats()['dropped'], manager.stats()['failed']), (1, 0))
+
+
+class TestLazyImport(unittest.TestCase):
+
+    def _loaded(self, code):
+        """runs `code` in a fresh interpreter; returns the `facebook_utils` submodules and the other packages of interest it loaded"""
+        probe = code + '\nimport sys\nprint " ".join(sorted(m for m in sys.modules if sys.modules[m] is not None and (m.startswith("facebook_utils.") or m in ("requests", "cgi"))))'
+        output = subprocess.check_output([sys.executable, '-c', probe], cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.split()
+
+    def test_pure_paths_skip_requests(self):
+        self.assertEqual(self._loaded('import facebook_utils'), [])
+        self.assertEqual(self._loaded('import facebook_utils\nfacebook_utils.FacebookApiUrls'), ['facebook_utils.facebook_api_urls'])
+        loaded = self._loaded('import facebook_utils\nfacebook_utils.FacebookHub(app_id="1", app_secret="s").signed_request_verifier')
+        self.assertNotIn('requests', loaded)
+        self.assertNotIn('cgi', loaded)
+        self.assertNotIn('facebook_utils.facebook_transport', loaded)
+        self.assertIn('requests', self._loaded('import facebook_utils\nfacebook_utils.FacebookHub(app_id="1", app_secret="s").transport'))
+
+    def test_star_import(self):
+        namespace = {}
+        exec 'from facebook_utils import *' in namespace
+        for name in ('FacebookHub', 'FacebookApiUrls', 'ApiError', 'FacebookTransport', 'includeme', 'FB_GRAPH_API_URL'):
+            self.assertIs(namespace[name], getattr(fb, name))
+        self.assertRaises(AttributeError, getattr, fb, 'NoSuchThing')